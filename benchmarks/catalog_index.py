@@ -0,0 +1,74 @@
+import argparse
+import time
+import numpy as np
+from contentDetectron import catalogIndex
+from contentDetectron import detectron
+from contentDetectron import featureStore
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Recall and speed of approximate catalog indices against the exact flat index")
+	parser.add_argument(u"--vectors_dir", required=True, help="directory with the feature vectors of the episodes")
+	parser.add_argument(u"--factories", nargs='+', default=['HNSW32', 'IVF256,Flat', 'IVF256,PQ20'],
+						help="FAISS factory strings to compare")
+	parser.add_argument(u"--nprobe", nargs='+', type=int, default=[1, 4, 16, 64])
+	parser.add_argument(u"--ef_search", nargs='+', type=int, default=[16, 64, 256])
+	parser.add_argument(u"--k", nargs='?', const=32, type=int, default=32,
+						help="neighbours searched to find the nearest one from another episode")
+	return parser.parse_args()
+
+
+def nearest_other_episode(index, vectors, episodes, k):
+	_, ids = index.search(vectors, k)
+	# ids of the vectors are their rows, -1 marks a missing neighbour
+	other_episode = (ids >= 0) & (episodes[np.clip(ids, 0, None)] != episodes[:, None])
+	nearest = ids[np.arange(ids.shape[0]), other_episode.argmax(axis=1)]
+	nearest[~other_episode.any(axis=1)] = -1
+	return nearest
+
+
+def timed_index(factory, vectors, search_params):
+	start = time.perf_counter()
+	index = catalogIndex.build_index(factory, vectors.shape[1])
+	index.train(vectors)
+	index.add_with_ids(vectors, np.arange(vectors.shape[0], dtype=np.int64))
+	catalogIndex.set_search_params(index, search_params)
+	return index, time.perf_counter() - start
+
+
+def main():
+	command_params = parse_cli_arguments()
+	videos = featureStore.list_videos(command_params.vectors_dir)
+	season_vectors = detectron.load_season_vectors(videos, command_params.vectors_dir)
+	episodes = np.repeat(np.arange(len(season_vectors)), [v.shape[0] for v in season_vectors])
+	vectors = np.ascontiguousarray(np.vstack(season_vectors))
+	print(f"Episodes: {len(videos)} \t Vectors: {vectors.shape[0]} \t Dimension: {vectors.shape[1]}")
+
+	exact_index, build_time = timed_index('Flat', vectors, {})
+	start = time.perf_counter()
+	exact = nearest_other_episode(exact_index, vectors, episodes, command_params.k)
+	exact_time = time.perf_counter() - start
+	print(f"{'Flat':<16} {'':<14} build {build_time:8.2f}s \t {vectors.shape[0] / exact_time:10.0f} queries/s \t "
+		  f"recall@1 1.000")
+
+	for factory in command_params.factories:
+		if factory.startswith('IVF'):
+			settings = [{'nprobe': n} for n in command_params.nprobe]
+		elif 'HNSW' in factory:
+			settings = [{'efSearch': n} for n in command_params.ef_search]
+		else:
+			settings = [{}]
+		index, build_time = timed_index(factory, vectors, {})
+		for search_params in settings:
+			catalogIndex.set_search_params(index, search_params)
+			start = time.perf_counter()
+			nearest = nearest_other_episode(index, vectors, episodes, command_params.k)
+			query_time = time.perf_counter() - start
+			recall = np.mean(nearest == exact)
+			params = ','.join(f"{name}={value}" for name, value in search_params.items())
+			print(f"{factory:<16} {params:<14} build {build_time:8.2f}s \t {vectors.shape[0] / query_time:10.0f} "
+				  f"queries/s \t recall@1 {recall:.3f}")
+
+
+if __name__ == "__main__":
+	main()
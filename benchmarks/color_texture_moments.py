@@ -0,0 +1,52 @@
+import argparse
+import time
+import cv2
+import numpy as np
+from contentDetectron import featureVectorizer
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Checks the vectorized color texture moments against matchTemplate and times it")
+	parser.add_argument(u"--video", required=True, help="video file to sample the frames from")
+	parser.add_argument(u"--framejump", nargs='?', const=25, type=int, default=25)
+	parser.add_argument(u"--tolerance", nargs='?', const=1e-5, type=float, default=1e-5)
+	return parser.parse_args()
+
+
+def matched_color_texture_moments(img):
+	# one matchTemplate per channel and template, the way the moments used to be computed
+	img = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+	result = []
+	for channel in range(0, 3):
+		for template, max_val in zip(*featureVectorizer.get_fourier_templates()[:2]):
+			r = cv2.matchTemplate(img[:, :, channel].astype('float32'), template, cv2.TM_CCORR)
+			r = r / max_val
+			result.append(r.mean())
+			result.append(r.std())
+	return np.array(result, np.float32)
+
+
+def timed(vector_function, frames):
+	start = time.perf_counter()
+	vectors = np.array([vector_function(img) for img in frames])
+	return vectors, time.perf_counter() - start
+
+
+def main():
+	command_params = parse_cli_arguments()
+	video = cv2.VideoCapture(command_params.video)
+	frames = [img for _, img in featureVectorizer.iter_frames(video, command_params.framejump)]
+
+	expected, matched_time = timed(matched_color_texture_moments, frames)
+	vectors, filtered_time = timed(featureVectorizer.color_texture_moments, frames)
+	difference = np.abs(vectors - expected).max()
+
+	print(f"Frames: {len(frames)} \t Vector size: {vectors.shape[1]} \t Max difference: {difference:.2e}")
+	print(f"matchTemplate: \t {len(frames) / matched_time:.1f} frames/s")
+	print(f"filter2D: \t {len(frames) / filtered_time:.1f} frames/s")
+	if difference > command_params.tolerance:
+		raise Exception(f"The color texture moments differ by more than {command_params.tolerance}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from contentDetectron import catalogIndex
+from contentDetectron import featureStore
+from contentDetectron import instrumentation
+from . import suite
+from . import synthetic_season
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Disk and index memory, query time, precision and recall of the compressed "
+									 u"feature vectors of a method on a synthetic season")
+	parser.add_argument(u"--season_dir", nargs='?', const='./benchmarks/season/', type=str,
+						default='./benchmarks/season/', help="synthetic season directory, generated when missing")
+	parser.add_argument(u"--episodes", nargs='?', const=6, type=int, default=6)
+	parser.add_argument(u"--duration", nargs='?', const=120, type=int, default=120)
+	parser.add_argument(u"--method", nargs='?', const='CH', type=str, default='CH')
+	parser.add_argument(u"--compressions", nargs='+', default=['none', 'float16', 'pca32', 'pq20'],
+						help="'none' is the exact float32 index, the pq subquantizers have to divide the dimension "
+							 "of the method vectors")
+	parser.add_argument(u"--framejump", nargs='?', const=4, type=int, default=4)
+	parser.add_argument(u"--resize_width", nargs='?', const=320, type=int, default=320)
+	return parser.parse_args()
+
+
+def disk_bytes(vectors_dir):
+	return sum(os.path.getsize(os.path.join(vectors_dir, name)) for name in os.listdir(vectors_dir)
+			   if name.endswith(featureStore.VECTORS_EXTENSION))
+
+
+def measure(video_dir, annotations_filename, method, compression, framejump, resize_width, artifacts_dir, duration):
+	metrics = instrumentation.Metrics()
+	accuracy = suite.detection_accuracy(video_dir, annotations_filename, method, framejump, resize_width,
+										artifacts_dir, duration, compression=compression, metrics=metrics)
+	counters = metrics.season["counters"]
+	stats = {"stored_dtype": catalogIndex.storage_dtype(compression)}
+	# PCA and PQ are learned by the season index from the float32 vectors, only the index memory shrinks
+	if compression in (None, 'float16'):
+		stats["disk_bytes"] = disk_bytes(os.path.join(artifacts_dir, "cache", "vectors"))
+	stats.update({"index_bytes": counters.get("index_bytes", 0), "index_vectors": counters.get("index_vectors", 0),
+				  "index_seconds": metrics.season["stages"].get("index", 0.0),
+				  "query_seconds": metrics.to_dict()["episode_totals"]["stages"].get("query", 0.0),
+				  "detect_seconds": accuracy["detect_seconds"], "precision": accuracy["precision"],
+				  "recall": accuracy["recall"]})
+	return stats
+
+
+def main():
+	command_params = parse_cli_arguments()
+	annotations_filename = synthetic_season.generate_season(command_params.season_dir, command_params.episodes,
+															command_params.duration)
+	video_dir = os.path.join(command_params.season_dir, "videos")
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		for compression in command_params.compressions:
+			compression = None if compression == 'none' else compression
+			stats = measure(video_dir, annotations_filename, command_params.method, compression,
+							command_params.framejump, command_params.resize_width,
+							os.path.join(tmp_dir, compression or 'none'), command_params.duration)
+			print(f"{compression or 'none'}: {json.dumps(stats)}")
+			if "disk_bytes" not in stats:
+				print(f"{compression}: the vectors are stored as {stats['stored_dtype']}, the disk size is the one "
+					  f"of none")
+	finally:
+		shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,53 @@
+import argparse
+import time
+import cv2
+from contentDetectron import featureVectorizer
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Compares the seeking frame reader against the sequential streaming reader")
+	parser.add_argument(u"--video", required=True, help="video file to decode")
+	parser.add_argument(u"--framejump", nargs='?', const=8, type=int, default=8)
+	return parser.parse_args()
+
+
+def seeking_reader(video_file, framejump):
+	video = cv2.VideoCapture(video_file)
+	total = featureVectorizer.get_sampled_frames_count(video, framejump)
+	indices = []
+	for i in range(total):
+		featureVectorizer.get_frame(i * framejump, video)
+		indices.append(i * framejump)
+	video.release()
+	return indices
+
+
+def streaming_reader(video_file, framejump):
+	video = cv2.VideoCapture(video_file)
+	indices = [frame_index for frame_index, _ in featureVectorizer.iter_frames(video, framejump)]
+	video.release()
+	return indices
+
+
+def timed(reader, video_file, framejump):
+	start = time.perf_counter()
+	indices = reader(video_file, framejump)
+	return indices, time.perf_counter() - start
+
+
+def main():
+	command_params = parse_cli_arguments()
+	seek_indices, seek_time = timed(seeking_reader, command_params.video, command_params.framejump)
+	stream_indices, stream_time = timed(streaming_reader, command_params.video, command_params.framejump)
+
+	if seek_indices != stream_indices:
+		raise Exception("The streaming reader sampled different frame indices than the seeking reader")
+
+	print(f"Sampled frames: {len(stream_indices)}")
+	print(f"Seeking reader: \t {seek_time:.2f}s \t {len(seek_indices) / seek_time:.1f} frames/s")
+	print(f"Streaming reader: \t {stream_time:.2f}s \t {len(stream_indices) / stream_time:.1f} frames/s")
+	print(f"Speedup: {seek_time / stream_time:.2f}x")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,59 @@
+import argparse
+import json
+import subprocess
+import sys
+import numpy as np
+
+
+HEAVY_MODULES = ['keras', 'tensorflow', 'pandas']
+
+# runs in a fresh interpreter, so nothing is imported yet
+PROBE = """
+import json, sys, time
+import numpy as np
+start = time.perf_counter()
+from contentDetectron import detectron, featureVectorizer
+imported = time.perf_counter() - start
+featureVectorizer.vectorize_frames([(0, np.zeros((240, 320, 3), np.uint8))], sys.argv[1], 1, False)
+print(json.dumps({"import_seconds": imported, "first_frame_seconds": time.perf_counter() - start,
+				  "loaded": [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Times the import of the detection and the first frame of a feature method "
+									 u"and checks that no heavy backend is imported by the methods not using it")
+	parser.add_argument(u"--method", nargs='?', const='CH', type=str, default='CH')
+	parser.add_argument(u"--repeats", nargs='?', const=5, type=int, default=5)
+	parser.add_argument(u"--max_seconds", required=False, type=float, default=None,
+						help="fails when the median time to the first vectorized frame is longer")
+	return parser.parse_args()
+
+
+def measure(method):
+	output = subprocess.run([sys.executable, "-c", PROBE, method] + HEAVY_MODULES, check=True,
+							stdout=subprocess.PIPE, universal_newlines=True).stdout
+	return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+	command_params = parse_cli_arguments()
+	runs = [measure(command_params.method) for _ in range(command_params.repeats)]
+	import_seconds = float(np.median([run["import_seconds"] for run in runs]))
+	first_frame_seconds = float(np.median([run["first_frame_seconds"] for run in runs]))
+	loaded = sorted(set(module for run in runs for module in run["loaded"]))
+	print(f"Method: {command_params.method}\nImport: {import_seconds:.3f}s\n"
+		  f"First frame: {first_frame_seconds:.3f}s\nHeavy modules loaded: {', '.join(loaded) or 'none'}")
+
+	failures = []
+	if command_params.method != 'CNN' and loaded:
+		failures.append(f"{', '.join(loaded)} imported without being used")
+	if command_params.max_seconds is not None and first_frame_seconds > command_params.max_seconds:
+		failures.append(f"first frame after {first_frame_seconds:.3f}s, over {command_params.max_seconds}s")
+	if failures:
+		print("Regression: " + "; ".join(failures))
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
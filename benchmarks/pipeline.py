@@ -0,0 +1,61 @@
+import argparse
+import shutil
+import tempfile
+import time
+import tracemalloc
+import cv2
+from contentDetectron import featureStore
+from contentDetectron import featureVectorizer
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Time and peak memory of the sequential extraction of an episode against the "
+									 u"pipelined one decoding, vectorizing and writing at the same time")
+	parser.add_argument(u"--video", required=True, help="resized video file")
+	parser.add_argument(u"--method", nargs='?', const='CH', type=str, default='CH')
+	parser.add_argument(u"--framejump", nargs='?', const=4, type=int, default=4)
+	parser.add_argument(u"--feature_threads", nargs='+', type=int, default=[1, 2, 4])
+	return parser.parse_args()
+
+
+def measure(function):
+	tracemalloc.start()
+	start = time.perf_counter()
+	function()
+	seconds = time.perf_counter() - start
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return seconds, peak / 1024 ** 2
+
+
+def sequential(video_file, method, framejump, vectors_dir):
+	vectors = featureVectorizer.vectorize_frames(featureVectorizer.iter_frames(cv2.VideoCapture(video_file), framejump),
+												 method, None, False)
+	featureStore.save_vectors(vectors_dir, "sequential", vectors, {})
+
+
+def pipelined(video_file, method, framejump, vectors_dir, feature_threads):
+	featureVectorizer.construct_feature_vectors(video_file, None, method, framejump, False,
+												vectors_dir=vectors_dir, vectors_name=f"pipelined{feature_threads}",
+												feature_threads=feature_threads)
+
+
+def main():
+	command_params = parse_cli_arguments()
+	# loads the model and the templates of the method outside of the measurements
+	featureVectorizer.load_model(command_params.method)
+	vectors_dir = tempfile.mkdtemp()
+	try:
+		seconds, peak = measure(lambda: sequential(command_params.video, command_params.method,
+												   command_params.framejump, vectors_dir))
+		print(f"Sequential: {seconds:.2f}s, peak {peak:.1f} MB")
+		for feature_threads in command_params.feature_threads:
+			seconds, peak = measure(lambda: pipelined(command_params.video, command_params.method,
+													  command_params.framejump, vectors_dir, feature_threads))
+			print(f"Pipelined with {feature_threads} feature threads: {seconds:.2f}s, peak {peak:.1f} MB")
+	finally:
+		shutil.rmtree(vectors_dir)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,52 @@
+import argparse
+import os
+import tempfile
+import time
+import cv2
+import numpy as np
+from contentDetectron import featureVectorizer
+from contentDetectron.rmac import export
+from contentDetectron.rmac import frozen
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Checks the vectors of the frozen RMAC graph against the keras model and times both")
+	parser.add_argument(u"--video", required=True, help="video file to sample the frames from")
+	parser.add_argument(u"--framejump", nargs='?', const=25, type=int, default=25)
+	parser.add_argument(u"--quantize", action='store_true')
+	parser.add_argument(u"--min_cosine", nargs='?', const=0.9999, type=float, default=None,
+						help="lowest accepted cosine similarity, 0.9999 for float and 0.99 for quantized graphs")
+	return parser.parse_args()
+
+
+def timed(function, frames):
+	start = time.perf_counter()
+	vectors = function(frames)
+	return vectors, len(frames) / (time.perf_counter() - start)
+
+
+def main():
+	command_params = parse_cli_arguments()
+	min_cosine = command_params.min_cosine or (0.99 if command_params.quantize else 0.9999)
+	video = cv2.VideoCapture(command_params.video)
+	frames = [cv2.resize(img, (244, 244)) for _, img in featureVectorizer.iter_frames(video, command_params.framejump)]
+
+	from contentDetectron.rmac import rmac
+	expected, keras_speed = timed(rmac.to_feature_vectors, frames)
+
+	graph_file = os.path.join(tempfile.mkdtemp(), "rmac_frozen.pb")
+	export.export_frozen_graph(graph_file, command_params.quantize)
+	frozen.configure(graph_file)
+	vectors, frozen_speed = timed(frozen.to_feature_vectors, frames)
+
+	# the vectors are l2 normalized, so the dot product is the cosine similarity
+	cosine = np.sum(expected * vectors, axis=1)
+	print(f"Frames: {len(frames)}\nGraph size: {os.path.getsize(graph_file) / 1024 ** 2:.1f} MB\n"
+		  f"Max abs difference: {np.abs(expected - vectors).max():.2e}\nMin cosine similarity: {cosine.min():.6f}\n"
+		  f"Keras: {keras_speed:.1f} frames/s\nFrozen: {frozen_speed:.1f} frames/s")
+	if cosine.min() < min_cosine:
+		raise Exception(f"The frozen graph vectors differ from the keras model, cosine {cosine.min()} < {min_cosine}")
+
+
+if __name__ == "__main__":
+	main()
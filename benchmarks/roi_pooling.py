@@ -0,0 +1,64 @@
+import argparse
+import time
+import numpy as np
+import keras.backend as K
+from keras.layers import Input
+from keras.models import Model
+from contentDetectron.rmac.RoiPooling import RoiPooling
+from contentDetectron.rmac.get_regions import rmac_regions, get_size_vgg_feature_map
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Checks the vectorized RoiPooling layer against the per-region loop and times it")
+	parser.add_argument(u"--batch_size", nargs='?', const=8, type=int, default=8)
+	parser.add_argument(u"--channels", nargs='?', const=512, type=int, default=512)
+	parser.add_argument(u"--feature_map", nargs='?', const=14, type=int, default=14)
+	return parser.parse_args()
+
+
+def looped_roi_pooling(img, rois, pool_list):
+	# the per-region slicing the layer used to build its graph with, in 'th' dim ordering
+	outputs = []
+	for x, y, w, h in rois:
+		for num_pool_regions in pool_list:
+			row_length = w / num_pool_regions
+			col_length = h / num_pool_regions
+			for ix in range(num_pool_regions):
+				for jy in range(num_pool_regions):
+					x1 = x + ix * col_length
+					y1 = y + jy * row_length
+					x1, x2 = int(np.round(x1)), int(np.round(x1 + col_length))
+					y1, y2 = int(np.round(y1)), int(np.round(y1 + row_length))
+					outputs.append(img[:, :, y1:y2, x1:x2].max(axis=(2, 3)))
+	outputs = np.stack(outputs, axis=1)
+	return outputs.reshape((img.shape[0], len(rois), -1))
+
+
+def main():
+	command_params = parse_cli_arguments()
+	K.set_image_dim_ordering('th')
+	Wmap, Hmap = get_size_vgg_feature_map(224, 224)
+	regions = rmac_regions(Wmap, Hmap, 3)
+	img = np.random.rand(command_params.batch_size, command_params.channels, command_params.feature_map,
+						 command_params.feature_map).astype('float32')
+	batch_regions = np.tile(np.expand_dims(regions, axis=0), (command_params.batch_size, 1, 1))
+
+	for pool_list in ([1], [1, 2], [1, 2, 3]):
+		start = time.perf_counter()
+		in_img = Input(shape=img.shape[1:])
+		in_roi = Input(shape=(len(regions), 4))
+		model = Model([in_img, in_roi], RoiPooling(pool_list, len(regions))([in_img, in_roi]))
+		build_time = time.perf_counter() - start
+
+		start = time.perf_counter()
+		pooled = model.predict([img, batch_regions], batch_size=command_params.batch_size)
+		predict_time = time.perf_counter() - start
+
+		expected = looped_roi_pooling(img, regions, pool_list)
+		if not np.array_equal(pooled, expected):
+			raise Exception(f"RoiPooling output differs from the looped pooling for pool list {pool_list}")
+		print(f"Pool list {pool_list}: \t build {build_time:.3f}s \t predict {predict_time:.3f}s \t outputs match")
+
+
+if __name__ == "__main__":
+	main()
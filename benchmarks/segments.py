@@ -0,0 +1,129 @@
+import argparse
+import itertools
+import operator
+import time
+import numpy as np
+from contentDetectron import segments
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Checks the run-length segment engine against the loop based post-processing")
+	parser.add_argument(u"--episodes", nargs='?', const=200, type=int, default=200)
+	parser.add_argument(u"--samples", nargs='?', const=20000, type=int, default=20000,
+						help="largest number of sampled frames per synthetic episode")
+	parser.add_argument(u"--seed", nargs='?', const=0, type=int, default=0)
+	return parser.parse_args()
+
+
+def looped_fill_gaps(sequence, lookahead):
+	i = 0
+	change_needed = False
+	look_left = 0
+	while i < len(sequence):
+		look_left -= 1
+		if change_needed and look_left < 1:
+			change_needed = False
+		if sequence[i]:
+			if change_needed:
+				for k in to_change:
+					sequence[k] = True
+			else:
+				change_needed = True
+			look_left = lookahead
+			to_change = []
+		else:
+			if change_needed:
+				to_change.append(i)
+		i += 1
+	return sequence
+
+
+def max_two_values(d):
+	v = list(d.values())
+	k = list(d.keys())
+	result1 = k[v.index(max(v))]
+	del d[result1]
+	v = list(d.values())
+	k = list(d.keys())
+	result2 = k[v.index(max(v))]
+	return [result1, result2]
+
+
+def looped_detection(result, framerate, framejump, percentile, video_start_threshold_percentile,
+					 video_end_threshold_seconds, min_detection_size_seconds):
+	# the post-processing detect used to run with groupby runs and the dict based two longest selection
+	threshold = np.percentile(result, percentile)
+	below_threshold = result < threshold
+	below_threshold = looped_fill_gaps(below_threshold, int((framerate / framejump) * 10))
+	nonzeros = [[i for i, v in it] for k, it in itertools.groupby(enumerate(below_threshold),
+																  key=operator.itemgetter(1))
+				if k != 0]
+	detected_beginning = []
+	detected_end = []
+
+	for nonzero in nonzeros:
+		start = nonzero[0]
+		end = nonzero[-1]
+		occurs_at_beggining = end < len(result) * (video_start_threshold_percentile/100)
+		ends_at_the_end = end  > len(result) - video_end_threshold_seconds * (framerate/framejump)
+
+		if (end - start > (min_detection_size_seconds * (framerate/framejump))
+			and (occurs_at_beggining or ends_at_the_end)):
+			start = start/(framerate/framejump)
+			end = end / (framerate/framejump)
+			if occurs_at_beggining:
+				detected_beginning.append((start, end))
+			elif ends_at_the_end:
+				detected_end.append((start, end))
+
+	if len(detected_beginning) > 2:
+		detected_beginning = max_two_values({(start, end): end - start for start, end in detected_beginning})
+	return detected_beginning + detected_end
+
+
+def run_length_detection(result, framerate, framejump, percentile, video_start_threshold_percentile,
+						 video_end_threshold_seconds, min_detection_size_seconds):
+	detected_beginning, detected_end = segments.detect_segments(
+		result, framerate, framejump, percentile, video_start_threshold_percentile, video_end_threshold_seconds,
+		min_detection_size_seconds
+	)
+	return segments.longest_segments(detected_beginning) + detected_end
+
+
+def synthetic_corpus(command_params):
+	random = np.random.RandomState(command_params.seed)
+	corpus = []
+	for _ in range(command_params.episodes):
+		length = random.randint(10, command_params.samples)
+		# blocks of low distances with noise around them, as an intro, an outro and random matches produce
+		result = random.rand(length).astype(np.float32)
+		for _ in range(random.randint(0, 12)):
+			start = random.randint(0, length)
+			result[start:start + random.randint(1, 400)] *= random.rand() * 0.2
+		params = (random.choice([23.976, 25, 29.97, 30]), random.choice([1, 2, 3, 8]), random.randint(5, 40),
+				  random.randint(10, 40), random.randint(3, 30), random.randint(1, 20))
+		corpus.append((result, params))
+	return corpus
+
+
+def main():
+	command_params = parse_cli_arguments()
+	corpus = synthetic_corpus(command_params)
+	timings = {}
+
+	outputs = {}
+	for detection in (looped_detection, run_length_detection):
+		start = time.perf_counter()
+		outputs[detection.__name__] = [detection(result, *params) for result, params in corpus]
+		timings[detection.__name__] = time.perf_counter() - start
+
+	mismatches = sum(a != b for a, b in zip(outputs['looped_detection'], outputs['run_length_detection']))
+	for name, seconds in timings.items():
+		print(f"{name}: \t {seconds:.3f}s")
+	print(f"Episodes: {len(corpus)} \t Mismatches: {mismatches}")
+	if mismatches:
+		raise Exception("The run-length segment engine differs from the loop based post-processing")
+
+
+if __name__ == "__main__":
+	main()
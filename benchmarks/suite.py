@@ -0,0 +1,163 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+import cv2
+import numpy as np
+from contentDetectron import detectron
+from contentDetectron import evaluation
+from contentDetectron import featureStore
+from contentDetectron import featureVectorizer
+from contentDetectron import segments
+from . import synthetic_season
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Stage level throughput and accuracy of the detection on a synthetic season")
+	parser.add_argument(u"--season_dir", nargs='?', const='./benchmarks/season/', type=str,
+						default='./benchmarks/season/', help="synthetic season directory, generated when missing")
+	parser.add_argument(u"--output", nargs='?', const='./benchmarks/results.json', type=str,
+						default='./benchmarks/results.json', help="JSON file the results are written to")
+	parser.add_argument(u"--episodes", nargs='?', const=6, type=int, default=6)
+	parser.add_argument(u"--duration", nargs='?', const=120, type=int, default=120)
+	parser.add_argument(u"--seed", nargs='?', const=0, type=int, default=0)
+	parser.add_argument(u"--methods", nargs='+', default=['CH', 'CTM', 'CNN'])
+	parser.add_argument(u"--framejump", nargs='?', const=4, type=int, default=4)
+	parser.add_argument(u"--resize_width", nargs='?', const=320, type=int, default=320)
+	parser.add_argument(u"--season_sizes", nargs='+', type=int, default=[1, 2, 4, 8],
+						help="multiples of the season the FAISS query is timed on")
+	return parser.parse_args()
+
+
+def peak_rss_mb():
+	# ru_maxrss is in kilobytes on linux
+	return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def timed(function, *args, **kwargs):
+	start = time.perf_counter()
+	with contextlib.redirect_stdout(io.StringIO()):
+		result = function(*args, **kwargs)
+	return result, time.perf_counter() - start
+
+
+def method_available(method):
+	try:
+		featureVectorizer.get_vector_function(method)(np.zeros((224, 224, 3), np.uint8))
+	except ImportError:
+		return False
+	return True
+
+
+def extraction_throughput(video_file, method, framejump, resize_width):
+	video = cv2.VideoCapture(video_file)
+	total = featureVectorizer.get_sampled_frames_count(video, framejump)
+	height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT) * resize_width / video.get(cv2.CAP_PROP_FRAME_WIDTH))
+	frames, decode_time = timed(lambda: [(i, cv2.resize(img, (resize_width, height)))
+										 for i, img in featureVectorizer.iter_frames(video, framejump, total)])
+	_, vectorize_time = timed(featureVectorizer.vectorize_frames, frames, method, total, False)
+	return {"frames": len(frames), "decode_frames_per_second": len(frames) / decode_time,
+			"vectorize_frames_per_second": len(frames) / vectorize_time}
+
+
+def detection_accuracy(video_dir, annotations_filename, method, framejump, resize_width, artifacts_dir, duration,
+					   **detect_params):
+	detected, detect_time = timed(detectron.detect, video_dir, method, artifacts_dir=artifacts_dir,
+								  framejump=framejump, resize_width=resize_width,
+								  **synthetic_season.detection_params(duration), **detect_params)
+	annotations = evaluation.get_annotations(annotations_filename)
+	totals = np.zeros(3)
+	for video, timestamps in detected.items():
+		ground_truth = evaluation.skip_timestamps_in_file(video, annotations)
+		totals += evaluation.precision_recall_detections_score(timestamps, ground_truth)
+	relevant, retrieved, relevant_retrieved = totals
+	# the 2 second boundary tolerance of the evaluation can credit more time than was detected
+	return {"detect_seconds": detect_time,
+			"precision": min(1.0, relevant_retrieved / retrieved) if retrieved else 0.0,
+			"recall": relevant_retrieved / relevant if relevant else 0.0}
+
+
+def query_scaling(vectors_dir, videos, season_sizes, tmp_dir):
+	# the season is tiled with a little noise to time the query on larger seasons
+	vectors = [np.array(featureStore.load_vectors(vectors_dir, video)) for video in videos]
+	random = np.random.RandomState(0)
+	scaling = []
+	for size in season_sizes:
+		scaled_dir = os.path.join(tmp_dir, f"season_x{size}")
+		names = []
+		for copy in range(size):
+			for video, episode_vectors in zip(videos, vectors):
+				names.append(f"{copy}_{video}")
+				noise = random.rand(*episode_vectors.shape).astype(np.float32) * 1e-3 * (copy > 0)
+				featureStore.save_vectors(scaled_dir, names[-1], episode_vectors + noise, {})
+		results, query_time = timed(detectron.query_episodes_with_faiss, names, scaled_dir)
+		scaling.append({"episodes": len(names), "vectors": int(sum(v.shape[0] for v in vectors) * size),
+						"query_seconds": query_time})
+	return scaling, results
+
+
+def post_processing_time(results, framerate, framejump):
+	_, seconds = timed(lambda: [segments.longest_segments(segments.detect_segments(result, framerate, framejump, 20,
+																				   20, 5, 3)[0])
+								for _, result in results])
+	return {"episodes": len(results), "seconds": seconds}
+
+
+def main():
+	command_params = parse_cli_arguments()
+	annotations_filename = synthetic_season.generate_season(command_params.season_dir, command_params.episodes,
+															command_params.duration, command_params.seed)
+	video_dir = os.path.join(command_params.season_dir, "videos")
+	videos = sorted(os.listdir(video_dir))
+	framerate = cv2.VideoCapture(os.path.join(video_dir, videos[0])).get(cv2.CAP_PROP_FPS)
+	report = {"date": datetime.datetime.now().isoformat(), "python": platform.python_version(),
+			  "params": vars(command_params), "methods": {}}
+
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		for method in command_params.methods:
+			if not method_available(method):
+				print(f"Skipping {method}, its backend is not installed")
+				continue
+			resize_width = 224 if method == 'CNN' else command_params.resize_width
+			stats = extraction_throughput(os.path.join(video_dir, videos[0]), method, command_params.framejump,
+										  resize_width)
+			stats.update(detection_accuracy(video_dir, annotations_filename, method, command_params.framejump,
+											resize_width, os.path.join(tmp_dir, method), command_params.duration))
+			report["methods"][method] = stats
+			print(f"{method}: {json.dumps(stats)}")
+			if stats["recall"] == 0:
+				raise Exception(f"{method} detected none of the intros and outros of the synthetic season, "
+								f"the detection is broken")
+
+		if not report["methods"]:
+			raise Exception(f"None of the methods {command_params.methods} could be benchmarked, "
+							f"their backends are not installed")
+		method = next(iter(report["methods"]))
+		vectors_dir = os.path.join(tmp_dir, method, "cache", "vectors")
+		vector_names = featureStore.list_videos(vectors_dir)
+		report["faiss_query"], results = query_scaling(vectors_dir, vector_names, command_params.season_sizes,
+													   tmp_dir)
+		report["post_processing"] = post_processing_time(results, framerate, command_params.framejump)
+		print(f"FAISS query: {json.dumps(report['faiss_query'])}")
+		print(f"Post-processing: {json.dumps(report['post_processing'])}")
+	finally:
+		shutil.rmtree(tmp_dir)
+
+	report["peak_rss_mb"] = peak_rss_mb()
+	os.makedirs(os.path.dirname(os.path.abspath(command_params.output)), exist_ok=True)
+	with open(command_params.output, "w") as outfile:
+		json.dump(report, outfile, indent=1)
+	print(f"Peak RSS: {report['peak_rss_mb']:.0f} MB\nResults saved into {command_params.output}")
+
+
+if __name__ == "__main__":
+	main()
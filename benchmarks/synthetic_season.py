@@ -0,0 +1,136 @@
+import argparse
+import os
+import shutil
+import cv2
+import numpy as np
+
+
+ANNOTATION_COLUMNS = ["filename", "recap_start", "recap_end", "openingcredits_start", "openingcredits_end",
+					  "preview_start", "preview_end", "closingcredits_start", "closingcredits_end"]
+# side in pixels of the texture blocks and range of the colour spread around the dominant colour of a scene
+BLOCK_SIZES = [4, 8, 16, 32, 64]
+MIN_SPREAD = 8
+MAX_SPREAD = 64
+# standard deviation of the grain added to the shared intro and outro of every episode, like a new encoding of them
+GRAIN = 3
+INTRO_SECONDS = 10
+OUTRO_SECONDS = 15
+# the intro starts at a random second before this one and the outro ends this many seconds before the episode end
+MAX_INTRO_START = 5
+END_SECONDS = 2
+# layout of the generated episodes, a season generated by another version or with other parameters is regenerated
+SEASON_VERSION = 2
+SEASON_FILE = "season.txt"
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Generates a synthetic season with a shared intro and outro at known positions")
+	parser.add_argument(u"--output_dir", required=True, help="directory the episodes and annotations.csv are written to")
+	parser.add_argument(u"--episodes", nargs='?', const=6, type=int, default=6)
+	parser.add_argument(u"--duration", nargs='?', const=120, type=int, default=120, help="episode length in seconds")
+	parser.add_argument(u"--seed", nargs='?', const=0, type=int, default=0)
+	return parser.parse_args()
+
+
+def to_timestamp(seconds):
+	return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def random_scene(random, width, height):
+	# every scene gets its own dominant colour, colour spread and block size, so that the colour histograms and the
+	# textures of the scenes differ from each other like the shots of a real episode, the blocks are scaled up
+	# so the scene survives the encoding and resizing
+	block = random.choice(BLOCK_SIZES)
+	spread = random.randint(MIN_SPREAD, MAX_SPREAD)
+	colour = random.randint(spread, 256 - spread, 3)
+	blocks = colour + random.randint(-spread, spread, (height // block + 1, width // block + 1, 3))
+	blocks = cv2.resize(blocks.astype(np.uint8), ((width // block + 1) * block, (height // block + 1) * block),
+						interpolation=cv2.INTER_NEAREST)
+	return np.ascontiguousarray(blocks[:height, :width])
+
+
+def with_grain(random, frames):
+	return [np.clip(frame + random.normal(0, GRAIN, frame.shape), 0, 255).astype(np.uint8) for frame in frames]
+
+
+def scenes(random, seconds, fps, width, height, scene_seconds=1):
+	frames = []
+	for _ in range(int(seconds / scene_seconds)):
+		scene = random_scene(random, width, height)
+		for i in range(int(fps * scene_seconds)):
+			# a slow pan keeps the frames of a scene slightly different
+			frames.append(np.roll(scene, i, axis=1))
+	return frames
+
+
+def detection_params(duration, intro_seconds=INTRO_SECONDS, outro_seconds=OUTRO_SECONDS):
+	"""
+	Post-processing parameters of detectron.detect fitted to the layout of the generated episodes: the percentile
+	threshold stays below the share of the episode the intro and outro take, so only their frames match, and the
+	start threshold covers the latest possible intro.
+	:return: dictionary of the keyword arguments of detectron.detect
+	"""
+	return {"percentile": 80 * (intro_seconds + outro_seconds) / duration,
+			"video_start_threshold_percentile": 100 * (MAX_INTRO_START + intro_seconds) / duration + 10,
+			"video_end_threshold_seconds": END_SECONDS + 3, "min_detection_size_seconds": 3}
+
+
+def generate_season(output_dir, episodes=6, duration=120, seed=0, fps=25, width=320, height=240,
+					intro_seconds=INTRO_SECONDS, outro_seconds=OUTRO_SECONDS):
+	"""
+	Writes a season of synthetic episodes: filler scenes of their own colours and textures, a shared intro starting
+	at a random second within the first MAX_INTRO_START seconds, more filler and a shared outro ending END_SECONDS
+	seconds before the end of the episode. The shared frames get a new grain in every episode.
+	The generation is deterministic for a seed and skipped when the season already exists.
+	:return: path of the annotations csv with the ground truth timestamps in the evaluation format
+	"""
+	annotations_filename = os.path.join(output_dir, "annotations.csv")
+	video_dir = os.path.join(output_dir, "videos")
+	season_filename = os.path.join(output_dir, SEASON_FILE)
+	season = f"{SEASON_VERSION} {episodes} {duration} {seed} {fps} {width} {height} {intro_seconds} {outro_seconds}"
+	if os.path.isfile(annotations_filename) and os.path.isfile(season_filename):
+		with open(season_filename) as infile:
+			if infile.read() == season:
+				return annotations_filename
+
+	shutil.rmtree(video_dir, ignore_errors=True)
+	os.makedirs(video_dir)
+	random = np.random.RandomState(seed)
+	intro = scenes(random, intro_seconds, fps, width, height)
+	outro = scenes(random, outro_seconds, fps, width, height)
+	rows = []
+
+	for episode in range(episodes):
+		filename = f"E{episode:03d}.mp4"
+		intro_start = random.randint(0, MAX_INTRO_START)
+		outro_start = duration - END_SECONDS - outro_seconds
+		writer = cv2.VideoWriter(os.path.join(video_dir, filename), cv2.VideoWriter_fourcc(*'mp4v'), fps,
+								 (width, height))
+		frames = (scenes(random, intro_start, fps, width, height) + with_grain(random, intro)
+				  + scenes(random, outro_start - intro_start - intro_seconds, fps, width, height)
+				  + with_grain(random, outro)
+				  + scenes(random, END_SECONDS, fps, width, height))
+		for frame in frames:
+			writer.write(frame)
+		writer.release()
+		rows.append([filename, "", "", to_timestamp(intro_start), to_timestamp(intro_start + intro_seconds), "", "",
+					 to_timestamp(outro_start), to_timestamp(outro_start + outro_seconds)])
+
+	with open(annotations_filename, "w") as outfile:
+		outfile.write(",".join(ANNOTATION_COLUMNS) + "\n")
+		for row in rows:
+			outfile.write(",".join(row) + "\n")
+	with open(season_filename, "w") as outfile:
+		outfile.write(season)
+	return annotations_filename
+
+
+def main():
+	command_params = parse_cli_arguments()
+	annotations_filename = generate_season(command_params.output_dir, command_params.episodes,
+										   command_params.duration, command_params.seed)
+	print(f"Season written to {command_params.output_dir}, ground truth in {annotations_filename}")
+
+
+if __name__ == "__main__":
+	main()
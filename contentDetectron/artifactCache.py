@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import hashlib
+from . import fileUtils
+
+
+CACHE_DIR = "cache"
+MANIFEST_FILE = "manifest.json"
+LOCK_EXTENSION = ".lock"
+FINGERPRINT_CHUNK = 1 << 20
+# kinds of artifacts in the order they are evicted, the distances are requeried from the vectors in seconds
+# and the resized videos are cheaper to rebuild than the vectors
+EVICTION_ORDER = ('distances', 'resized', 'vectors')
+
+
+def fingerprint(source_file):
+	"""
+	Fast partial content hash of a source file: its size, mtime and the first, middle and last chunk.
+	"""
+	stat = os.stat(source_file)
+	digest = hashlib.sha1(f"{stat.st_size}:{stat.st_mtime}".encode())
+	with open(source_file, 'rb') as infile:
+		for offset in (0, stat.st_size // 2, stat.st_size - FINGERPRINT_CHUNK):
+			infile.seek(max(offset, 0))
+			digest.update(infile.read(FINGERPRINT_CHUNK))
+	return digest.hexdigest()
+
+
+def artifact_key(kind, source_fingerprint, **params):
+	"""
+	Key of an artifact built from a source with the given parameters, every parameter affecting the output
+	has to be passed.
+	"""
+	description = json.dumps({"kind": kind, "source": source_fingerprint, "params": params}, sort_keys=True)
+	return hashlib.sha1(description.encode()).hexdigest()
+
+
+class ArtifactCache:
+	"""
+	Content addressed artifacts under artifacts_dir/cache/{kind}/ with a manifest of their sizes and last access
+	times. When the cache grows over max_bytes the least recently used artifacts are evicted, all resized videos
+	before any feature vectors. The registrations are merged into the manifest on disk under a lock by save, which
+	the callers run after every episode, so crashed and concurrent runs do not lose the artifacts they registered.
+	:param artifacts_dir: root artifacts directory
+	:param max_bytes: byte budget of the cache, unbounded when None
+	"""
+
+	def __init__(self, artifacts_dir, max_bytes=None):
+		self.cache_dir = os.path.join(artifacts_dir, CACHE_DIR)
+		self.manifest_filename = os.path.join(self.cache_dir, MANIFEST_FILE)
+		self.lock_filename = self.manifest_filename + LOCK_EXTENSION
+		self.max_bytes = max_bytes
+		self.entries = self.load()
+		# keys dropped since the last save, removed from the manifest on disk as well
+		self.removed = set()
+
+	def load(self):
+		if not os.path.isfile(self.manifest_filename):
+			return {}
+		with open(self.manifest_filename) as infile:
+			return json.load(infile)
+
+	def kind_dir(self, kind):
+		return os.path.join(self.cache_dir, kind)
+
+	def path(self, kind, key, extension=''):
+		return os.path.join(self.kind_dir(kind), key + extension)
+
+	def register(self, kind, key, files):
+		"""
+		Records an access of the artifact made of the files until the next save, artifacts with missing files
+		are not recorded.
+		"""
+		if not all(os.path.isfile(f) for f in files):
+			self.drop(key)
+		else:
+			self.entries[key] = {"kind": kind, "files": [os.path.relpath(f, self.cache_dir) for f in files],
+								 "size": sum(os.path.getsize(f) for f in files), "last_access": time.time()}
+
+	def drop(self, key):
+		self.entries.pop(key, None)
+		self.removed.add(key)
+
+	def total_bytes(self):
+		return sum(entry["size"] for entry in self.entries.values())
+
+	def eviction_rank(self, key):
+		kind = self.entries[key]["kind"]
+		kind_rank = EVICTION_ORDER.index(kind) if kind in EVICTION_ORDER else len(EVICTION_ORDER)
+		return kind_rank, self.entries[key]["last_access"]
+
+	def adopt_unknown_files(self):
+		"""
+		Records the artifacts of the kind directories missing from the manifest, e.g. written by a run which crashed
+		before registering them, with their modification time as last access. The hidden files are the temporary
+		outputs of running writers.
+		"""
+		known = {f for entry in self.entries.values() for f in entry["files"]}
+		for kind in os.listdir(self.cache_dir):
+			if not os.path.isdir(self.kind_dir(kind)):
+				continue
+			for name in os.listdir(self.kind_dir(kind)):
+				filename = os.path.join(self.kind_dir(kind), name)
+				if name.startswith('.') or os.path.join(kind, name) in known or not os.path.isfile(filename):
+					continue
+				key = name.split('.')[0]
+				entry = self.entries.setdefault(key, {"kind": kind, "files": [], "size": 0, "last_access": 0})
+				entry["files"].append(os.path.join(kind, name))
+				entry["size"] += os.path.getsize(filename)
+				entry["last_access"] = max(entry["last_access"], os.path.getmtime(filename))
+
+	def evict(self, protected=()):
+		"""
+		Removes the least recently used artifacts until the cache fits into max_bytes, the artifacts of other runs
+		and the files missing from the manifest included.
+		:param protected: keys which are never evicted, e.g. the artifacts of the current run
+		:return: list of the evicted keys
+		"""
+		evicted = []
+		os.makedirs(self.cache_dir, exist_ok=True)
+		with fileUtils.file_lock(self.lock_filename):
+			self.merge()
+			if self.max_bytes is not None:
+				self.adopt_unknown_files()
+				total = self.total_bytes()
+				candidates = sorted((key for key in self.entries if key not in protected), key=self.eviction_rank)
+				for key in candidates:
+					if total <= self.max_bytes:
+						break
+					entry = self.entries[key]
+					self.drop(key)
+					for f in entry["files"]:
+						try:
+							os.remove(os.path.join(self.cache_dir, f))
+						except FileNotFoundError:
+							# evicted by another run meanwhile
+							pass
+					total -= entry["size"]
+					evicted.append(key)
+			self.write()
+		return evicted
+
+	def merge(self):
+		# the most recent access of every artifact wins, the dropped ones are removed
+		entries = self.load()
+		for key in self.removed:
+			entries.pop(key, None)
+		for key, entry in self.entries.items():
+			if key not in entries or entry["last_access"] >= entries[key]["last_access"]:
+				entries[key] = entry
+		self.entries = entries
+		self.removed = set()
+
+	def write(self):
+		with fileUtils.atomic_output(self.manifest_filename) as tmp_filename:
+			with open(tmp_filename, 'w') as outfile:
+				json.dump(self.entries, outfile, indent=1)
+
+	def save(self):
+		"""
+		Merges the entries into the manifest on disk, which other runs may have updated meanwhile.
+		"""
+		os.makedirs(self.cache_dir, exist_ok=True)
+		with fileUtils.file_lock(self.lock_filename):
+			self.merge()
+			self.write()
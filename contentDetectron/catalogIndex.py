@@ -0,0 +1,154 @@
+import os
+import re
+import json
+import faiss
+import numpy as np
+from . import fileUtils
+
+
+INDEX_FILE = "index.faiss"
+EPISODES_FILE = "episodes.json"
+DEFAULT_FACTORY = "HNSW32"
+# float16, pca<dimension> or pq<subquantizers>
+COMPRESSION_PATTERN = re.compile(r"^(float16|pca(\d+)|pq(\d+))$")
+
+
+def build_index(factory, dimension):
+	# HNSW and flat indices can not store custom ids on their own
+	if not factory.startswith(("IVF", "IDMap")):
+		factory = "IDMap," + factory
+	return faiss.index_factory(dimension, factory)
+
+
+def compression_factory(compression, dimension, count):
+	"""
+	FAISS factory string of a season index searching the compressed vectors directly: 'float16' stores every value
+	in 16 bits, 'pca<dimension>' projects the vectors to a learned lower dimension and 'pq<subquantizers>' encodes
+	every vector in one byte per subquantizer.
+	:param compression: one of the above or None for the exact float32 index
+	:param dimension: dimension of the feature vectors
+	:param count: number of vectors the index is trained on, product quantizers of small seasons use fewer bits
+	"""
+	if compression is None:
+		return "Flat"
+	match = COMPRESSION_PATTERN.match(compression)
+	if match is None:
+		raise Exception(f"Unknown compression {compression}, use float16, pca<dimension> or pq<subquantizers>")
+	if compression == 'float16':
+		return "SQfp16"
+	if match.group(2) is not None:
+		reduced = int(match.group(2))
+		if not 0 < reduced < dimension:
+			raise Exception(f"The PCA dimension {reduced} has to be lower than the vector dimension {dimension}")
+		return f"PCA{reduced},Flat"
+	subquantizers = int(match.group(3))
+	if subquantizers == 0 or dimension % subquantizers:
+		raise Exception(f"The vector dimension {dimension} is not divisible into {subquantizers} subquantizers")
+	# k-means needs more training vectors than centroids
+	bits = max(1, min(8, int(np.log2(max(count, 2)))))
+	return f"PQ{subquantizers}x{bits}"
+
+
+def storage_dtype(compression):
+	# only the float16 compression is stored compressed, PCA and PQ are learned per index from float32 vectors
+	return 'float16' if compression == 'float16' else 'float32'
+
+
+def set_search_params(index, search_params):
+	parameter_space = faiss.ParameterSpace()
+	for name, value in search_params.items():
+		parameter_space.set_index_parameter(index, name, value)
+
+
+class CatalogIndex:
+	"""
+	Persistent approximate nearest neighbour index over the feature vectors of a whole show or catalog.
+	Every vector is labelled with the id of its episode, new episodes are added incrementally and the index
+	is written back to its directory with save. The episodes are keyed by their vector artifact keys, the vectors
+	of a replaced episode are removed from the index, or only excluded from the searches by the indices which can
+	not remove vectors (HNSW).
+	:param catalog_dir: directory where the index and its episodes manifest are stored, one per feature method and
+	vector parameters as the vectors of different ones are not comparable
+	:param factory: FAISS index factory string used when the catalog is created, e.g. 'IVF1024,Flat',
+	'IVF1024,PQ32' or 'HNSW32'
+	:param search_params: FAISS search time parameters, e.g. {'nprobe': 16} for IVF or {'efSearch': 128} for HNSW
+	"""
+
+	def __init__(self, catalog_dir, factory=DEFAULT_FACTORY, search_params=None):
+		self.catalog_dir = catalog_dir
+		self.index_filename = os.path.join(catalog_dir, INDEX_FILE)
+		self.episodes_filename = os.path.join(catalog_dir, EPISODES_FILE)
+		self.search_params = search_params or {}
+		self.index = None
+		self.factory = factory
+		self.episodes = {}
+		# ids of the replaced episodes whose vectors could not be removed from the index
+		self.stale_ids = []
+		self.next_id = 0
+
+		if os.path.isfile(self.index_filename) and os.path.isfile(self.episodes_filename):
+			with open(self.episodes_filename) as infile:
+				manifest = json.load(infile)
+			self.factory = manifest["factory"]
+			self.episodes = manifest["episodes"]
+			self.stale_ids = manifest.get("stale_ids", [])
+			self.next_id = manifest.get("next_id", len(self.episodes))
+			self.index = faiss.read_index(self.index_filename)
+			set_search_params(self.index, self.search_params)
+
+	def __contains__(self, key):
+		return key in self.episodes
+
+	def episode_id(self, key):
+		return self.episodes[key]["id"]
+
+	def remove_episode(self, key):
+		episode_id = self.episodes.pop(key)["id"]
+		try:
+			self.index.remove_ids(np.array([episode_id], np.int64))
+		except RuntimeError:
+			self.stale_ids.append(episode_id)
+
+	def add_episodes(self, episodes_vectors):
+		"""
+		Adds the episodes which are not in the catalog yet, replacing the previous vectors of their episodes.
+		An untrained index (IVF) is trained on the first vectors added to it.
+		:param episodes_vectors: list of (episode, key, vectors) triples, the episode is the path of the video and
+		the key the artifact key of its vectors
+		"""
+		new_episodes = [(episode, key, vectors) for episode, key, vectors in episodes_vectors
+						if key not in self.episodes]
+		if not new_episodes:
+			return
+
+		vectors = np.vstack([v for _, _, v in new_episodes]).astype(np.float32, copy=False)
+		if self.index is None:
+			self.index = build_index(self.factory, vectors.shape[1])
+			set_search_params(self.index, self.search_params)
+		if self.index.d != vectors.shape[1]:
+			raise Exception(f"The catalog {self.catalog_dir} holds vectors of dimension {self.index.d}, "
+							f"not {vectors.shape[1]}")
+		if not self.index.is_trained:
+			try:
+				self.index.train(vectors)
+			except RuntimeError as e:
+				raise Exception(f"Not enough vectors to train the {self.factory} catalog index: {e}")
+
+		new_paths = {episode for episode, _, _ in new_episodes}
+		for key in [key for key, entry in self.episodes.items() if entry["episode"] in new_paths]:
+			self.remove_episode(key)
+		ids = []
+		for episode, key, episode_vectors in new_episodes:
+			self.episodes[key] = {"id": self.next_id, "episode": episode, "vectors": int(episode_vectors.shape[0])}
+			ids.append(np.full(episode_vectors.shape[0], self.next_id, np.int64))
+			self.next_id += 1
+		self.index.add_with_ids(vectors, np.concatenate(ids))
+
+	def save(self):
+		os.makedirs(self.catalog_dir, exist_ok=True)
+		with fileUtils.atomic_output(self.index_filename) as tmp_filename:
+			faiss.write_index(self.index, tmp_filename)
+		with fileUtils.atomic_output(self.episodes_filename) as tmp_filename:
+			with open(tmp_filename, "w") as outfile:
+				json.dump({"factory": self.factory, "episodes": self.episodes, "stale_ids": self.stale_ids,
+						   "next_id": self.next_id}, outfile)
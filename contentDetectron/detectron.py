@@ -1,169 +1,636 @@
 import os
-import itertools
 import numpy as np
-import faiss
-import operator
-import pickle
 import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from tqdm import tqdm
 from natsort import natsorted, ns
 from . import featureVectorizer
 from . import videoUtils
 from . import evaluation
+from . import catalogIndex
+from . import featureStore
+from . import segments
+from . import videoMetadata
+from . import artifactCache
+from . import instrumentation
+from . import fileUtils
+from .rmac import frozen
 
 
-def max_two_values(d):
-	v = list(d.values())
-	k = list(d.keys())
-	result1 = k[v.index(max(v))]
-	del d[result1]
-	v = list(d.values())
-	k = list(d.keys())
-	result2 = k[v.index(max(v))]
-	return [result1, result2]
-
-
-def fill_gaps(sequence, lookahead):
-	"""
-	Fills the gap in features sequence in case of the gap between 1's and 0's values.
-	:param sequence: list consisting of 0's and 1's
-	:param lookahead: skipping params in sequence
-	:return: list of sequence filled where gap has occured
-	"""
-	i = 0
-	change_needed = False
-	look_left = 0
-	while i < len(sequence):
-		look_left -= 1
-		if change_needed and look_left < 1:
-			change_needed = False
-		if sequence[i]:
-			if change_needed:
-				for k in to_change:
-					sequence[k] = True
-			else:
-				change_needed = True
-			look_left = lookahead
-			to_change = []
-		else:
-			if change_needed:
-				to_change.append(i)
-		i += 1
-	return sequence
-
-
-def get_two_longest_timestamps(timestamps):
-
-	if len(timestamps) <= 2:
-		return timestamps
+# seconds decoded densely on both sides of every coarse boundary by the refinement
+REFINE_SECONDS = 3
+# number of vectors a compressed season index is trained on, enough for 256 centroids per product quantizer
+TRAINING_SAMPLE_SIZE = 256 * 39
+# safety margin of the head and tail windows, it bounds the length of the outros found by the head_tail extraction
+WINDOW_MARGIN_SECONDS = 120
 
-	d = {}
-	for start, end in timestamps:
-		d[(start, end)] = end - start
-
-	return max_two_values(d)
+# setup of the pool worker running this process, see init_worker
+worker_setup = None
 
 
 def to_time_string(seconds):
 	return str(datetime.timedelta(seconds=seconds))
 
 
-def query_episodes_with_faiss(videos, vectors_dir):
-
-	vector_files = [os.path.join(vectors_dir, e+'.p') for e in videos]
-	vectors = []
-	lengths = []
+def search_other_episodes(index, query, episode_id, k, max_k=None, excluded_ids=None):
+	"""
+	Searches the nearest neighbour of every query vector among the vectors of the other episodes.
+	The self-episode hits are dropped from the top-k results, the rows without any other episode hit
+	are searched again with a doubled k.
+	:param index: season index labelled with the episode ids
+	:param query: vectors of the episode with the episode_id
+	:param k: number of neighbours to search at first
+	:param max_k: largest k to search with, by default all vectors of the index
+	:param excluded_ids: ids of other episodes whose hits are dropped as well
+	:return: array of the nearest other episode distances
+	"""
+	max_k = index.ntotal if max_k is None else min(max_k, index.ntotal)
+	result = np.full(query.shape[0], np.finfo(np.float32).max, np.float32)
+	pending = np.arange(query.shape[0])
+	k = min(k, max_k)
+	while pending.size and k > 0:
+		scores, labels = index.search(query[pending], k)
+		# approximate indices mark the missing neighbours with the -1 label
+		other_episode = (labels != episode_id) & (labels >= 0)
+		if excluded_ids:
+			other_episode &= ~np.isin(labels, excluded_ids)
+		found = other_episode.any(axis=1)
+		first = other_episode.argmax(axis=1)
+		result[pending[found]] = scores[found, first[found]]
+		pending = pending[~found]
+		if k == max_k:
+			break
+		k = min(k * 2, max_k)
+	return result
+
+
+def load_season_vectors(videos, vectors_dir):
+	# memory mapped matrices, FAISS reads the float32 ones without copies
+	return [featureStore.load_vectors(vectors_dir, e) for e in videos]
+
+
+def as_float32(vectors):
+	# float16 vectors are converted one episode at a time, the season is never held in float32 at once
+	return np.asarray(vectors, np.float32)
+
+
+def training_sample(vectors, count=TRAINING_SAMPLE_SIZE, seed=0):
+	"""
+	Random rows of the season vectors to train a compressed index on.
+	:param vectors: list of the vectors of the episodes
+	:return: float32 matrix of at most count vectors
+	"""
+	sizes = np.array([len(episode_vectors) for episode_vectors in vectors])
+	rows = np.arange(sizes.sum())
+	if len(rows) > count:
+		rows = np.sort(np.random.RandomState(seed).choice(rows, count, replace=False))
+	episodes = np.searchsorted(np.cumsum(sizes), rows, side='right')
+	offsets = rows - np.concatenate(([0], np.cumsum(sizes)[:-1]))[episodes]
+	return np.vstack([as_float32(vectors[i][offsets[episodes == i]]) for i in np.unique(episodes)])
 
-	for f in vector_files:
-		episode_vectors = np.array(pickle.load(open(f, 'rb')), np.float32)
-		lengths.append(episode_vectors.shape[0])
-		vectors.append(episode_vectors)
 
-	vectors = np.vstack(vectors)
+def build_season_index(vectors, compression=None):
+	"""
+	One index for the whole season, every vector is labelled with the id of its episode.
+	:param compression: None for the exact index, otherwise the compressed vectors are searched directly,
+	see catalogIndex.compression_factory
+	"""
+	factory = catalogIndex.compression_factory(compression, vectors[0].shape[1], sum(len(v) for v in vectors))
+	index = catalogIndex.build_index(factory, vectors[0].shape[1])
+	if not index.is_trained:
+		index.train(training_sample(vectors))
+	for i, episode_vectors in enumerate(vectors):
+		index.add_with_ids(as_float32(episode_vectors), np.full(episode_vectors.shape[0], i, np.int64))
+	return index
+
+
+def query_episodes_with_faiss(videos, vectors_dir, k=16, vector_names=None, metrics=None, labels=None,
+							  compression=None):
+	metrics = metrics or instrumentation.Metrics()
+	labels = labels or videos
+
+	with metrics.stage("index"):
+		vectors = load_season_vectors(vector_names or videos, vectors_dir)
+		index = build_season_index(vectors, compression)
+	metrics.count("index_vectors", index.ntotal)
+	metrics.count("index_bytes", index.ntotal * index.sa_code_size())
 	results = []
 
-	for i, length in enumerate(lengths):
-		print(f"Querying the video file identified as {videos[i]}")
-		i += 1
-		s = sum(lengths[:i - 1])
-		e = sum(lengths[:i])
-		query = vectors[s:e]
-		rest = np.append(vectors[:s], vectors[e:], axis=0)
-		vector_size = query.shape[1]
-		index = faiss.IndexFlatL2(vector_size)
-		index.add(rest)
-		k = 1
-		scores, indexes = index.search(query, k)
-		result = scores[:, 0]
-		results.append((videos[i - 1], result))
+	for i, video in enumerate(videos):
+		print(f"Querying the video file identified as {video}")
+		with metrics.stage("query", labels[i]):
+			result = search_other_episodes(index, as_float32(vectors[i]), i, k)
+		results.append((video, result))
 	return results
 
 
-def detect(video_dir, feature_vector_function = 'CH', annotations = None, artifacts_dir = None, framejump = 3,
-		   percentile = 10, resize_width = 320, video_start_threshold_percentile = 20, video_end_threshold_seconds = 15,
-		   min_detection_size_seconds = 15):
+def query_episodes_with_catalog(videos, vectors_dir, episode_paths, catalog, k=16, max_k=1024, vector_names=None,
+								metrics=None, labels=None):
+	"""
+	Adds the season to the persistent catalog index and queries every episode against the whole catalog.
+	:param episode_paths: absolute paths of the videos, the catalog replaces the previous vectors of a path
+	:param catalog: catalogIndex.CatalogIndex
+	:param max_k: largest k to search with, approximate indices may not return enough neighbours for every row
+	:param vector_names: names of the stored vectors of the videos, the video file names by default, they key the
+	episodes in the catalog
+	:param metrics: instrumentation.Metrics the stage timers and counters are recorded into
+	:param labels: names of the videos in the metrics, the video file names by default
+	"""
+	metrics = metrics or instrumentation.Metrics()
+	labels = labels or videos
+
+	with metrics.stage("index"):
+		keys = vector_names or videos
+		vectors = load_season_vectors(keys, vectors_dir)
+		catalog.add_episodes(list(zip(episode_paths, keys, vectors)))
+		catalog.save()
+	metrics.count("index_vectors", catalog.index.ntotal)
+	metrics.count("index_bytes", os.path.getsize(catalog.index_filename))
+	results = []
 
-	if feature_vector_function == 'CNN':
-		resize_width = 224
-	print(f"Detection started...\nFramejump: {framejump}\nVideo Width: {resize_width}\nFeature Vector Type: {feature_vector_function}")
-	resized_dir_name = f"resized{resize_width}"
-	feature_vector_dir_name = f"{feature_vector_function}_feature_vectors_framejump{framejump}"
-	videos = [f for f in os.listdir(video_dir) if os.path.isfile(os.path.join(video_dir, f))]
-	videos = natsorted(videos, alg=ns.IGNORECASE)
+	for video, label, key, query in zip(videos, labels, keys, vectors):
+		print(f"Querying the video file identified as {video} in the catalog")
+		with metrics.stage("query", label):
+			result = search_other_episodes(catalog.index, as_float32(query), catalog.episode_id(key), k, max_k,
+										   catalog.stale_ids)
+		results.append((video, result))
+	return results
 
-	if artifacts_dir is None:
-		artifacts_dir = video_dir
 
-	vectors_dir = os.path.join(artifacts_dir, resized_dir_name, feature_vector_dir_name)
+def prepare_episode(file_full, file_resized, vectors_dir, vectors_name, feature_vector_function, framejump,
+					resize_width, ingestion, batch_size, video_metadata, windows=None, dtype='float32', sampling='framejump',
+					sample_fps=None, feature_threads=1, progress=True):
+	"""
+	Resizes a single episode and converts it to feature vectors, skipping every artifact which already exists.
+	Runs in the pool workers of detect, so it only takes picklable arguments, the video metadata is probed upfront.
+	:param file_resized: path of the resized video, unused by the pipe ingestion
+	:param vectors_dir: directory of the stored feature vectors
+	:param vectors_name: name of the stored feature vectors
+	:param windows: [first, end) ranges of the sampled frames to vectorize, all sampled frames by default
+	:param dtype: float32 or float16 storage of the feature vectors
+	:param sampling: 'framejump', 'keyframes' or 'fps' sampling of the frames, the last two are always piped
+	:param feature_threads: threads vectorizing the frames while they are decoded
+	:return: the processed file name and its metrics, the season scope of instrumentation.Metrics.to_dict()
+	"""
+	file = os.path.basename(file_full)
+	metrics = instrumentation.Metrics()
 
-	if annotations is not None:
-		annotations = evaluation.get_annotations(annotations)
+	if featureStore.exists(vectors_dir, vectors_name):
+		metrics.count("vectors_cached")
+		return file, metrics.season
 
-	for file in videos:
-		file_full = os.path.join(video_dir, file)
-		file_resized = os.path.join(artifacts_dir, resized_dir_name, file)
-		os.makedirs(os.path.dirname(file_resized), exist_ok=True)
+	if ingestion == 'pipe':
+		if progress:
+			print(f"Converted {file} to feature vectors")
+		featureVectorizer.construct_piped_feature_vectors(file_full, vectors_dir, feature_vector_function, framejump,
+														  resize_width, progress, batch_size, video_metadata,
+														  vectors_name, metrics, windows, dtype, sampling,
+														  sample_fps, feature_threads)
+		return file, metrics.season
 
-		if not os.path.isfile(file_resized):
-			print(f"Resizing {file}")
-			videoUtils.resize(file_full, file_resized, resize_width)
+	resize_episode(file_full, file_resized, resize_width, video_metadata, metrics, progress)
 
+	if progress:
 		print(f"Converted {file} to feature vectors")
-		featureVectorizer.construct_feature_vectors(file_resized, feature_vector_dir_name, feature_vector_function,
-													framejump)
-	results = query_episodes_with_faiss(videos, vectors_dir)
+	featureVectorizer.construct_feature_vectors(file_resized, None, feature_vector_function, framejump, progress,
+												batch_size, vectors_dir, vectors_name, metrics, windows, dtype,
+												feature_threads)
+	return file, metrics.season
+
+
+def resize_episode(file_full, file_resized, resize_width, video_metadata, metrics, progress=True):
+	"""
+	Creates the resized copy of an episode unless it exists.
+	"""
+	if os.path.isfile(file_resized):
+		return
+	os.makedirs(os.path.dirname(file_resized), exist_ok=True)
+	if progress:
+		print(f"Resizing {os.path.basename(file_full)}")
+	with metrics.stage("resize"):
+		videoUtils.resize(file_full, file_resized, resize_width, quiet=not progress, metadata=video_metadata)
+	metrics.count("bytes_read", os.path.getsize(file_full))
+
+
+def prefetch_resize(task):
+	"""
+	Resizes the episode of a prepare_episode task ahead of it, nothing is resized for the piped or cached episodes.
+	:return: the metrics of the resize, the season scope of instrumentation.Metrics.to_dict()
+	"""
+	file_full, file_resized, vectors_dir, vectors_name = task[:4]
+	resize_width, ingestion, video_metadata = task[6], task[7], task[9]
+	metrics = instrumentation.Metrics()
+	if ingestion == 'resize' and not featureStore.exists(vectors_dir, vectors_name):
+		resize_episode(file_full, file_resized, resize_width, video_metadata, metrics, progress=False)
+	return metrics.season
+
+
+def iter_prepared_episodes(tasks):
+	"""
+	Prepares the episodes one after another in this process, the resize of the next episode runs in a background
+	ffmpeg while the current one is vectorized.
+	:return: generator of the processed file names and their metrics, see prepare_episode
+	"""
+	with ThreadPoolExecutor(max_workers=1) as resizer:
+		resized = [resizer.submit(prefetch_resize, task) for task in tasks[:1]]
+		for i, task in enumerate(tasks):
+			resize_metrics = resized[i].result()
+			if i + 1 < len(tasks):
+				resized.append(resizer.submit(prefetch_resize, tasks[i + 1]))
+			file, episode_metrics = prepare_episode(*task)
+			metrics = instrumentation.Metrics()
+			metrics.merge_episode(None, resize_metrics)
+			metrics.merge_episode(None, episode_metrics)
+			yield file, metrics.season
+
+
+def get_detection_windows(extraction, video_start_threshold_percentile, video_end_threshold_seconds,
+						  window_margin_seconds):
+	if extraction == 'full':
+		return None
+	if extraction == 'head_tail':
+		return video_start_threshold_percentile, video_end_threshold_seconds, window_margin_seconds
+	raise Exception(f"Unknown extraction mode {extraction}, use 'full' or 'head_tail'")
+
+
+def get_worker_setup(feature_vector_function):
+	"""
+	:return: arguments of init_worker setting up the pool workers like this process, the workers which are not forked
+	do not inherit the frozen CNN model configured in it
+	"""
+	return feature_vector_function, frozen.settings(), featureVectorizer.get_backend(feature_vector_function)
+
+
+def init_worker(feature_vector_function, rmac_settings, backend):
+	"""
+	Sets up a pool worker, configures the frozen CNN model and loads the model of the method once per worker instead
+	of once per episode or season.
+	:param rmac_settings: configuration of the frozen CNN model, see rmac.frozen.settings
+	:param backend: backend of the method in the parent process, the vectors of the workers are keyed by it
+	"""
+	global worker_setup
+	if worker_setup == (feature_vector_function, rmac_settings, backend):
+		return
+	frozen.configure(*rmac_settings)
+	worker_backend = featureVectorizer.get_backend(feature_vector_function)
+	if worker_backend != backend:
+		raise Exception(f"The pool worker runs the {worker_backend} backend of {feature_vector_function} instead of "
+						f"the {backend} one of the parent process")
+	featureVectorizer.load_model(feature_vector_function)
+	worker_setup = (feature_vector_function, rmac_settings, backend)
+
+
+def run_in_worker(setup, function, *args, **kwargs):
+	"""
+	Runs a task in a pool worker set up by init_worker, the first task of every worker sets it up as the initializer
+	of ProcessPoolExecutor needs Python 3.7.
+	:param setup: arguments of init_worker, see get_worker_setup
+	"""
+	init_worker(*setup)
+	return function(*args, **kwargs)
+
+
+def list_videos(video_dir):
+	"""
+	:return: the naturally sorted video files of the season directory
+	"""
+	# the hidden files are the temporary outputs of the artifacts when they are kept in the video dir
+	videos = [f for f in os.listdir(video_dir) if os.path.isfile(os.path.join(video_dir, f)) and not f.startswith('.')]
+	return natsorted(videos, alg=ns.IGNORECASE)
+
+
+def plan_season(video_dir, feature_vector_function, artifacts_dir, cache, framejump, resize_width, ingestion,
+				batch_size, metrics, detection_windows=None, compression=None, sampling='framejump', sample_fps=None,
+				feature_threads=1):
+	"""
+	Lists the videos of a season and addresses their artifacts in the cache, the artifacts of the layout before the
+	cache are adopted into it, see adopt_legacy_artifacts.
+	:param cache: artifactCache.ArtifactCache of the artifacts_dir
+	:param detection_windows: (video_start_threshold_percentile, video_end_threshold_seconds, margin_seconds) to
+	vectorize only the head and the tail of the episodes, see segments.detection_windows, all frames when None
+	:param compression: compression of the stored vectors and of the season index, see catalogIndex.compression_factory
+	:param sampling: 'framejump', 'keyframes' or 'fps' sampling of the frames, see videoUtils.SAMPLING_MODES,
+	the keyframes and fps sampling decode the original videos through ffmpeg like the pipe ingestion
+	:return: season dictionary with the videos, their metadata, artifact keys, the parameters of the vectors besides
+	their source and the prepare_episode tasks
+	"""
+	if sampling not in videoUtils.SAMPLING_MODES:
+		raise Exception(f"Unknown sampling mode {sampling}, use one of {', '.join(videoUtils.SAMPLING_MODES)}")
+	if sampling != 'framejump':
+		if detection_windows is not None:
+			raise Exception(f"The {sampling} sampling vectorizes whole episodes, use the full extraction")
+		# the keyframes of a resized copy are not the ones of the original video
+		ingestion = 'pipe'
+	videos = list_videos(video_dir)
+
+	video_files = [os.path.join(video_dir, file) for file in videos]
+	with metrics.stage("probe"):
+		videos_metadata = videoMetadata.get_videos_metadata(video_files, artifacts_dir)
+
+	# artifacts are addressed by the source content and every parameter they are built with, so a replaced
+	# source file or other settings never reuse stale artifacts
+	with metrics.stage("fingerprint"):
+		fingerprints = [artifactCache.fingerprint(video_file) for video_file in video_files]
+	resized_keys = [artifactCache.artifact_key('resized', f, resize_width=resize_width) for f in fingerprints]
+	# the windows, dtype and sampling only take part in the keys when they differ from the defaults, so full float32
+	# framejump extractions keep the keys they were cached with, the backend only for the methods which have one
+	extra_params = {} if detection_windows is None else {"detection_windows": list(detection_windows)}
+	dtype = catalogIndex.storage_dtype(compression)
+	if dtype != 'float32':
+		extra_params["dtype"] = dtype
+	if sampling != 'framejump':
+		extra_params["sampling"] = sampling
+		extra_params["sample_fps"] = sample_fps if sampling == 'fps' else None
+	backend = featureVectorizer.get_backend(feature_vector_function)
+	if backend is not None:
+		extra_params["backend"] = backend
+	vector_params = dict(method=feature_vector_function, framejump=framejump, resize_width=resize_width,
+						 ingestion=ingestion, **extra_params)
+	vector_keys = [artifactCache.artifact_key('vectors', f, **vector_params) for f in fingerprints]
+	resized_files = [cache.path('resized', key, os.path.splitext(file)[1]) for key, file in zip(resized_keys, videos)]
+	vectors_dir = cache.kind_dir('vectors')
+
+	windows = [None] * len(videos)
+	window_share = None
+	if detection_windows is not None:
+		samples = [featureVectorizer.count_sampled_frames(videos_metadata[video_file]["frame_count"], framejump)
+				   for video_file in video_files]
+		windows = [segments.detection_windows(video_samples, videos_metadata[video_file]["fps"] / framejump,
+											  *detection_windows)
+				   for video_samples, video_file in zip(samples, video_files)]
+		# share of the sampled frames of the season which are vectorized
+		window_share = sum(end - first for video_windows in windows for first, end in video_windows)
+		window_share /= max(sum(samples), 1)
+
+	tasks = [(video_file, resized_file, vectors_dir, vector_key, feature_vector_function, framejump, resize_width,
+			  ingestion, batch_size, videos_metadata[video_file], video_windows, dtype, sampling, sample_fps,
+			  feature_threads)
+			 for video_file, resized_file, vector_key, video_windows
+			 in zip(video_files, resized_files, vector_keys, windows)]
+	season = {"video_dir": video_dir, "videos": videos, "videos_metadata": videos_metadata,
+			  "resized_keys": resized_keys, "resized_files": resized_files, "vector_keys": vector_keys,
+			  "vector_params": vector_params, "vectors_dir": vectors_dir, "tasks": tasks,
+			  "feature_vector_function": feature_vector_function, "resize_width": resize_width, "ingestion": ingestion,
+			  "batch_size": batch_size, "compression": compression, "window_share": window_share}
+	with metrics.stage("adopt_legacy"):
+		adopt_legacy_artifacts(season, artifacts_dir)
+	return season
+
+
+def is_newer(filename, source_file):
+	return os.path.isfile(filename) and os.path.getmtime(filename) >= os.path.getmtime(source_file)
+
+
+def adopt_legacy_artifacts(season, artifacts_dir):
+	"""
+	Copies the artifacts of the layout before the cache into it under the keys of the season, so an upgraded artifacts
+	dir is not extracted again: the resized videos of artifacts_dir/resized{width}/ and the pickled or migrated
+	vectors of its {method}_feature_vectors_framejump{framejump}/ subdirectory, see featureStore.migrate. That layout
+	only held full float32 extractions of the resized videos, by the keras model for the CNN method. The legacy files
+	older than their source video are stale and skipped, the legacy files are kept.
+	"""
+	params = season["vector_params"]
+	if (set(params) - {"method", "framejump", "resize_width", "ingestion", "backend"} or params["ingestion"] != 'resize'
+			or params.get("backend", 'keras') != 'keras'):
+		return
+	resized_dir = os.path.join(artifacts_dir, f"resized{params['resize_width']}")
+	if not os.path.isdir(resized_dir):
+		return
+	legacy_dir = os.path.join(resized_dir, f"{params['method']}_feature_vectors_framejump{params['framejump']}")
+
+	for video, resized_file, vector_key in zip(season["videos"], season["resized_files"], season["vector_keys"]):
+		video_file = os.path.join(season["video_dir"], video)
+		legacy_resized = os.path.join(resized_dir, video)
+		if not os.path.isfile(resized_file) and is_newer(legacy_resized, video_file):
+			os.makedirs(os.path.dirname(resized_file), exist_ok=True)
+			fileUtils.link_or_copy(legacy_resized, resized_file)
+
+		legacy_files = [f for f in (featureStore.vectors_filename(legacy_dir, video),
+									featureStore.legacy_filename(legacy_dir, video)) if os.path.isfile(f)]
+		if (featureStore.exists(season["vectors_dir"], vector_key) or not legacy_files
+				or not all(is_newer(f, video_file) for f in legacy_files)):
+			continue
+		print(f"Adopting the legacy feature vectors of {video}")
+		metadata = featureVectorizer.get_vectors_metadata(season["videos_metadata"][video_file]["fps"], video_file,
+														  params["method"], params["framejump"])
+		featureStore.adopt_legacy_vectors(legacy_dir, video, season["vectors_dir"], vector_key, metadata)
+
+
+def refine_season(season, detections, thresholds, refine_seconds, metrics, labels):
+	"""
+	Second pass of the coarse to fine detection. Every frame within refine_seconds of a coarse boundary is vectorized
+	and matched against the coarse vectors and the dense boundary vectors of the other episodes, then the boundaries
+	snap to the first and the last matching frame of their segment, with the coarse distance threshold and the gap
+	filling of detect_segments.
+	:param detections: coarse (start, end) seconds of the segments of every episode
+	:param thresholds: distance threshold of every episode of the coarse pass
+	:return: refined (start, end) seconds of the segments of every episode
+	"""
+	dense = []
+	for label, video, detected in zip(labels, season["videos"], detections):
+		video_file = os.path.join(season["video_dir"], video)
+		video_metadata = season["videos_metadata"][video_file]
+		if season["ingestion"] == 'resize':
+			video_file = season["resized_files"][season["videos"].index(video)]
+		windows = segments.boundary_windows(detected, video_metadata["fps"], video_metadata["frame_count"],
+											refine_seconds)
+		with metrics.stage("refine_extract", label):
+			dense_vectors = featureVectorizer.vectorize_frame_windows(
+				video_file, [window for pair in windows for window in pair], season["feature_vector_function"],
+				season["resize_width"], season["ingestion"], video_metadata, season["batch_size"]
+			)
+		metrics.count("refine_frames", len(dense_vectors), label)
+		dense.append((windows, dense_vectors))
+
+	# the coarse thresholds are compressed distances when the season index is compressed, the dense vectors
+	# are matched in the same space
+	index = build_season_index(load_season_vectors(season["vector_keys"], season["vectors_dir"]),
+							   season["compression"])
+	for i, (_, dense_vectors) in enumerate(dense):
+		if len(dense_vectors):
+			index.add_with_ids(dense_vectors, np.full(dense_vectors.shape[0], i, np.int64))
+
+	refined_detections = []
+	for i, (video, detected, threshold, (windows, dense_vectors)) in enumerate(
+			zip(season["videos"], detections, thresholds, dense)):
+		fps = season["videos_metadata"][os.path.join(season["video_dir"], video)]["fps"]
+		distances = search_other_episodes(index, dense_vectors, i, 16) if len(dense_vectors) else dense_vectors
+		refined = []
+		offset = 0
+		for (start, end), (start_window, end_window) in zip(detected, windows):
+			length = start_window[1] - start_window[0] + end_window[1] - end_window[0]
+			start_frame = end_frame = None
+			# a decoding ending early leaves the last windows without vectors, their boundaries are kept
+			if offset + length <= len(distances):
+				start_frame, end_frame = segments.snap_boundaries(
+					distances[offset:offset + length], threshold, start_window, end_window,
+					int(fps * segments.LOOKAHEAD_SECONDS)
+				)
+			refined.append((start if start_frame is None else start_frame / fps,
+							end if end_frame is None else end_frame / fps))
+			offset += length
+		refined_detections.append(refined)
+	return refined_detections
+
+
+def check_catalog(catalog_dir, compression):
+	if catalog_dir is not None and compression is not None:
+		# the catalog index is compressed by its own factory, the compression only applies to the season index
+		raise Exception(f"The compression {compression} can not be used with a catalog, compress the catalog index "
+						f"with its factory instead, e.g. IVF1024,PQ32")
+
+
+def open_catalog(catalog_dir, catalog_factory, catalog_search_params, vector_params):
+	"""
+	:param vector_params: parameters of the vectors of the season, see plan_season, the vectors of every feature
+	method and parameters are kept in their own catalog under catalog_dir
+	:return: catalogIndex.CatalogIndex of the season or None to match the seasons on their own
+	"""
+	if catalog_dir is None:
+		return None
+	directory = os.path.join(catalog_dir, artifactCache.artifact_key('catalog', None, **vector_params))
+	return catalogIndex.CatalogIndex(directory, catalog_factory, catalog_search_params)
+
+
+def prepare_season(season, feature_vector_function, workers, metrics, cache=None):
+	"""
+	Runs the tasks of plan_season, in a pool of workers processes when there is more than one.
+	:param cache: artifactCache.ArtifactCache every prepared episode is registered into, see register_episode
+	"""
+	with metrics.stage("prepare"):
+		if workers > 1:
+			setup = get_worker_setup(feature_vector_function)
+			with ProcessPoolExecutor(max_workers=workers) as pool:
+				futures = [pool.submit(run_in_worker, setup, prepare_episode, *task, progress=False)
+						   for task in season["tasks"]]
+				for future in tqdm(as_completed(futures), total=len(futures), desc="Season", unit="episode"):
+					file, episode_metrics = future.result()
+					metrics.merge_episode(file, episode_metrics)
+					register_episode(season, cache, file)
+					tqdm.write(f"Converted {file} to feature vectors")
+		else:
+			for file, episode_metrics in iter_prepared_episodes(season["tasks"]):
+				metrics.merge_episode(file, episode_metrics)
+				register_episode(season, cache, file)
+
+
+def query_season(season, cache, catalog, metrics, labels):
+	"""
+	Registers the prepared artifacts of a season and queries the nearest other episode of every sampled frame.
+	:param catalog: catalogIndex.CatalogIndex or None to match the season on its own
+	:return: list of the distances of every sampled frame of the episodes, NaN for the frames outside the detection
+	windows, list of the framerates of the episodes and list of the presentation times of the sampled frames
+	followed by the duration of every episode, see segments.detect_segments, None for vectors stored without them
+	"""
+	videos = season["videos"]
+	video_dir = season["video_dir"]
+	vector_keys = season["vector_keys"]
+	vectors_dir = season["vectors_dir"]
+	register_season(season, cache)
+
+	if catalog is None:
+		results = query_episodes_with_faiss(videos, vectors_dir, vector_names=vector_keys, metrics=metrics,
+											labels=labels, compression=season["compression"])
+	else:
+		episode_paths = [os.path.abspath(os.path.join(video_dir, video)) for video in videos]
+		results = query_episodes_with_catalog(videos, vectors_dir, episode_paths, catalog, vector_names=vector_keys,
+											  metrics=metrics, labels=labels)
+	distances = []
+	framerates = []
+	sample_times = []
+
+	for i, (video, result) in enumerate(results):
+		result, framerate, episode_times = episode_distances(season, i, result)
+		distances.append(result)
+		framerates.append(framerate)
+		sample_times.append(episode_times)
+	return distances, framerates, sample_times
+
+
+def register_episode(season, cache, video, save=True):
+	"""
+	Records the access of the prepared artifacts of an episode for the eviction, as soon as they are prepared so a
+	crashed run leaves no unregistered artifacts behind.
+	:param video: file name of the episode in the season
+	:param save: saves the manifest of the cache, once per episode
+	"""
+	if cache is None:
+		return
+	i = season["videos"].index(video)
+	vector_key = season["vector_keys"][i]
+	cache.register('resized', season["resized_keys"][i], [season["resized_files"][i]])
+	cache.register('vectors', vector_key, [featureStore.vectors_filename(season["vectors_dir"], vector_key),
+										   featureStore.metadata_filename(season["vectors_dir"], vector_key)])
+	if save:
+		cache.save()
+
+
+def register_season(season, cache):
+	# the manifest is saved once for the whole season
+	if cache is None:
+		return
+	for video in season["videos"]:
+		register_episode(season, cache, video, save=False)
+	cache.save()
+
+
+def episode_distances(season, i, result):
+	"""
+	Places the queried distances of the i-th episode of the season in the episode, see query_season.
+	:param result: nearest other episode distances of the stored vectors of the episode
+	:return: distances of every sampled frame, framerate and sample times of the episode
+	"""
+	vector_key = season["vector_keys"][i]
+	framerate = season["videos_metadata"][os.path.join(season["video_dir"], season["videos"][i])]["fps"]
+	vectors_metadata = featureStore.load_metadata(season["vectors_dir"], vector_key)
+	if "windows" in vectors_metadata:
+		result = segments.expand_windows(result, vectors_metadata["windows"], vectors_metadata["samples"])
+	sample_times = None
+	if "timestamps" in vectors_metadata:
+		sample_times = np.append(vectors_metadata["timestamps"], vectors_metadata["duration"])
+	return result, framerate, sample_times
+
+
+def match_season(season, cache, framejump, percentile, video_start_threshold_percentile, video_end_threshold_seconds,
+				 min_detection_size_seconds, annotations, catalog, metrics, labels=None, refine_seconds=None):
+	"""
+	Registers the prepared artifacts of a season, matches its episodes and detects their intros and outros.
+	:param season: dictionary of plan_season whose tasks were all prepared
+	:param annotations: annotations dataframe of evaluation.get_annotations or None
+	:param catalog: catalogIndex.CatalogIndex or None to match the season on its own
+	:param labels: names of the episodes in the metrics, the video file names by default
+	:param refine_seconds: seconds around the boundaries refined by refine_season, no refinement when None
+	:return: dictionary of the detected (start, end) seconds per video file
+	"""
+	videos = season["videos"]
+	labels = labels or videos
+	if season["window_share"] is not None:
+		# the threshold of a full extraction is taken over whole episodes, of whose frames the windows hold a share
+		print(f"The percentile threshold is taken over the {season['window_share']:.0%} of the sampled frames in the "
+			  f"head and tail windows, the full extraction with --percentile {percentile:g} corresponds to about "
+			  f"--percentile {min(100, percentile / max(season['window_share'], 1e-9)):.3g} of the head_tail one")
+	distances, framerates, sample_times = query_season(season, cache, catalog, metrics, labels)
+	detections = []
+	thresholds = []
+
+	for label, result, framerate, episode_times in zip(labels, distances, framerates, sample_times):
+		with metrics.stage("post_processing", label):
+			detected_beginning, detected_end = segments.detect_segments(
+				result, framerate, framejump, percentile, video_start_threshold_percentile,
+				video_end_threshold_seconds, min_detection_size_seconds, sample_times=episode_times
+			)
+			detections.append(segments.longest_segments(detected_beginning) + detected_end)
+		thresholds.append(segments.distance_threshold(result, percentile))
+
+	if refine_seconds is not None:
+		detections = refine_season(season, detections, thresholds, refine_seconds, metrics, labels)
+
 	total_relevant_sec = 0
 	total_detected_sec = 0
 	total_relevant_detected_sec = 0
 	all_detected = {}
 
-	for video, result in results:
-		framerate = videoUtils.get_framerate(os.path.join(video_dir, video))
-		threshold = np.percentile(result, percentile)
-		below_threshold = result < threshold
-		below_threshold = fill_gaps(below_threshold, int((framerate / framejump) * 10))
-		nonzeros = [[i for i, v in it] for k, it in itertools.groupby(enumerate(below_threshold),
-																	  key=operator.itemgetter(1))
-					if k != 0]
-		detected_beginning = []
-		detected_end = []
-
-		for nonzero in nonzeros:
-			start = nonzero[0]
-			end = nonzero[-1]
-			occurs_at_beggining = end < len(result) * (video_start_threshold_percentile/100)
-			ends_at_the_end = end  > len(result) - video_end_threshold_seconds * (framerate/framejump)
-
-			if (end - start > (min_detection_size_seconds * (framerate/framejump))
-				and (occurs_at_beggining or ends_at_the_end)):
-				start = start/(framerate/framejump)
-				end = end / (framerate/framejump)
-				if occurs_at_beggining:
-					detected_beginning.append((start, end))
-				elif ends_at_the_end:
-					detected_end.append((start, end))
-
-		detected = get_two_longest_timestamps(detected_beginning) + detected_end
-
+	for video, detected in zip(videos, detections):
 		print(f"Detection for {video}")
 
 		for s, e in detected:
@@ -183,4 +650,161 @@ def detect(video_dir, feature_vector_function = 'CH', annotations = None, artifa
 		precision = total_relevant_detected_sec / total_detected_sec
 		recall = total_relevant_detected_sec / total_relevant_sec
 		print(f"Precision: {precision} ----- Recall: {recall}")
+
+	return all_detected
+
+
+def detect(video_dir, feature_vector_function = 'CH', annotations = None, artifacts_dir = None, framejump = 3,
+		   percentile = 10, resize_width = 320, video_start_threshold_percentile = 20, video_end_threshold_seconds = 15,
+		   min_detection_size_seconds = 15, ingestion = 'resize', workers = 1,
+		   batch_size = featureVectorizer.BATCH_SIZE, catalog_dir = None, catalog_factory = catalogIndex.DEFAULT_FACTORY,
+		   catalog_search_params = None, cache_max_bytes = None, metrics = None, extraction = 'full',
+		   window_margin_seconds = WINDOW_MARGIN_SECONDS, refine = False, refine_seconds = REFINE_SECONDS,
+		   compression = None, sampling = 'framejump', sample_fps = 1, feature_threads = 1):
+	"""
+	Detects the intros and outros of every video of the season.
+	:param metrics: instrumentation.Metrics the per-stage timers and counters of the run are recorded into
+	:param extraction: 'full' vectorizes every sampled frame, 'head_tail' only the frames of the windows
+	detect_segments can report, widened by window_margin_seconds, the percentile is then taken over those frames only
+	:param refine: refines the boundaries found at framejump by matching every frame within refine_seconds of them
+	:param compression: 'float16', 'pca<dimension>' or 'pq<subquantizers>' compression of the feature vectors,
+	see catalogIndex.compression_factory
+	:param sampling: 'framejump' samples every framejump-th frame, 'keyframes' decodes only the keyframes and 'fps'
+	sample_fps frames per second, the frames are then placed at their presentation times
+	:param feature_threads: threads of every worker vectorizing the frames while a decoding thread decodes the next
+	ones, see featureVectorizer.iter_vector_batches
+	:return: dictionary of the detected (start, end) seconds per video file
+	"""
+	metrics = metrics or instrumentation.Metrics()
+
+	if feature_vector_function == 'CNN':
+		resize_width = 224
+	print(f"Detection started...\nFramejump: {framejump}\nVideo Width: {resize_width}\nFeature Vector Type: {feature_vector_function}")
+	if ingestion not in ('resize', 'pipe'):
+		raise Exception(f"Unknown ingestion mode {ingestion}, use 'resize' or 'pipe'")
+	detection_windows = get_detection_windows(extraction, video_start_threshold_percentile,
+											  video_end_threshold_seconds, window_margin_seconds)
+
+	check_catalog(catalog_dir, compression)
+
+	if artifacts_dir is None:
+		artifacts_dir = video_dir
+
+	if annotations is not None:
+		annotations = evaluation.get_annotations(annotations)
+
+	cache = artifactCache.ArtifactCache(artifacts_dir, cache_max_bytes)
+	season = plan_season(video_dir, feature_vector_function, artifacts_dir, cache, framejump, resize_width, ingestion,
+						 batch_size, metrics, detection_windows, compression, sampling, sample_fps, feature_threads)
+
+	prepare_season(season, feature_vector_function, workers, metrics, cache)
+
+	catalog = open_catalog(catalog_dir, catalog_factory, catalog_search_params, season["vector_params"])
+	all_detected = match_season(season, cache, framejump, percentile, video_start_threshold_percentile,
+								video_end_threshold_seconds, min_detection_size_seconds, annotations, catalog, metrics,
+								refine_seconds=refine_seconds if refine else None)
+
+	with metrics.stage("evict"):
+		cache.evict(protected=set(season["vector_keys"]))
 	return all_detected
+
+
+def find_seasons(library_dir):
+	"""
+	:return: the subdirectories of library_dir which contain videos, one season each
+	"""
+	seasons = []
+	for name in natsorted(os.listdir(library_dir), alg=ns.IGNORECASE):
+		season_dir = os.path.join(library_dir, name)
+		if os.path.isdir(season_dir) and list_videos(season_dir):
+			seasons.append(season_dir)
+	return seasons
+
+
+def detect_library(season_dirs, feature_vector_function = 'CH', annotations = None, artifacts_dir = './artifacts/',
+				   framejump = 3, percentile = 10, resize_width = 320, video_start_threshold_percentile = 20,
+				   video_end_threshold_seconds = 15, min_detection_size_seconds = 15, ingestion = 'resize',
+				   workers = 1, batch_size = featureVectorizer.BATCH_SIZE, catalog_dir = None,
+				   catalog_factory = catalogIndex.DEFAULT_FACTORY, catalog_search_params = None,
+				   cache_max_bytes = None, metrics = None, extraction = 'full',
+				   window_margin_seconds = WINDOW_MARGIN_SECONDS, refine = False, refine_seconds = REFINE_SECONDS,
+				   compression = None, sampling = 'framejump', sample_fps = 1, feature_threads = 1):
+	"""
+	Detects the intros and outros of many seasons in one run. The episodes of all seasons are prepared by one shared
+	pool of workers, each loading the model once, and every season is matched on its own as soon as all its episodes
+	are prepared. The artifacts of all seasons share the cache of artifacts_dir.
+	:param season_dirs: video directories of the seasons, see find_seasons
+	:param metrics: instrumentation.Metrics, the episodes are recorded by their video paths
+	:return: dictionary of the detect results per season directory
+	"""
+	metrics = metrics or instrumentation.Metrics()
+
+	if feature_vector_function == 'CNN':
+		resize_width = 224
+	print(f"Library detection started...\nSeasons: {len(season_dirs)}\nFramejump: {framejump}\nVideo Width: {resize_width}\nFeature Vector Type: {feature_vector_function}")
+	if ingestion not in ('resize', 'pipe'):
+		raise Exception(f"Unknown ingestion mode {ingestion}, use 'resize' or 'pipe'")
+	detection_windows = get_detection_windows(extraction, video_start_threshold_percentile,
+											  video_end_threshold_seconds, window_margin_seconds)
+
+	check_catalog(catalog_dir, compression)
+
+	if annotations is not None:
+		annotations = evaluation.get_annotations(annotations)
+
+	matched_dirs = []
+	for season_dir in season_dirs:
+		if len(list_videos(season_dir)) < 2:
+			# the episodes are matched against the other episodes of their season
+			print(f"Skipping the season {season_dir}, it has fewer than two episodes")
+		else:
+			matched_dirs.append(season_dir)
+	season_dirs = matched_dirs
+
+	cache = artifactCache.ArtifactCache(artifacts_dir, cache_max_bytes)
+	seasons = [plan_season(season_dir, feature_vector_function, artifacts_dir, cache, framejump, resize_width,
+						   ingestion, batch_size, metrics, detection_windows, compression, sampling, sample_fps,
+						   feature_threads)
+			   for season_dir in season_dirs]
+	# the seasons of a run share the parameters of their vectors and so their catalog
+	catalog = None
+	if seasons:
+		catalog = open_catalog(catalog_dir, catalog_factory, catalog_search_params, seasons[0]["vector_params"])
+	results = {}
+
+	def match(season_index):
+		season = seasons[season_index]
+		print(f"Matching the season {season['video_dir']}")
+		labels = [os.path.join(season["video_dir"], video) for video in season["videos"]]
+		results[season["video_dir"]] = match_season(
+			season, cache, framejump, percentile, video_start_threshold_percentile, video_end_threshold_seconds,
+			min_detection_size_seconds, annotations, catalog, metrics, labels, refine_seconds if refine else None
+		)
+
+	with metrics.stage("prepare_and_match"):
+		if workers > 1:
+			pending = [len(season["tasks"]) for season in seasons]
+			setup = get_worker_setup(feature_vector_function)
+			with ProcessPoolExecutor(max_workers=workers) as pool:
+				futures = {pool.submit(run_in_worker, setup, prepare_episode, *task, progress=False): i
+						   for i, season in enumerate(seasons) for task in season["tasks"]}
+				for future in tqdm(as_completed(futures), total=len(futures), desc="Library", unit="episode"):
+					file, episode_metrics = future.result()
+					season_index = futures[future]
+					metrics.merge_episode(os.path.join(seasons[season_index]["video_dir"], file), episode_metrics)
+					register_episode(seasons[season_index], cache, file)
+					tqdm.write(f"Converted {file} to feature vectors")
+					pending[season_index] -= 1
+					if pending[season_index] == 0:
+						# the finished season is matched while the workers keep preparing the others
+						match(season_index)
+		else:
+			for i, season in enumerate(seasons):
+				for file, episode_metrics in iter_prepared_episodes(season["tasks"]):
+					metrics.merge_episode(os.path.join(season["video_dir"], file), episode_metrics)
+					register_episode(season, cache, file)
+				match(i)
+
+	with metrics.stage("evict"):
+		cache.evict(protected={key for season in seasons for key in season["vector_keys"]})
+	return {season["video_dir"]: results[season["video_dir"]] for season in seasons}
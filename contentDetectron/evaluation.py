@@ -1,5 +1,4 @@
 import os
-import pandas as pd
 import math
 
 
@@ -95,6 +94,8 @@ def skip_timestamps_in_file(filename, df):
 
 
 def get_annotations(filename):
+	# pandas is only needed to evaluate against annotations, so it is not imported by every detection
+	import pandas as pd
 	annotations = pd.read_csv(filename).dropna(how="all")
 	# the beauty building :)
 	annotations["recap_start"] = annotations["recap_start"].apply(convert_to_sec)
@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import pickle
+import tempfile
+import numpy as np
+from . import fileUtils
+
+
+VECTORS_EXTENSION = ".npy"
+METADATA_EXTENSION = ".json"
+LEGACY_EXTENSION = ".p"
+# size of the .npy header written by VectorWriter, a multiple of 64 as the format recommends
+HEADER_BYTES = 128
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# the feature vectors dirs are named {method}_feature_vectors_framejump{framejump}
+VECTORS_DIR_PATTERN = re.compile(r"(?P<method>.+)_feature_vectors_framejump(?P<framejump>\d+)$")
+
+
+def vectors_filename(vectors_dir, video):
+	return os.path.join(vectors_dir, video + VECTORS_EXTENSION)
+
+
+def metadata_filename(vectors_dir, video):
+	return os.path.join(vectors_dir, video + METADATA_EXTENSION)
+
+
+def legacy_filename(vectors_dir, video):
+	return os.path.join(vectors_dir, video + LEGACY_EXTENSION)
+
+
+def exists(vectors_dir, video):
+	return os.path.isfile(vectors_filename(vectors_dir, video)) or os.path.isfile(legacy_filename(vectors_dir, video))
+
+
+def list_videos(vectors_dir):
+	videos = set()
+	for f in os.listdir(vectors_dir):
+		for extension in (VECTORS_EXTENSION, LEGACY_EXTENSION):
+			if f.endswith(extension) and not f.startswith('.'):
+				videos.add(f[:-len(extension)])
+	return sorted(videos)
+
+
+def save_vectors(vectors_dir, video, vectors, metadata, dtype=np.float32):
+	"""
+	Stores the feature vectors of a video as one contiguous .npy matrix with a json metadata sidecar.
+	:param vectors: (frames, dimension) feature vectors
+	:param metadata: dict with fps, framejump, method and source of the vectors
+	:param dtype: float32 or float16 to store the vectors in half the space
+	"""
+	os.makedirs(vectors_dir, exist_ok=True)
+	vectors = np.ascontiguousarray(vectors, dtype)
+	metadata = dict(metadata, frames=int(vectors.shape[0]), dimension=int(vectors.shape[1]) if vectors.ndim > 1 else 0,
+					dtype=vectors.dtype.name)
+	with fileUtils.atomic_output(metadata_filename(vectors_dir, video)) as tmp_filename:
+		with open(tmp_filename, 'w') as outfile:
+			json.dump(metadata, outfile)
+	# the vectors are renamed into place last, their presence marks the complete artifact
+	with fileUtils.atomic_output(vectors_filename(vectors_dir, video)) as tmp_filename:
+		np.save(tmp_filename, vectors)
+
+
+class VectorWriter:
+	"""
+	Streams the feature vectors of a video into its .npy file batch by batch, so the vectors of a whole episode are
+	never held in memory. The header is rewritten with the final shape on close, then the metadata sidecar and the
+	vectors are renamed into place like save_vectors does. An exception inside the with block discards the file.
+	:param dtype: float32 or float16 to store the vectors in half the space
+	"""
+
+	def __init__(self, vectors_dir, video, dtype=np.float32):
+		os.makedirs(vectors_dir, exist_ok=True)
+		self.vectors_dir = vectors_dir
+		self.video = video
+		self.dtype = np.dtype(dtype)
+		self.frames = 0
+		self.dimension = None
+		# unique per writer like fileUtils.atomic_output, the threads of a process may write the same video
+		fd, self.tmp_filename = tempfile.mkstemp(prefix=f".{video}.", suffix=VECTORS_EXTENSION, dir=vectors_dir)
+		self.outfile = os.fdopen(fd, 'wb')
+		# room for the header of any shape, rewritten on close
+		self.outfile.write(b' ' * HEADER_BYTES)
+
+	def write(self, vectors):
+		vectors = np.ascontiguousarray(vectors, self.dtype)
+		if not len(vectors):
+			return
+		if self.dimension is None:
+			self.dimension = vectors.shape[1]
+		self.outfile.write(vectors.tobytes())
+		self.frames += len(vectors)
+
+	def close(self, metadata):
+		"""
+		:param metadata: dict with fps, framejump, method and source of the vectors
+		"""
+		shape = (self.frames,) if self.dimension is None else (self.frames, self.dimension)
+		self.outfile.seek(0)
+		self.outfile.write(npy_header(self.dtype, shape))
+		self.outfile.close()
+		metadata = dict(metadata, frames=self.frames, dimension=self.dimension or 0, dtype=self.dtype.name)
+		with fileUtils.atomic_output(metadata_filename(self.vectors_dir, self.video)) as tmp_filename:
+			with open(tmp_filename, 'w') as outfile:
+				json.dump(metadata, outfile)
+		os.replace(self.tmp_filename, vectors_filename(self.vectors_dir, self.video))
+
+	def abort(self):
+		self.outfile.close()
+		if os.path.exists(self.tmp_filename):
+			os.remove(self.tmp_filename)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is not None or not self.outfile.closed:
+			self.abort()
+
+
+def npy_header(dtype, shape):
+	# version 1.0 .npy header padded with spaces to HEADER_BYTES, numpy.load ignores the padding
+	description = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+	header = description.encode('latin1').ljust(HEADER_BYTES - len(NPY_MAGIC) - 2 - 1) + b'\n'
+	return NPY_MAGIC + len(header).to_bytes(2, 'little') + header
+
+
+def load_metadata(vectors_dir, video):
+	with open(metadata_filename(vectors_dir, video)) as infile:
+		return json.load(infile)
+
+
+def load_vectors(vectors_dir, video):
+	"""
+	Memory maps the float32 feature vectors of a video, a pickled legacy artifact is migrated first.
+	:return: read-only (frames, dimension) float32 matrix
+	"""
+	if not os.path.isfile(vectors_filename(vectors_dir, video)):
+		migrate_vectors(vectors_dir, video)
+	return np.load(vectors_filename(vectors_dir, video), mmap_mode='r')
+
+
+def migrate_vectors(vectors_dir, video):
+	with open(legacy_filename(vectors_dir, video), 'rb') as infile:
+		vectors = np.array(pickle.load(infile), np.float32)
+	metadata = {"fps": None, "framejump": None, "method": None, "source": None,
+				"migrated_from": os.path.basename(legacy_filename(vectors_dir, video))}
+	match = VECTORS_DIR_PATTERN.match(os.path.basename(os.path.normpath(vectors_dir)))
+	if match:
+		metadata["method"] = match.group("method")
+		metadata["framejump"] = int(match.group("framejump"))
+	save_vectors(vectors_dir, video, vectors, metadata)
+
+
+def adopt_legacy_vectors(legacy_dir, video, vectors_dir, name, metadata):
+	"""
+	Stores the vectors of a video of a legacy vectors dir, pickled or migrated, under a new name in vectors_dir.
+	The legacy files are kept.
+	:param metadata: dict with fps, framejump, method and source of the vectors
+	"""
+	if os.path.isfile(vectors_filename(legacy_dir, video)):
+		legacy_file = vectors_filename(legacy_dir, video)
+		vectors = np.load(legacy_file)
+	else:
+		legacy_file = legacy_filename(legacy_dir, video)
+		with open(legacy_file, 'rb') as infile:
+			vectors = np.array(pickle.load(infile), np.float32)
+	save_vectors(vectors_dir, name, vectors, dict(metadata, migrated_from=os.path.abspath(legacy_file)))
+
+
+def migrate(vectors_dir):
+	"""
+	One time migration of every pickled .p artifact of the vectors dir to the .npy store.
+	The .p files are kept, they are ignored once the .npy file exists.
+	:return: list of the migrated videos
+	"""
+	migrated = []
+	for video in list_videos(vectors_dir):
+		if not os.path.isfile(vectors_filename(vectors_dir, video)):
+			migrate_vectors(vectors_dir, video)
+			migrated.append(video)
+	return migrated
@@ -1,11 +1,27 @@
 import cv2
 import numpy as np
 import os
-import json
-import pickle
+import queue
+import threading
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 from math import sqrt
 from tqdm import tqdm
-from . import rmac
+from . import videoUtils
+from . import featureStore
+from . import instrumentation
+from .rmac.utils import BATCH_SIZE
+
+try:
+	from importlib.metadata import entry_points
+except ImportError:
+	from importlib_metadata import entry_points
+
+
+# batches of decoded frames queued ahead of the feature extraction, it bounds the memory of the pipeline
+QUEUE_BATCHES = 4
+# entry point group of the feature methods of other packages, see register_method
+ENTRY_POINT_GROUP = "contentDetectron.feature_methods"
 
 
 def get_frame(frame_index, video):
@@ -14,7 +30,49 @@ def get_frame(frame_index, video):
 	return img
 
 
-fouriers = [
+def count_sampled_frames(frame_count, framejump):
+	return int(frame_count / framejump) - 1
+
+
+def get_sampled_frames_count(video, framejump):
+	return count_sampled_frames(video.get(cv2.CAP_PROP_FRAME_COUNT), framejump)
+
+
+def iter_frames(video, framejump, total=None):
+	"""
+	Decodes the video in a single forward pass instead of seeking for every sampled frame.
+	Skipped frames are only grabbed, every framejump-th frame is retrieved.
+	:param video: opened cv2.VideoCapture
+	:param framejump: step between the sampled frames
+	:param total: number of frames to sample, by default the same as the seeking reader produced
+	:return: generator of (frame_index, frame) pairs
+	"""
+	if total is None:
+		total = get_sampled_frames_count(video, framejump)
+	frame_index = 0
+	sampled = 0
+	while sampled < total:
+		if not video.grab():
+			break
+		if frame_index % framejump == 0:
+			_, img = video.retrieve()
+			yield frame_index, img
+			sampled += 1
+		frame_index += 1
+
+
+def iter_frame_windows(video, framejump, windows):
+	"""
+	iter_frames of only the given windows, the video is seeked once to the start of every window.
+	:param windows: [first, end) ranges of sampled frames
+	"""
+	for first, end in windows:
+		video.set(cv2.CAP_PROP_POS_FRAMES, first * framejump)
+		for frame_index, img in iter_frames(video, framejump, end - first):
+			yield first * framejump + frame_index, img
+
+
+FOURIERS = [
 	[1, 1, 1, 1, 1, 1, 1, 1],
 	[-1, 1, -1, 1, 1, -1, 1, -1],
 	[-sqrt(2) / 2, 0, sqrt(2) / 2, -1, 1, -sqrt(2) / 2, 0, sqrt(2) / 2],
@@ -25,46 +83,100 @@ fouriers = [
 	[-sqrt(2) / 2, 1, -sqrt(2) / 2, 0, 0, sqrt(2) / 2, -1, sqrt(2) / 2]
 ]
 
-for i, f in enumerate(fouriers):
-	f.insert(4, 0)
-	fouriers[i] = np.array(f)
-	fouriers[i] = fouriers[i].reshape((3, 3)).astype('float32')
+fourier_templates = None
+
+
+def get_fourier_templates():
+	"""
+	Builds the 3x3 fourier templates and their maximum responses on the first call of the CTM method.
+	:return: lists of the templates, their maximum responses and the templates divided by them, so one filtering
+	gives the normalized response
+	"""
+	global fourier_templates
+	if fourier_templates is None:
+		fouriers = []
+		for f in FOURIERS:
+			f = list(f)
+			f.insert(4, 0)
+			fouriers.append(np.array(f).reshape((3, 3)).astype('float32'))
 
-max_vals = []
-for f in fouriers:
-	m = np.array([255])
-	m = cv2.matchTemplate(m.astype('float32'), f, cv2.TM_CCORR).clip(0, 255)
-	max_vals.append(cv2.matchTemplate(m.astype('float32'), f, cv2.TM_CCORR)[0][0])
+		max_vals = []
+		for f in fouriers:
+			m = np.array([255])
+			m = cv2.matchTemplate(m.astype('float32'), f, cv2.TM_CCORR).clip(0, 255)
+			max_vals.append(cv2.matchTemplate(m.astype('float32'), f, cv2.TM_CCORR)[0][0])
+
+		fourier_templates = fouriers, max_vals, [f / max_val for f, max_val in zip(fouriers, max_vals)]
+	return fourier_templates
 
 
 def color_texture_moments(img):
-	img = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-	result = []
-	for channel in range(0, 3):
-		for template, max_val in zip(fouriers, max_vals):
-			r = cv2.matchTemplate(img[:, :, channel].astype('float32'), template, cv2.TM_CCORR)
-			r = r / max_val
-			result.append(r.mean())
-			result.append(r.std())
+	_, _, scaled_fouriers = get_fourier_templates()
+	img = cv2.cvtColor(img, cv2.COLOR_BGR2HSV).astype('float32')
+	result = np.empty((3, len(scaled_fouriers), 2), np.float32)
+	for i, template in enumerate(scaled_fouriers):
+		# filter2D correlates all 3 channels at once, the border is cropped to the valid region of matchTemplate
+		r = cv2.filter2D(img, -1, template, borderType=cv2.BORDER_CONSTANT)[1:-1, 1:-1]
+		mean, std = cv2.meanStdDev(r)
+		result[:, i, 0] = mean[:, 0]
+		result[:, i, 1] = std[:, 0]
+	# channel, template, (mean, std) order
+	return result.reshape(-1)
 
-	return result
+
+def get_rmac():
+	# keras and tensorflow are imported by the first use of the CNN method only,
+	# the frozen graph exported by contentDetectron.rmac.export is used instead of keras when it exists
+	from .rmac import frozen
+	if frozen.available():
+		return frozen
+	from .rmac import rmac
+	return rmac
 
 
 def cnn_feature_vectors(img):
-	feature_vector = rmac.rmac.to_feature_vector(img)
+	feature_vector = get_rmac().to_feature_vector(img)
 	return feature_vector
 
 
-def get_img_color_hist(img, binsize):
-	channels = cv2.split(img)
-	main = np.zeros((0, 1))
-	# channels iteration process
-	for channel in channels:
-		hist = cv2.calcHist([channel], [0], None, [binsize], [0, 256])
-		main = np.append(main, hist)
+def cnn_batch_feature_vectors(imgs):
+	return get_rmac().to_feature_vectors(imgs, batch_size=len(imgs))
+
+
+def cnn_thread_safe():
+	return get_rmac().THREAD_SAFE
+
+
+def cnn_backend():
+	return get_rmac().backend()
+
+
+def load_cnn_model():
+	rmac = get_rmac()
+	if rmac.model is None:
+		rmac.load_model()
+
+
+def get_batch_color_hist(imgs, binsize):
+	"""
+	Color histograms of a whole stack of frames, written into one preallocated matrix and normalized at once.
+	:param imgs: (N, H, W, C) uint8 frames
+	:param binsize: number of bins per channel over the [0, 256) range
+	:return: (N, C * binsize) float32 matrix of normalized histograms
+	"""
+	frames, height, width, channels = imgs.shape
+	hist = np.empty((frames, channels, binsize))
+	# channels iteration process, calcHist counts faster than any numpy bincount over the pixels
+	for i, img in enumerate(imgs):
+		for channel in range(channels):
+			hist[i, channel] = cv2.calcHist([img], [channel], None, [binsize], [0, 256]).ravel()
 	# normalization
-	main = main / (img.shape[0] * img.shape[1])
-	return main.astype('float32')
+	hist = hist.reshape((frames, channels * binsize)) / (height * width)
+	return hist.astype('float32')
+
+
+def get_img_color_hist(img, binsize):
+	return get_batch_color_hist(img[np.newaxis], binsize)[0]
 
 
 def color_hist(img):
@@ -72,27 +184,334 @@ def color_hist(img):
 	return result
 
 
-def construct_feature_vectors(video_filename, result_dir_name, vector_function, framejump):
-	base_video_fn = os.path.basename(video_filename)
+def batch_color_hist(imgs):
+	return get_batch_color_hist(np.stack(imgs), 100)
+
+
+# frame_function vectorizes a single frame, the optional batch_function a list of frames at once, the optional
+# load_model loads the model of the method upfront, e.g. in a pool worker initializer, the optional thread_safe
+# tells whether the model can vectorize from several threads at once, it can when thread_safe is None, and the
+# optional backend names the implementation computing the vectors, it takes part in the keys of the vectors
+FeatureMethod = namedtuple("FeatureMethod", ["frame_function", "batch_function", "load_model", "thread_safe",
+											 "backend"])
+FeatureMethod.__new__.__defaults__ = (None, None, None, None)
+
+feature_methods = {}
+entry_points_loaded = False
+
+
+def register_method(name, frame_function, batch_function=None, load_model=None, thread_safe=None, backend=None):
+	"""
+	Registers a feature method under the name used by detect and the CLI. Other packages register their methods
+	through the contentDetectron.feature_methods entry point group: the entry point name is the method name and it
+	refers to a FeatureMethod or a frame function, it is loaded the first time an unknown method is requested.
+	"""
+	feature_methods[name] = FeatureMethod(frame_function, batch_function, load_model, thread_safe, backend)
+
+
+def load_entry_points():
+	global entry_points_loaded
+	if entry_points_loaded:
+		return
+	entry_points_loaded = True
+	group = entry_points()
+	group = group.select(group=ENTRY_POINT_GROUP) if hasattr(group, "select") else group.get(ENTRY_POINT_GROUP, [])
+	for entry_point in group:
+		if entry_point.name not in feature_methods:
+			method = entry_point.load()
+			if not isinstance(method, FeatureMethod):
+				method = FeatureMethod(method)
+			feature_methods[entry_point.name] = method
+
+
+def get_method(name):
+	if name not in feature_methods:
+		load_entry_points()
+	if name not in feature_methods:
+		raise Exception(f"Unknown feature vector method {name}, use one of {', '.join(feature_methods)}")
+	return feature_methods[name]
+
+
+register_method('CH', color_hist, batch_color_hist)
+register_method('CTM', color_texture_moments)
+register_method('CNN', cnn_feature_vectors, cnn_batch_feature_vectors, load_cnn_model, cnn_thread_safe,
+				cnn_backend)
+
+
+def get_vector_function(vector_function):
+	# Method of feature vectorizing to apply, a function is applied as it is:
+	if isinstance(vector_function, str):
+		return get_method(vector_function).frame_function
+	return vector_function
+
+
+def get_batch_vector_function(vector_function):
+	# Methods of feature vectorizing which process a whole batch of frames at once:
+	if isinstance(vector_function, str):
+		return get_method(vector_function).batch_function
+	return None
+
+
+def is_thread_safe(vector_function):
+	# whether the frames can be vectorized from several threads at once, a function is assumed to be
+	if isinstance(vector_function, str):
+		thread_safe = get_method(vector_function).thread_safe
+		return thread_safe is None or thread_safe()
+	return True
+
+
+def get_backend(vector_function):
+	# backend of the method, None for the methods with a single implementation
+	if isinstance(vector_function, str):
+		backend = get_method(vector_function).backend
+		return None if backend is None else backend()
+	return None
+
+
+def load_model(vector_function):
+	# the models are loaded lazily by the first frame, this loads the model of the method upfront
+	method = get_method(vector_function)
+	if method.load_model is not None:
+		method.load_model()
+
+
+def iter_batches(frames, batch_size):
+	batch = []
+	for frame in frames:
+		batch.append(frame)
+		if len(batch) == batch_size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+
+def vectorize_frames(frames, vector_function, total, progress=True, batch_size=BATCH_SIZE):
+	batch_function = get_batch_vector_function(vector_function)
+	vector_function = get_vector_function(vector_function)
+	feature_vectors = []
+	with tqdm(total=total, disable=not progress) as progress_bar:
+		if batch_function is None:
+			for _, img in frames:
+				feature_vector = vector_function(img)
+				feature_vectors.append(feature_vector)
+				progress_bar.update()
+		else:
+			for batch in iter_batches(frames, batch_size):
+				feature_vectors.extend(batch_function([img for _, img in batch]))
+				progress_bar.update(len(batch))
+	return np.asarray(feature_vectors, np.float32)
+
+
+def get_vectors_metadata(fps, video_filename, vector_function, framejump):
+	return {"fps": fps, "framejump": framejump, "source": os.path.abspath(video_filename),
+			"method": vector_function if isinstance(vector_function, str) else vector_function.__name__}
+
+
+def prefetch(items, max_items):
+	"""
+	Produces the items in a background thread at most max_items ahead of the consumer, e.g. decodes the next frames
+	while the current ones are vectorized. The producer blocks while the queue is full, an exception it raises is
+	raised in the consumer and closing the generator stops it.
+	:return: generator of the items
+	"""
+	buffer = queue.Queue(max_items)
+	stopped = threading.Event()
+
+	def put(entry):
+		while not stopped.is_set():
+			try:
+				buffer.put(entry, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def produce():
+		try:
+			for item in items:
+				if not put(('item', item)):
+					break
+			else:
+				put(('done', None))
+		except BaseException as error:
+			put(('error', error))
+		finally:
+			if hasattr(items, 'close'):
+				items.close()
+
+	producer = threading.Thread(target=produce, daemon=True)
+	producer.start()
+	try:
+		while True:
+			kind, value = buffer.get()
+			if kind == 'done':
+				return
+			if kind == 'error':
+				raise value
+			yield value
+	finally:
+		stopped.set()
+		producer.join()
+
+
+def iter_vector_batches(frames, vector_function, batch_size=BATCH_SIZE, feature_threads=1):
+	"""
+	Pipelined extraction: a decoding thread fills a bounded queue of frame batches and feature_threads threads
+	vectorize them, the decoders and most feature functions release the GIL.
+	:param feature_threads: threads vectorizing batches at the same time, a single one for the methods which are not
+	thread-safe like the keras CNN model, see is_thread_safe
+	:return: generator of the float32 vectors of every batch, in the order of the frames
+	"""
+	batch_function = get_batch_vector_function(vector_function)
+	frame_function = get_vector_function(vector_function)
+
+	def vectorize(batch):
+		imgs = [img for _, img in batch]
+		if batch_function is None:
+			return np.asarray([frame_function(img) for img in imgs], np.float32)
+		return np.asarray(batch_function(imgs), np.float32)
+
+	batches = prefetch(iter_batches(frames, batch_size), QUEUE_BATCHES)
+	if feature_threads <= 1 or not is_thread_safe(vector_function):
+		for batch in batches:
+			yield vectorize(batch)
+		return
+	if isinstance(vector_function, str):
+		# loaded once before the threads share it
+		load_model(vector_function)
+	with ThreadPoolExecutor(max_workers=feature_threads) as pool:
+		# the batches in flight are bounded as well, the results are taken in order
+		pending = deque()
+		for batch in batches:
+			pending.append(pool.submit(vectorize, batch))
+			if len(pending) >= 2 * feature_threads:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+
+def stream_feature_vectors(frames, vector_function, total, progress, batch_size, metrics, source_filename, writer,
+						   feature_threads=1):
+	"""
+	Vectorizes the frames with iter_vector_batches and streams the vectors into the writer batch by batch,
+	timing the decoding ('decode') apart from the whole extraction ('extract').
+	:param metrics: instrumentation.Metrics or None
+	:param source_filename: original video decoded into the frames, counted as read, None for a resized copy whose
+	original was counted by its resize
+	:param writer: featureStore.VectorWriter
+	"""
+	metrics = metrics or instrumentation.Metrics()
+	if source_filename is not None:
+		metrics.count("bytes_read", os.path.getsize(source_filename))
+	with metrics.stage("extract"), tqdm(total=total, disable=not progress) as progress_bar:
+		frames = metrics.timed_iter("decode", frames, counter="frames_decoded")
+		for vectors in iter_vector_batches(frames, vector_function, batch_size, feature_threads):
+			writer.write(vectors)
+			progress_bar.update(len(vectors))
+	metrics.count("vectors_produced", writer.frames)
+
+
+def vectorize_frame_windows(video_filename, windows, vector_function, resize_width, ingestion, video_metadata,
+							batch_size=BATCH_SIZE):
+	"""
+	Vectorizes every frame of the windows, decoded from the resized video or piped from the original one.
+	:param video_filename: the resized video for the resize ingestion, the original video for the pipe ingestion
+	:param windows: [first, end) frame ranges
+	:return: float32 matrix of the vectors of the frames of the windows one after another
+	"""
+	if ingestion == 'pipe':
+		frames = videoUtils.iter_scaled_frame_windows(video_filename, resize_width, 1, windows, video_metadata)
+	else:
+		frames = iter_frame_windows(cv2.VideoCapture(video_filename), 1, windows)
+	return vectorize_frames(frames, vector_function, sum(end - first for first, end in windows), False, batch_size)
+
+
+def clip_windows(windows, total, metadata):
+	"""
+	Clips the windows to the sampled frames of the video and records them in the vectors metadata,
+	the stored vectors are the frames of the windows one after another.
+	:return: the clipped windows, their number of frames and the metadata
+	"""
+	windows = [(min(first, total), min(end, total)) for first, end in windows]
+	windows = [(first, end) for first, end in windows if end > first]
+	return windows, sum(end - first for first, end in windows), dict(metadata, windows=windows, samples=total)
+
+
+def construct_feature_vectors(video_filename, result_dir_name, vector_function, framejump, progress=True,
+							  batch_size=BATCH_SIZE, vectors_dir=None, vectors_name=None, metrics=None, windows=None,
+							  dtype='float32', feature_threads=1):
+	"""
+	Converts the sampled frames of the video to feature vectors, stored by default as result_dir_name/<video>
+	next to the video.
+	:param vectors_dir: directory of the stored vectors, overrides result_dir_name
+	:param vectors_name: name of the stored vectors, e.g. an artifact cache key, the video file name by default
+	:param metrics: instrumentation.Metrics the stage timers and counters are recorded into
+	:param windows: [first, end) ranges of the sampled frames to vectorize, see segments.detection_windows,
+	all sampled frames by default
+	:param dtype: float32 or float16 storage of the vectors
+	:param feature_threads: threads vectorizing the decoded frames, see iter_vector_batches
+	"""
+	base_video_fn = vectors_name or os.path.basename(video_filename)
 	video = cv2.VideoCapture(video_filename)
-	series_dir = os.path.dirname(video_filename)
-	vectors_filename = os.path.join(series_dir, result_dir_name, base_video_fn + ".p")
-
-	# Method of feature vectorizing to apply:
-	if vector_function == 'CH':
-		vector_function = color_hist
-	elif vector_function == 'CTM':
-		vector_function = color_texture_moments
-	elif vector_function == 'CNN':
-		vector_function = cnn_feature_vectors
-
-	os.makedirs(os.path.dirname(vectors_filename), exist_ok=True)
-	if not os.path.isfile(vectors_filename):
-		feature_vectors = []
-		total = int(video.get(cv2.CAP_PROP_FRAME_COUNT) / framejump) - 1
-		for i in tqdm(range(total)):
-			img = get_frame(i * framejump, video)
-			feature_vector = vector_function(img)
-			feature_vectors.append(feature_vector)
-		with open(vectors_filename, 'wb') as outfile:
-			pickle.dump(feature_vectors, outfile, protocol=2)
+	if vectors_dir is None:
+		vectors_dir = os.path.join(os.path.dirname(video_filename), result_dir_name)
+
+	if not featureStore.exists(vectors_dir, base_video_fn):
+		total = get_sampled_frames_count(video, framejump)
+		metadata = get_vectors_metadata(video.get(cv2.CAP_PROP_FPS), video_filename, vector_function, framejump)
+		if windows is None:
+			frames = iter_frames(video, framejump, total)
+		else:
+			windows, total, metadata = clip_windows(windows, total, metadata)
+			frames = iter_frame_windows(video, framejump, windows)
+		with featureStore.VectorWriter(vectors_dir, base_video_fn, dtype) as writer:
+			stream_feature_vectors(frames, vector_function, total, progress, batch_size, metrics, None, writer,
+								   feature_threads)
+			writer.close(metadata)
+
+
+def construct_piped_feature_vectors(video_filename, vectors_dir, vector_function, framejump, resize_width,
+									progress=True, batch_size=BATCH_SIZE, video_metadata=None, vectors_name=None,
+									metrics=None, windows=None, dtype='float32', sampling='framejump',
+									sample_fps=None, feature_threads=1):
+	"""
+	Same as construct_feature_vectors, but the frames are decoded from the original video straight to the target
+	resolution through an ffmpeg pipe, so no resized copy of the video is needed. The presentation times of the
+	frames are stored in the metadata as timestamps, next to the duration of the video, unless windows are given.
+	:param video_metadata: probed metadata of the original video, it is probed when not provided
+	:param vectors_name: name of the stored vectors, the video file name by default
+	:param windows: [first, end) ranges of the sampled frames to vectorize, all sampled frames by default
+	:param dtype: float32 or float16 storage of the vectors
+	:param sampling: 'framejump', 'keyframes' or 'fps', see videoUtils.iter_sampled_frames
+	:param sample_fps: frames per second sampled by the 'fps' sampling
+	:param feature_threads: threads vectorizing the decoded frames, see iter_vector_batches
+	"""
+	base_video_fn = vectors_name or os.path.basename(video_filename)
+
+	if not featureStore.exists(vectors_dir, base_video_fn):
+		if video_metadata is None:
+			video_metadata = videoUtils.probe(video_filename)
+		total = count_sampled_frames(video_metadata["frame_count"], framejump)
+		metadata = get_vectors_metadata(video_metadata["fps"], video_filename, vector_function, framejump)
+		timestamps = []
+		if sampling != 'framejump':
+			total = int(video_metadata["duration"] * sample_fps) if sampling == 'fps' else None
+			metadata = dict(metadata, sampling=sampling, sample_fps=sample_fps if sampling == 'fps' else None)
+			frames = videoUtils.iter_sampled_frames(video_filename, resize_width, sampling, sample_fps,
+													video_metadata, timestamps)
+		elif windows is None:
+			frames = videoUtils.iter_scaled_frames(video_filename, resize_width, framejump, total, video_metadata,
+												   timestamps=timestamps)
+		else:
+			windows, total, metadata = clip_windows(windows, total, metadata)
+			frames = videoUtils.iter_scaled_frame_windows(video_filename, resize_width, framejump, windows,
+														  video_metadata)
+			timestamps = None
+		with featureStore.VectorWriter(vectors_dir, base_video_fn, dtype) as writer:
+			stream_feature_vectors(frames, vector_function, total, progress, batch_size, metrics, video_filename,
+								   writer, feature_threads)
+			if timestamps is not None:
+				metadata = dict(metadata, timestamps=timestamps[:writer.frames],
+								duration=max(video_metadata["duration"], timestamps[-1] if timestamps else 0.0))
+			writer.close(metadata)
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+try:
+	import fcntl
+except ImportError:
+	# Windows, the files are updated without a lock between processes
+	fcntl = None
+
+
+@contextmanager
+def atomic_output(filename):
+	"""
+	Yields a temporary path next to filename and renames it onto filename only when the block succeeds,
+	so concurrent or crashed runs never leave a half-written artifact behind.
+	:param filename: final artifact path
+	:return: temporary path to write into, it keeps the extension of filename
+	"""
+	directory, basename = os.path.split(filename)
+	_, extension = os.path.splitext(basename)
+	fd, tmp_filename = tempfile.mkstemp(prefix=f".{basename}.", suffix=extension, dir=directory or None)
+	os.close(fd)
+	try:
+		yield tmp_filename
+		os.replace(tmp_filename, filename)
+	finally:
+		if os.path.exists(tmp_filename):
+			os.remove(tmp_filename)
+
+
+def link_or_copy(source, filename):
+	"""
+	Hard links source to filename, or copies it when the file system can not link them, atomically like atomic_output.
+	"""
+	with atomic_output(filename) as tmp_filename:
+		os.remove(tmp_filename)
+		try:
+			os.link(source, tmp_filename)
+		except OSError:
+			shutil.copyfile(source, tmp_filename)
+
+
+@contextmanager
+def file_lock(filename):
+	"""
+	Holds an exclusive lock on filename between processes for the block, the file is created when missing.
+	The lock is not reentrant, a process must not take it twice.
+	"""
+	with open(filename, 'a') as lock_file:
+		if fcntl is not None:
+			fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			if fcntl is not None:
+				fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
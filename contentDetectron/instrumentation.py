@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import pstats
+import threading
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from . import fileUtils
+
+
+PROFILE_MODES = ('cprofile', 'sample')
+SAMPLE_INTERVAL_SECONDS = 0.005
+
+
+def empty_metrics():
+	return {"stages": {}, "counters": {}}
+
+
+class Metrics:
+	"""
+	Stage timers and counters of a detection run, for the whole season and per episode.
+	The optional hook is called as hook(kind, name, value, episode) for every recorded stage ('stage', seconds)
+	and counter ('counter', increment), episode is None for the season wide entries.
+	"""
+
+	def __init__(self, hook=None):
+		self.hook = hook
+		self.season = empty_metrics()
+		self.episodes = {}
+
+	def scope(self, episode):
+		if episode is None:
+			return self.season
+		return self.episodes.setdefault(episode, empty_metrics())
+
+	def record(self, name, seconds, episode=None):
+		stages = self.scope(episode)["stages"]
+		stages[name] = stages.get(name, 0.0) + seconds
+		if self.hook is not None:
+			self.hook('stage', name, seconds, episode)
+
+	def count(self, name, value=1, episode=None):
+		counters = self.scope(episode)["counters"]
+		counters[name] = counters.get(name, 0) + value
+		if self.hook is not None:
+			self.hook('counter', name, value, episode)
+
+	@contextmanager
+	def stage(self, name, episode=None):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.record(name, time.perf_counter() - start, episode)
+
+	def timed_iter(self, name, iterable, episode=None, counter=None):
+		"""
+		Times only the time spent producing the items of iterable, e.g. decoding interleaved with vectorizing.
+		:param counter: name of the counter of the produced items, they are not counted when None
+		:return: generator of the items of iterable
+		"""
+		iterator = iter(iterable)
+		seconds = 0.0
+		items = 0
+		try:
+			while True:
+				start = time.perf_counter()
+				try:
+					item = next(iterator)
+				except StopIteration:
+					break
+				finally:
+					seconds += time.perf_counter() - start
+				items += 1
+				yield item
+		finally:
+			self.record(name, seconds, episode)
+			if counter is not None:
+				self.count(counter, items, episode)
+
+	def merge_episode(self, episode, episode_metrics):
+		"""
+		Adds the metrics collected for an episode by another Metrics, e.g. in a pool worker.
+		:param episode_metrics: season scope of Metrics.to_dict()
+		"""
+		for name, seconds in episode_metrics["stages"].items():
+			self.record(name, seconds, episode)
+		for name, value in episode_metrics["counters"].items():
+			self.count(name, value, episode)
+
+	def to_dict(self):
+		totals = empty_metrics()
+		for episode_metrics in self.episodes.values():
+			for kind in ("stages", "counters"):
+				for name, value in episode_metrics[kind].items():
+					totals[kind][name] = totals[kind].get(name, 0) + value
+		return {"season": self.season, "episode_totals": totals, "episodes": self.episodes}
+
+	def save(self, filename):
+		with fileUtils.atomic_output(filename) as tmp_filename:
+			with open(tmp_filename, 'w') as outfile:
+				json.dump(self.to_dict(), outfile, indent=1)
+
+
+class StackSampler(threading.Thread):
+	"""
+	Sampling profiler of a single thread, the sampled stacks are counted in the collapsed format of flamegraph.pl
+	and speedscope.
+	"""
+
+	def __init__(self, thread_id, interval=SAMPLE_INTERVAL_SECONDS):
+		super().__init__(daemon=True)
+		self.thread_id = thread_id
+		self.interval = interval
+		self.stacks = Counter()
+		self.stopped = threading.Event()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			frame = sys._current_frames().get(self.thread_id)
+			if frame is not None:
+				self.stacks[";".join(f"{f.name} ({os.path.basename(f.filename)}:{f.lineno})"
+									 for f in traceback.extract_stack(frame))] += 1
+
+	def save(self, filename):
+		with open(filename, 'w') as outfile:
+			for stack, samples in self.stacks.most_common():
+				outfile.write(f"{stack} {samples}\n")
+
+
+@contextmanager
+def profiled(mode, output_prefix):
+	"""
+	Profiles the calling thread while the block runs, pool worker processes are not profiled.
+	:param mode: None, 'cprofile' for output_prefix.prof stats or 'sample' for output_prefix.folded stacks
+	:param output_prefix: path of the profile without the extension
+	"""
+	if mode is None:
+		yield
+	elif mode == 'cprofile':
+		profile = cProfile.Profile()
+		profile.enable()
+		try:
+			yield
+		finally:
+			profile.disable()
+			profile.dump_stats(output_prefix + ".prof")
+			pstats.Stats(profile).sort_stats("cumulative").print_stats(20)
+	elif mode == 'sample':
+		sampler = StackSampler(threading.get_ident())
+		sampler.start()
+		try:
+			yield
+		finally:
+			sampler.stopped.set()
+			sampler.join()
+			sampler.save(output_prefix + ".folded")
+	else:
+		raise Exception(f"Unknown profile mode {mode}, use one of {', '.join(PROFILE_MODES)}")
@@ -0,0 +1,197 @@
+import os
+import csv
+import argparse
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from . import detectron
+from . import evaluation
+from . import segments
+from . import artifactCache
+from . import featureVectorizer
+from . import videoUtils
+from . import instrumentation
+from . import fileUtils
+
+
+# post-processing parameters of detect swept by default, the lookahead is the one of segments.fill_gaps
+DEFAULT_GRID = {
+	"percentile": [5, 10, 15, 20, 25],
+	"video_start_threshold_percentile": [20],
+	"video_end_threshold_seconds": [5, 7, 10, 15],
+	"min_detection_size_seconds": [3, 5, 10, 15],
+	"lookahead_seconds": [5, 10, 15],
+}
+# format of the cached distances, the frames outside the detection windows were the float32 maximum up to version 1
+DISTANCES_VERSION = 2
+SCORE_COLUMNS = ["precision", "recall", "f1", "relevant_seconds", "detected_seconds", "relevant_detected_seconds"]
+
+
+def parameter_grid(grid):
+	"""
+	:param grid: dictionary of the list of values of every parameter
+	:return: list of the parameter dictionaries of every combination of the values
+	"""
+	names = list(grid)
+	return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def season_distances(video_dir, feature_vector_function='CH', artifacts_dir=None, framejump=3, resize_width=320,
+					 ingestion='resize', workers=1, batch_size=featureVectorizer.BATCH_SIZE, compression=None,
+					 sampling='framejump', sample_fps=1, metrics=None):
+	"""
+	Nearest other episode distances of every sampled frame of the season, computed once per season and framejump.
+	The feature vectors are prepared like in detectron.detect and the distances are cached next to them
+	in artifacts_dir/cache/distances/, keyed by the feature vectors they were queried from.
+	:return: dictionary of the videos, the distances, the framerates and the sample times of the episodes,
+	see detectron.query_season
+	"""
+	metrics = metrics or instrumentation.Metrics()
+	if feature_vector_function == 'CNN':
+		resize_width = 224
+	if artifacts_dir is None:
+		artifacts_dir = video_dir
+
+	cache = artifactCache.ArtifactCache(artifacts_dir)
+	season = detectron.plan_season(video_dir, feature_vector_function, artifacts_dir, cache, framejump, resize_width,
+								   ingestion, batch_size, metrics, compression=compression, sampling=sampling,
+								   sample_fps=sample_fps)
+	key = artifactCache.artifact_key('distances', season["vector_keys"], compression=compression,
+									 version=DISTANCES_VERSION)
+	distances_file = cache.path('distances', key, '.npz')
+
+	if os.path.isfile(distances_file):
+		print(f"Loading the cached distances of {video_dir}")
+		with np.load(distances_file) as stored:
+			distances = [stored[f"distances_{i}"] for i in range(len(season["videos"]))]
+			framerates = stored["framerates"].tolist()
+			sample_times = [stored[f"sample_times_{i}"] if f"sample_times_{i}" in stored else None
+							for i in range(len(season["videos"]))]
+	else:
+		detectron.prepare_season(season, feature_vector_function, workers, metrics, cache)
+		distances, framerates, sample_times = detectron.query_season(season, cache, None, metrics, season["videos"])
+		os.makedirs(cache.kind_dir('distances'), exist_ok=True)
+		with fileUtils.atomic_output(distances_file) as tmp_filename:
+			with open(tmp_filename, 'wb') as outfile:
+				np.savez(outfile, framerates=np.array(framerates),
+						 **{f"distances_{i}": np.asarray(d) for i, d in enumerate(distances)},
+						 **{f"sample_times_{i}": t for i, t in enumerate(sample_times) if t is not None})
+	cache.register('distances', key, [distances_file])
+	cache.save()
+	return {"videos": season["videos"], "distances": distances, "framerates": framerates, "sample_times": sample_times}
+
+
+def evaluate_settings(season, ground_truths, framejump, settings):
+	return [evaluate_setting(season, ground_truths, framejump, setting) for setting in settings]
+
+
+def evaluate_setting(season, ground_truths, framejump, setting):
+	"""
+	Detects the intros and outros of the season from its distances with one setting of the post-processing,
+	the same way detectron.match_season does, and scores them against the ground truth.
+	:param ground_truths: list of the annotated (start, end) seconds of every episode
+	:param setting: post-processing parameters, see DEFAULT_GRID
+	:return: the setting with its precision, recall and f1 and the summed seconds they are computed from
+	"""
+	totals = np.zeros(3)
+	for result, framerate, sample_times, ground_truth in zip(season["distances"], season["framerates"],
+															 season["sample_times"], ground_truths):
+		detected_beginning, detected_end = segments.detect_segments(
+			result, framerate, framejump, setting["percentile"], setting["video_start_threshold_percentile"],
+			setting["video_end_threshold_seconds"], setting["min_detection_size_seconds"],
+			setting["lookahead_seconds"], sample_times
+		)
+		detected = segments.longest_segments(detected_beginning) + detected_end
+		totals += evaluation.precision_recall_detections_score(detected, ground_truth)
+
+	relevant, retrieved, relevant_retrieved = totals
+	# the 2 second boundary tolerance of the evaluation can credit more time than was detected
+	precision = min(1.0, relevant_retrieved / retrieved) if retrieved else 0.0
+	recall = relevant_retrieved / relevant if relevant else 0.0
+	f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+	return dict(setting, precision=precision, recall=recall, f1=f1, relevant_seconds=relevant,
+				detected_seconds=retrieved, relevant_detected_seconds=relevant_retrieved)
+
+
+def sweep(season, annotations, framejump, grid=None, workers=1):
+	"""
+	Evaluates every combination of the post-processing parameters of the grid on the distances of a season.
+	:param season: dictionary of season_distances
+	:param annotations: annotations dataframe of evaluation.get_annotations
+	:param grid: dictionary of the list of values of every parameter, DEFAULT_GRID by default
+	:return: list of the scored settings, see evaluate_setting
+	"""
+	settings = parameter_grid(grid or DEFAULT_GRID)
+	ground_truths = [evaluation.skip_timestamps_in_file(video, annotations) for video in season["videos"]]
+	if workers > 1:
+		# the distances and ground truth of the season are sent once per chunk of settings instead of with every setting
+		chunksize = max(1, len(settings) // (workers * 4))
+		with ProcessPoolExecutor(max_workers=workers) as pool:
+			futures = [pool.submit(evaluate_settings, season, ground_truths, framejump, settings[i:i + chunksize])
+					   for i in range(0, len(settings), chunksize)]
+			return [row for future in futures for row in future.result()]
+	return evaluate_settings(season, ground_truths, framejump, settings)
+
+
+def save_table(rows, filename):
+	os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+	with fileUtils.atomic_output(filename) as tmp_filename:
+		with open(tmp_filename, 'w', newline='') as outfile:
+			writer = csv.DictWriter(outfile, fieldnames=list(rows[0]))
+			writer.writeheader()
+			writer.writerows(rows)
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Sweeps the post-processing parameters of the detection over the cached "
+									 u"nearest neighbour distances of a season and scores every setting against "
+									 u"the annotations")
+	parser.add_argument(u"--video_dir", required=True, help="video directory where the video files are stored")
+	parser.add_argument(u"--annotations", required=True, help="annotations csv file of the season")
+	parser.add_argument(u"--feature_vector_method", nargs='?', const='CH', type=str, default='CH')
+	parser.add_argument(u"--artifacts_dir", required=False, nargs='?', type=str, const='./artifacts/',
+						default='./artifacts/')
+	parser.add_argument(u"--framejump", nargs='?', const=8, type=int, default=8)
+	parser.add_argument(u"--resize_width", nargs='?', const=720, type=int, default=720)
+	parser.add_argument(u"--ingestion", choices=['resize', 'pipe'], default='resize')
+	parser.add_argument(u"--compression", required=False, type=str, default=None)
+	parser.add_argument(u"--sampling", choices=videoUtils.SAMPLING_MODES, default='framejump')
+	parser.add_argument(u"--sample_fps", nargs='?', const=1, type=float, default=1)
+	parser.add_argument(u"--workers", nargs='?', const=os.cpu_count(), type=int, default=1,
+						help="number of processes preparing the episodes and evaluating the settings")
+	parser.add_argument(u"--percentiles", nargs='+', type=float, default=DEFAULT_GRID["percentile"])
+	parser.add_argument(u"--start_percentiles", nargs='+', type=float,
+						default=DEFAULT_GRID["video_start_threshold_percentile"])
+	parser.add_argument(u"--end_thresholds", nargs='+', type=float,
+						default=DEFAULT_GRID["video_end_threshold_seconds"])
+	parser.add_argument(u"--min_seconds", nargs='+', type=float, default=DEFAULT_GRID["min_detection_size_seconds"])
+	parser.add_argument(u"--lookaheads", nargs='+', type=float, default=DEFAULT_GRID["lookahead_seconds"])
+	parser.add_argument(u"--output", nargs='?', const='./outputs/sweep_for_season.csv', type=str,
+						default='./outputs/sweep_for_season.csv', help="csv file the scored settings are written to")
+	return parser.parse_args()
+
+
+def main():
+	command_params = parse_cli_arguments()
+	grid = {"percentile": command_params.percentiles,
+			"video_start_threshold_percentile": command_params.start_percentiles,
+			"video_end_threshold_seconds": command_params.end_thresholds,
+			"min_detection_size_seconds": command_params.min_seconds,
+			"lookahead_seconds": command_params.lookaheads}
+	season = season_distances(command_params.video_dir, command_params.feature_vector_method,
+							  command_params.artifacts_dir, command_params.framejump, command_params.resize_width,
+							  command_params.ingestion, command_params.workers, compression=command_params.compression,
+							  sampling=command_params.sampling, sample_fps=command_params.sample_fps)
+	rows = sweep(season, evaluation.get_annotations(command_params.annotations), command_params.framejump, grid,
+				 command_params.workers)
+	save_table(rows, command_params.output)
+
+	names = list(grid)
+	print(" ".join(names + SCORE_COLUMNS[:3]))
+	for row in sorted(rows, key=lambda row: -row["f1"])[:10]:
+		print(" ".join(f"{row[column]:g}" for column in names + SCORE_COLUMNS[:3]))
+	print(f"{len(rows)} settings saved into {command_params.output}")
+
+
+if __name__ == "__main__":
+	main()
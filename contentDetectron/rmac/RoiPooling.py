@@ -15,7 +15,7 @@ class RoiPooling(Layer):
 		if self.dim_ordering == 'th':
 			self.nb_channels = input_shape[0][1]
 		elif self.dim_ordering == 'tf':
-			self.nb_channels == input_shape[0][3]
+			self.nb_channels = input_shape[0][3]
 
 	def compute_output_shape(self, input_shape):
 		return None, self.num_rois, self.nb_channels * self.num_outputs_per_channel
@@ -25,72 +25,68 @@ class RoiPooling(Layer):
 		base_config = super(RoiPooling, self).get_config()
 		return dict(list(base_config.items()) + list(config.items()))
 
+	def pool_bounds(self, rois):
+		"""
+		Computes the rounded bounds of every pooling cell of every ROI at once.
+		:param rois: (num_rois, 4) tensor of x, y, w, h regions
+		:return: x1, x2, y1, y2 int32 tensors of num_rois * num_outputs_per_channel cells, ordered ROI first
+		"""
+		x = rois[:, 0]
+		y = rois[:, 1]
+		w = rois[:, 2]
+		h = rois[:, 3]
+
+		x1s, x2s, y1s, y2s = [], [], [], []
+		for num_pool_regions in self.pool_list:
+			row_length = w / num_pool_regions
+			col_length = h / num_pool_regions
+			for ix in range(num_pool_regions):
+				for jy in range(num_pool_regions):
+					x1 = x + ix * col_length
+					y1 = y + jy * row_length
+					x1s.append(x1)
+					x2s.append(x1 + col_length)
+					y1s.append(y1)
+					y2s.append(y1 + row_length)
+
+		return [K.reshape(K.cast(K.round(K.stack(bounds, axis=1)), 'int32'), (-1,))
+				for bounds in (x1s, x2s, y1s, y2s)]
+
+	@staticmethod
+	def outside_penalty(start, end, length):
+		# 0 inside the [start, end) range of every cell and a huge negative value outside, so a max skips it
+		positions = K.expand_dims(K.arange(0, length), axis=0)
+		inside = K.cast(K.greater_equal(positions, K.expand_dims(start, axis=1)), 'float32') * \
+			K.cast(K.less(positions, K.expand_dims(end, axis=1)), 'float32')
+		return (inside - 1.) * 1e30
+
 	def call(self, x, mask=None):
 
 		assert (len(x) == 2)
 
 		img = x[0]
-		rois = x[1]
+		# the same regions are used for every image of the batch
+		rois = K.cast(x[1][0], 'float32')
 
 		input_shape = K.shape(img)
-		outputs = []
-
-		for roi_idx in range(self.num_rois):
-
-			x = rois[0, roi_idx, 0]
-			y = rois[0, roi_idx, 1]
-
-			w = rois[0, roi_idx, 2]
-			h = rois[0, roi_idx, 3]
-
-			row_length = [w / i for i in self.pool_list]
-			col_length = [h / i for i in self.pool_list]
-
-			if self.dim_ordering == 'th':
-				for pool_num, num_pool_regions in enumerate(self.pool_list):
-					for ix in range(num_pool_regions):
-						for jy in range(num_pool_regions):
-							x1 = x + ix * col_length[pool_num]
-							x2 = x1 + col_length[pool_num]
-
-							y1 = y + jy * row_length[pool_num]
-							y2 = y1 + row_length[pool_num]
-
-							x1 = K.cast(K.round(x1), 'int32')
-							x2 = K.cast(K.round(x2), 'int32')
+		x1, x2, y1, y2 = self.pool_bounds(rois)
 
-							y1 = K.cast(K.round(y1), 'int32')
-							y2 = K.cast(K.round(y2), 'int32')
-
-							new_shape = [input_shape[0], input_shape[1], y2 - y1, x2 - x1]
-							x_crop = img[:, :, y1:y2, x1:x2]
-							xm = K.reshape(x_crop, new_shape)
-							pooled_val = K.max(xm, axis=(2, 3))
-							outputs.append(pooled_val)
-
-			elif self.dim_ordering == 'tf':
-				for pool_num, num_pool_regions in enumerate(self.pool_list):
-					for ix in range(num_pool_regions):
-						for jy in range(num_pool_regions):
-							x1 = x + ix * col_length[pool_num]
-							x2 = x1 + col_length[pool_num]
-
-							y1 = y + jy * row_length[pool_num]
-							y2 = y1 + row_length[pool_num]
-
-							x1 = K.cast(K.round(x1), 'int32')
-							x2 = K.cast(K.round(x2), 'int32')
-
-							y1 = K.cast(K.round(y1), 'int32')
-							y2 = K.cast(K.round(y2), 'int32')
+		# all cells are pooled together: the image is broadcast against the masks of every cell,
+		# reduced over the width first and over the height after
+		if self.dim_ordering == 'th':
+			width_penalty = self.outside_penalty(x1, x2, input_shape[3])
+			height_penalty = self.outside_penalty(y1, y2, input_shape[2])
+			pooled = K.max(K.expand_dims(img, axis=1) + K.reshape(width_penalty, (1, -1, 1, 1, input_shape[3])),
+						   axis=4)
+			pooled = K.max(pooled + K.reshape(height_penalty, (1, -1, 1, input_shape[2])), axis=3)
 
-							new_shape = [input_shape[0], y2 - y1, x2 - x1, input_shape[3]]
-							x_crop = img[:, y1:y2, x1:x2, :]
-							xm = K.reshape(x_crop, new_shape)
-							pooled_val = K.max(xm, axis=(1, 2))
-							outputs.append(pooled_val)
+		elif self.dim_ordering == 'tf':
+			width_penalty = self.outside_penalty(x1, x2, input_shape[2])
+			height_penalty = self.outside_penalty(y1, y2, input_shape[1])
+			pooled = K.max(K.expand_dims(img, axis=1) + K.reshape(width_penalty, (1, -1, 1, input_shape[2], 1)),
+						   axis=3)
+			pooled = K.max(pooled + K.reshape(height_penalty, (1, -1, input_shape[1], 1)), axis=2)
 
-		final_output = K.concatenate(outputs, axis=0)
-		final_output = K.reshape(final_output, (1, self.num_rois, self.nb_channels * self.num_outputs_per_channel))
+		final_output = K.reshape(pooled, (-1, self.num_rois, self.nb_channels * self.num_outputs_per_channel))
 
 		return final_output
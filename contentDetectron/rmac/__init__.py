@@ -1 +0,0 @@
-from . import rmac
\ No newline at end of file
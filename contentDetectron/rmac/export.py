@@ -0,0 +1,53 @@
+import argparse
+import json
+from ..fileUtils import atomic_output
+from . import frozen
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Freezes the keras RMAC model with its weights into a standalone graph "
+									 u"for the CPU inference of the CNN feature vectors")
+	parser.add_argument(u"--output", nargs='?', const=frozen.MODEL_FILE, type=str, default=frozen.MODEL_FILE)
+	parser.add_argument(u"--quantize", action='store_true',
+						help="stores the weights as 8 bit integers, the graph is 4 times smaller")
+	return parser.parse_args()
+
+
+def export_frozen_graph(output_file=frozen.MODEL_FILE, quantize=False):
+	"""
+	Freezes VGG16 conv5, the RoI max pooling, the PCA and the normalizations of the keras RMAC model into one
+	GraphDef with constant weights, next to a json file with the names of its input and output tensors.
+	:param quantize: quantizes the weights to 8 bits with the quantize_weights graph transform
+	"""
+	import tensorflow as tf
+	import keras.backend as K
+	from tensorflow.tools.graph_transforms import TransformGraph
+	from . import rmac
+
+	K.set_learning_phase(0)
+	rmac.load_model()
+	output_name = rmac.model.output.op.name
+	input_names = [model_input.op.name for model_input in rmac.model.inputs]
+
+	session = K.get_session()
+	graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), [output_name])
+	if quantize:
+		graph_def = TransformGraph(graph_def, input_names, [output_name], ['quantize_weights'])
+
+	with atomic_output(output_file) as tmp_filename:
+		with open(tmp_filename, 'wb') as outfile:
+			outfile.write(graph_def.SerializeToString())
+	with atomic_output(frozen.config_filename(output_file)) as tmp_filename:
+		with open(tmp_filename, 'w') as outfile:
+			json.dump({"inputs": [name + ":0" for name in input_names], "output": output_name + ":0",
+					   "quantized": bool(quantize)}, outfile, indent=1)
+
+
+def main():
+	command_params = parse_cli_arguments()
+	export_frozen_graph(command_params.output, command_params.quantize)
+	print(f"Frozen RMAC graph saved into {command_params.output}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,118 @@
+import os
+import json
+import numpy as np
+from ..artifactCache import fingerprint
+from .get_regions import rmac_regions, get_size_vgg_feature_map
+from .utils import BATCH_SIZE, DATA_DIR, INPUT_DIMENSION, preprocess
+
+
+# frozen RMAC graph written by contentDetectron.rmac.export, used instead of the keras model when it exists
+MODEL_FILE = os.path.join(DATA_DIR, "rmac_frozen.pb")
+# a tensorflow session can be run from several threads at once
+THREAD_SAFE = True
+
+model_file = MODEL_FILE
+# 0 lets tensorflow pick the number of threads
+intra_op_threads = 0
+inter_op_threads = 0
+
+model = None
+regions = None
+tiled_regions = None
+
+
+def config_filename(graph_file):
+	return os.path.splitext(graph_file)[0] + ".json"
+
+
+def configure(graph_file=None, intra_op=None, inter_op=None):
+	"""
+	Sets the frozen graph and the thread pools of the CPU inference, before the model is loaded.
+	:param intra_op: threads running a single operation, e.g. a convolution
+	:param inter_op: threads running independent operations in parallel
+	"""
+	global model_file, intra_op_threads, inter_op_threads
+	if graph_file is not None:
+		model_file = graph_file
+	if intra_op is not None:
+		intra_op_threads = intra_op
+	if inter_op is not None:
+		inter_op_threads = inter_op
+
+
+def settings():
+	"""
+	:return: the arguments of configure the model of this process is loaded with, to configure the pool workers alike
+	"""
+	return model_file, intra_op_threads, inter_op_threads
+
+
+def available():
+	return os.path.isfile(model_file) and os.path.isfile(config_filename(model_file))
+
+
+def backend():
+	"""
+	Part of the keys of the CNN vectors: a quantized graph or another export gives other vectors than the keras model.
+	"""
+	with open(config_filename(model_file)) as infile:
+		quantized = json.load(infile).get("quantized", False)
+	return f"frozen{'_quantized' if quantized else ''}:{fingerprint(model_file)}"
+
+
+class FrozenModel:
+	"""
+	Session over the frozen RMAC graph, only tensorflow is imported, keras and the ImageNet weights are not needed.
+	"""
+
+	def __init__(self, graph_file, intra_op, inter_op):
+		import tensorflow as tf
+		with open(config_filename(graph_file)) as infile:
+			self.config = json.load(infile)
+		graph_def = tf.GraphDef()
+		with open(graph_file, 'rb') as infile:
+			graph_def.ParseFromString(infile.read())
+		self.graph = tf.Graph()
+		with self.graph.as_default():
+			tf.import_graph_def(graph_def, name='')
+		self.inputs = [self.graph.get_tensor_by_name(name) for name in self.config["inputs"]]
+		self.output = self.graph.get_tensor_by_name(self.config["output"])
+		self.session = tf.Session(graph=self.graph, config=tf.ConfigProto(
+			intra_op_parallelism_threads=intra_op, inter_op_parallelism_threads=inter_op))
+
+	def predict(self, inputs):
+		return self.session.run(self.output, feed_dict=dict(zip(self.inputs, inputs)))
+
+
+def load_model():
+	global regions
+	global model
+	Wmap, Hmap = get_size_vgg_feature_map(INPUT_DIMENSION[0], INPUT_DIMENSION[1])
+	regions = rmac_regions(Wmap, Hmap, 3)
+	model = FrozenModel(model_file, intra_op_threads, inter_op_threads)
+
+
+def get_tiled_regions(batch_size):
+	global tiled_regions
+	if tiled_regions is None or tiled_regions.shape[0] < batch_size:
+		tiled_regions = np.tile(np.expand_dims(regions, axis=0), (batch_size, 1, 1))
+	return tiled_regions[:batch_size]
+
+
+def to_feature_vector(img_array):
+	return to_feature_vectors([img_array], 1)[0]
+
+
+def to_feature_vectors(img_arrays, batch_size=BATCH_SIZE):
+	"""
+	Same vectors as rmac.to_feature_vectors computed by the frozen graph.
+	:return: (N, 512) float32 matrix of RMAC vectors
+	"""
+	if model is None:
+		load_model()
+	imgs = np.stack([preprocess(img_array) for img_array in img_arrays])
+	RMAC = []
+	for start in range(0, len(imgs), batch_size):
+		batch = imgs[start:start + batch_size]
+		RMAC.append(model.predict([batch, get_tiled_regions(len(batch))]))
+	return np.concatenate(RMAC, axis=0).astype('float32')
@@ -1,6 +1,6 @@
 from __future__ import division, print_function
+import os
 import warnings
-import cv2
 from keras.layers import Lambda, Dense, TimeDistributed, Input
 from keras.models import Model
 import keras.backend as K
@@ -16,8 +16,9 @@ K.set_image_dim_ordering('th')
 warnings.filterwarnings("ignore")
 
 
-INPUT_DIMENSION = (224, 224)
 vector_size = 512
+# keras models can not predict from several threads at once
+THREAD_SAFE = False
 
 
 def addition(x):
@@ -51,7 +52,7 @@ def rmac(input_shape, num_rois):
     # Model
     model = Model([vgg16_model.input, in_roi], rmac_norm)
     # Load weights
-    mat = scipy.io.loadmat(DATA_DIR + PCA_FILE)
+    mat = scipy.io.loadmat(os.path.join(DATA_DIR, PCA_FILE))
     b = np.squeeze(mat['bias'], axis=1)
     w = np.transpose(mat['weights'])
     model.layers[-4].set_weights([w, b])
@@ -60,6 +61,12 @@ def rmac(input_shape, num_rois):
 
 model = None
 regions = None
+tiled_regions = None
+
+
+def backend():
+    # part of the keys of the CNN vectors, the frozen graphs give other vectors
+    return 'keras'
 
 
 def load_model():
@@ -70,13 +77,34 @@ def load_model():
     model = rmac((3, INPUT_DIMENSION[0], INPUT_DIMENSION[1]), len(regions))
 
 
+def get_tiled_regions(batch_size):
+    # the regions are the same for every frame, so the tiled tensor is built once and sliced per batch
+    global tiled_regions
+    if tiled_regions is None or tiled_regions.shape[0] < batch_size:
+        tiled_regions = np.tile(np.expand_dims(regions, axis=0), (batch_size, 1, 1))
+    return tiled_regions[:batch_size]
+
+
 def to_feature_vector(img_array):
     if model is None:
         load_model()
-    img = cv2.resize(img_array, dsize=INPUT_DIMENSION, interpolation=cv2.INTER_NEAREST)
-    img = img.reshape((3, INPUT_DIMENSION[0], INPUT_DIMENSION[1]))
-    img = np.expand_dims(img, axis=0)
-    RMAC = model.predict([img, np.expand_dims(regions, axis=0)])
+    img = np.expand_dims(preprocess(img_array), axis=0)
+    RMAC = model.predict([img, get_tiled_regions(1)])
     return RMAC[0, :].astype('float32')
 
 
+def to_feature_vectors(img_arrays, batch_size=BATCH_SIZE):
+    """
+    Batched version of to_feature_vector, runs one predict per batch_size frames.
+    :param img_arrays: sequence of frames or an (N, H, W, 3) stack of frames
+    :param batch_size: number of frames per predict call
+    :return: (N, vector_size) float32 matrix of RMAC vectors
+    """
+    if model is None:
+        load_model()
+    imgs = np.stack([preprocess(img_array) for img_array in img_arrays])
+    RMAC = []
+    for start in range(0, len(imgs), batch_size):
+        batch = imgs[start:start + batch_size]
+        RMAC.append(model.predict([batch, get_tiled_regions(len(batch))], batch_size=batch_size))
+    return np.concatenate(RMAC, axis=0).astype('float32')
@@ -1,11 +1,16 @@
 import pickle
 import os
+import cv2
 
 realpath = os.path.dirname(os.path.relpath(__file__))
 
 DATA_DIR = realpath + '/data'
 PCA_FILE = "PCAmatrices.mat"
 IMG_SIZE = 1024
+INPUT_DIMENSION = (224, 224)
+# number of frames collected for the methods which vectorize whole batches of frames (CH, CNN), the batch size of
+# the CNN model calls
+BATCH_SIZE = 32
 
 
 def save_obj(obj, filename):
@@ -31,3 +36,8 @@ def preprocess_image(x):
 	# RgB -> BGR
 	x = x[:, ::-1, :, :]
 	return x
+
+
+def preprocess(img_array):
+	img = cv2.resize(img_array, dsize=INPUT_DIMENSION, interpolation=cv2.INTER_NEAREST)
+	return img.reshape((3, INPUT_DIMENSION[0], INPUT_DIMENSION[1]))
@@ -0,0 +1,166 @@
+import numpy as np
+
+
+# longest gap in seconds filled between two matching frames
+LOOKAHEAD_SECONDS = 10
+
+
+def fill_gaps(sequence, lookahead):
+	"""
+	Fills the gap in features sequence in case of the gap between 1's and 0's values.
+	A gap is filled when the next 1 follows the previous one within lookahead - 1 positions.
+	:param sequence: boolean array consisting of 0's and 1's
+	:param lookahead: skipping params in sequence
+	:return: the same sequence filled where gap has occured
+	"""
+	ones = np.flatnonzero(sequence)
+	gaps = np.diff(ones) - 1
+	fill = (gaps > 0) & (gaps <= lookahead - 2)
+	# every filled gap adds 1 at its first zero and -1 after its last zero, the cumulative sum marks the gaps
+	marks = np.zeros(len(sequence) + 1, np.int64)
+	np.add.at(marks, ones[:-1][fill] + 1, 1)
+	np.add.at(marks, ones[1:][fill], -1)
+	sequence[np.cumsum(marks[:-1]) > 0] = True
+	return sequence
+
+
+def find_runs(sequence):
+	"""
+	Run-length encoding of the 1's of the sequence.
+	:return: arrays of the first and the last index of every run
+	"""
+	edges = np.diff(np.concatenate(([0], np.asarray(sequence, np.int8), [0])))
+	return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+
+
+def longest_segments(timestamps, k=2):
+	"""
+	Picks the k longest segments, the earlier one wins when the lengths are equal.
+	:param timestamps: list of (start, end) pairs
+	:return: the timestamps themselves when there are not more than k, the k longest ordered by length otherwise
+	"""
+	if len(timestamps) <= k:
+		return timestamps
+
+	lengths = np.array([end - start for start, end in timestamps])
+	return [timestamps[i] for i in np.argsort(-lengths, kind='stable')[:k]]
+
+
+def distance_threshold(result, percentile):
+	"""
+	:param result: nearest other episode distance of every sampled frame, NaN for the frames which were not vectorized
+	:return: percentile of the distances of the vectorized frames
+	"""
+	return np.nanpercentile(result, percentile)
+
+
+def detect_segments(result, framerate, framejump, percentile, video_start_threshold_percentile,
+					video_end_threshold_seconds, min_detection_size_seconds, lookahead_seconds=LOOKAHEAD_SECONDS,
+					sample_times=None):
+	"""
+	Finds the segments of an episode whose nearest neighbour distances are below the percentile threshold,
+	long enough and located at the beginning or the end of the episode.
+	:param result: nearest other episode distance of every sampled frame
+	:param lookahead_seconds: longest gap in seconds filled between two matching frames
+	:param sample_times: presentation time in seconds of every sampled frame followed by the duration of the episode,
+	the frames are placed at index / (framerate / framejump) when None
+	:return: lists of the (start, end) timestamps in seconds detected at the beginning and at the end
+	"""
+	samples_per_second = framerate / framejump
+	if sample_times is not None:
+		# the gaps are filled at the average rate of unevenly sampled frames
+		samples_per_second = len(result) / sample_times[-1]
+	threshold = distance_threshold(result, percentile)
+	below_threshold = result < threshold
+	below_threshold = fill_gaps(below_threshold, int(samples_per_second * lookahead_seconds))
+	starts, ends = find_runs(below_threshold)
+
+	if sample_times is None:
+		occurs_at_beggining = ends < len(result) * (video_start_threshold_percentile/100)
+		ends_at_the_end = ends > len(result) - video_end_threshold_seconds * samples_per_second
+		long_enough = ends - starts > min_detection_size_seconds * samples_per_second
+		timestamps = np.stack((starts / samples_per_second, ends / samples_per_second), axis=1)
+	else:
+		sample_times = np.asarray(sample_times, np.float64)
+		duration = sample_times[-1]
+		occurs_at_beggining = sample_times[ends] < duration * (video_start_threshold_percentile/100)
+		ends_at_the_end = sample_times[ends] > duration - video_end_threshold_seconds
+		long_enough = sample_times[ends] - sample_times[starts] > min_detection_size_seconds
+		timestamps = np.stack((sample_times[starts], sample_times[ends]), axis=1)
+	beginning = long_enough & occurs_at_beggining
+	end = long_enough & ~occurs_at_beggining & ends_at_the_end
+
+	return [tuple(t) for t in timestamps[beginning].tolist()], [tuple(t) for t in timestamps[end].tolist()]
+
+
+def detection_windows(samples, samples_per_second, video_start_threshold_percentile, video_end_threshold_seconds,
+					  margin_seconds):
+	"""
+	Ranges of the sampled frames detect_segments can report segments in: the head up to the start threshold and the
+	tail within the end threshold, both widened by the safety margin. An outro only has to end within the end
+	threshold, so the margin also bounds how long a detected outro can be.
+	:param samples: number of sampled frames of the episode
+	:return: list of [first, end) ranges of sampled frames, a single range when the head and the tail overlap
+	"""
+	margin = int(np.ceil(margin_seconds * samples_per_second))
+	head_end = int(np.ceil(samples * video_start_threshold_percentile / 100)) + margin
+	tail_start = samples - int(np.ceil(video_end_threshold_seconds * samples_per_second)) - margin
+	if tail_start <= head_end:
+		return [(0, samples)]
+	return [(0, head_end), (tail_start, samples)]
+
+
+def expand_windows(result, windows, samples):
+	"""
+	Places the distances of the windowed frames at their positions in the whole episode, the frames which were
+	not vectorized are NaN, they never match and are left out of the percentile threshold.
+	:param result: distances of the frames of the windows, a truncated last window is allowed
+	:param windows: [first, end) ranges of sampled frames of detection_windows
+	:return: array of samples distances
+	"""
+	expanded = np.full(samples, np.nan, np.float32)
+	positions = np.concatenate([np.arange(first, end) for first, end in windows])[:len(result)]
+	expanded[positions] = result[:len(positions)]
+	return expanded
+
+
+def boundary_windows(detected, fps, frame_count, refine_seconds):
+	"""
+	Frame ranges around the coarse boundaries of the segments, the inner edge of every window lies inside its segment.
+	:param detected: coarse (start, end) seconds of the segments
+	:param refine_seconds: seconds covered on both sides of a boundary
+	:return: list of ([first, end) frames around the start, [first, end) frames around the end) per segment
+	"""
+	margin = int(np.ceil(refine_seconds * fps))
+	windows = []
+	for start, end in detected:
+		start_frame, end_frame = int(round(start * fps)), int(round(end * fps))
+		windows.append(((max(0, start_frame - margin), min(start_frame + margin, end_frame) + 1),
+						(max(end_frame - margin, start_frame), min(end_frame + margin + 1, frame_count))))
+	return windows
+
+
+def snap_boundaries(distances, threshold, start_window, end_window, lookahead):
+	"""
+	Moves the boundaries of a segment to its first and last matching frame. The inner edge of a window lies inside
+	the segment, so the matches chained to it by the gap filling belong to the segment, a boundary is kept when
+	there are none.
+	:param distances: dense distances of the frames of the start window followed by the frames of the end window
+	:param lookahead: longest gap in frames filled between matching frames
+	:return: the refined start and end frames, None for a kept boundary
+	"""
+	start_length = start_window[1] - start_window[0]
+	# the inner edges are marked as matching, they are inside the segment by construction
+	start_matches = np.append(distances[:start_length] < threshold, True)
+	end_matches = np.insert(distances[start_length:] < threshold, 0, True)
+	start_matches = fill_gaps(start_matches, lookahead)
+	end_matches = fill_gaps(end_matches, lookahead)
+
+	refined_start = refined_end = None
+	starts, ends = find_runs(start_matches)
+	if starts[-1] < start_length:
+		refined_start = start_window[0] + int(starts[-1])
+	starts, ends = find_runs(end_matches)
+	if ends[0] > 0:
+		refined_end = end_window[0] + int(ends[0]) - 1
+	return refined_start, refined_end
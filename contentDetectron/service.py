@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import queue
+import uuid
+import inspect
+import argparse
+import threading
+import numpy as np
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn, UnixStreamServer
+from . import detectron
+from . import segments
+from . import featureStore
+from . import artifactCache
+from . import featureVectorizer
+from . import instrumentation
+
+
+DEFAULT_PORT = 8765
+# jobs waiting for a runner, further submissions are rejected until the queue drains
+QUEUE_SIZE = 16
+# season indices kept in memory for the episode jobs, the least recently used one is dropped first
+MAX_SEASON_INDICES = 8
+# finished jobs kept for GET /jobs/<id>, the oldest are forgotten first
+MAX_FINISHED_JOBS = 1000
+# parameters of the jobs, the service itself fixes the feature method and the artifacts directory
+SERVICE_PARAMS = ('video_dir', 'feature_vector_function', 'artifacts_dir', 'metrics', 'workers')
+# parameters of the season jobs the episode jobs do not support, they match the episode against its season only
+SEASON_ONLY_PARAMS = ('annotations', 'catalog_dir', 'catalog_factory', 'catalog_search_params', 'refine',
+					  'refine_seconds')
+
+
+class SeasonIndex:
+	"""
+	In memory FAISS index of the stored vectors of a season. The vectors of new episodes are added to it,
+	it is rebuilt when a vector artifact it holds is no longer part of the season, e.g. for a replaced episode.
+	"""
+
+	def __init__(self, season):
+		self.keys = list(season["vector_keys"])
+		self.index = detectron.build_season_index(detectron.load_season_vectors(self.keys, season["vectors_dir"]),
+												  season["compression"])
+
+	def is_stale(self, season):
+		return not set(self.keys) <= set(season["vector_keys"])
+
+	def update(self, season):
+		for key in season["vector_keys"]:
+			if key not in self.keys:
+				vectors = featureStore.load_vectors(season["vectors_dir"], key)
+				self.index.add_with_ids(detectron.as_float32(vectors), np.full(len(vectors), len(self.keys), np.int64))
+				self.keys.append(key)
+
+	def episode_id(self, key):
+		return self.keys.index(key)
+
+
+class DetectionService:
+	"""
+	Runs detection jobs with a model loaded once. A season job runs detectron.detect on a whole season directory,
+	an episode job only vectorizes the new episodes of a season and matches one of them against the in memory index
+	of the season. The jobs wait in a bounded queue for one of the concurrency runner threads.
+	:param feature_vector_function: feature method of every job, its model is loaded once by the runners
+	:param concurrency: number of jobs running at the same time, a single one for the methods which are not
+	thread-safe like the keras CNN model, see featureVectorizer.is_thread_safe
+	:param detect_params: defaults of the parameters of detectron.detect for every job
+	"""
+
+	def __init__(self, artifacts_dir, feature_vector_function='CH', concurrency=1, queue_size=QUEUE_SIZE,
+				 detect_params=None):
+		if concurrency > 1 and not featureVectorizer.is_thread_safe(feature_vector_function):
+			raise Exception(f"The {feature_vector_function} model can not run several jobs at once, "
+							f"use a concurrency of 1")
+		self.artifacts_dir = artifacts_dir
+		self.feature_vector_function = feature_vector_function
+		signature = inspect.signature(detectron.detect).parameters.items()
+		self.default_params = {name: parameter.default for name, parameter in signature
+							   if parameter.default is not inspect.Parameter.empty and name not in SERVICE_PARAMS}
+		self.detect_params = dict(self.default_params, **(detect_params or {}))
+		self.jobs = OrderedDict()
+		self.pending = queue.Queue(queue_size)
+		self.season_indices = OrderedDict()
+		self.jobs_lock = threading.Lock()
+		self.index_lock = threading.Lock()
+		self.model_lock = threading.Lock()
+
+		self.runners = [threading.Thread(target=self.run, daemon=True) for _ in range(concurrency)]
+		for runner in self.runners:
+			runner.start()
+
+	def submit(self, video_dir, episode=None, params=None):
+		"""
+		:param episode: file name of the episode of a new episode job, a season job when None
+		:param params: parameters of detectron.detect overriding the defaults of the service
+		:return: the queued job, None when the queue is full
+		"""
+		params = params or {}
+		unknown = set(params) - set(self.detect_params)
+		if unknown:
+			raise Exception(f"Unknown parameters {', '.join(sorted(unknown))}")
+		if episode is not None:
+			job_params = dict(self.detect_params, **params)
+			unsupported = [name for name in SEASON_ONLY_PARAMS if job_params[name] != self.default_params[name]]
+			if unsupported:
+				raise Exception(f"The episode jobs do not support the parameters {', '.join(unsupported)}, "
+								f"submit a season job")
+		# every key is created here, the runners only assign them while the handlers serialize the job
+		job = {"id": uuid.uuid4().hex, "kind": "season" if episode is None else "episode", "status": "queued",
+			   "video_dir": video_dir, "episode": episode, "params": params, "submitted": time.time(),
+			   "started": None, "finished": None, "result": None, "metrics": None, "error": None,
+			   "done": threading.Event()}
+		with self.jobs_lock:
+			try:
+				self.pending.put_nowait(job)
+			except queue.Full:
+				return None
+			self.jobs[job["id"]] = job
+		return job
+
+	def get(self, job_id):
+		with self.jobs_lock:
+			return self.jobs.get(job_id)
+
+	def run(self):
+		# keras models are bound to the graph of the thread which loaded them, so the model is loaded by the
+		# runners which use it, only by the first one when several runners share a thread-safe model
+		model_error = None
+		with self.model_lock:
+			try:
+				featureVectorizer.load_model(self.feature_vector_function)
+			except Exception as error:
+				model_error = error
+		while True:
+			job = self.pending.get()
+			job["status"] = "running"
+			job["started"] = time.time()
+			metrics = instrumentation.Metrics()
+			try:
+				if model_error is not None:
+					raise model_error
+				params = dict(self.detect_params, **job["params"])
+				if job["episode"] is None:
+					job["result"] = detectron.detect(job["video_dir"], self.feature_vector_function,
+													 artifacts_dir=self.artifacts_dir, metrics=metrics, **params)
+				else:
+					job["result"] = self.detect_episode(job["video_dir"], job["episode"], params, metrics)
+				job["status"] = "done"
+			except Exception as error:
+				job["status"] = "failed"
+				job["error"] = str(error)
+			job["metrics"] = metrics.to_dict()
+			job["finished"] = time.time()
+			job["done"].set()
+			self.forget_finished()
+
+	def forget_finished(self):
+		with self.jobs_lock:
+			finished = [job_id for job_id, job in self.jobs.items() if job["done"].is_set()]
+			for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+				del self.jobs[job_id]
+
+	def season_index(self, season):
+		key = (os.path.abspath(season["video_dir"]), season["compression"])
+		season_index = self.season_indices.pop(key, None)
+		if season_index is None or season_index.is_stale(season):
+			season_index = SeasonIndex(season)
+		else:
+			season_index.update(season)
+		self.season_indices[key] = season_index
+		while len(self.season_indices) > MAX_SEASON_INDICES:
+			self.season_indices.popitem(last=False)
+		return season_index
+
+	def detect_episode(self, video_dir, episode, params, metrics):
+		"""
+		Detects the intro and outro of a single episode of a season. Only the episodes without stored vectors are
+		vectorized, the episode is then queried against the in memory index of the season. The other episodes keep
+		their previous detections.
+		:return: dictionary of the detected (start, end) seconds of the episode, none for the only episode of a season
+		"""
+		resize_width = 224 if self.feature_vector_function == 'CNN' else params["resize_width"]
+		detection_windows = detectron.get_detection_windows(
+			params["extraction"], params["video_start_threshold_percentile"], params["video_end_threshold_seconds"],
+			params["window_margin_seconds"]
+		)
+		cache = artifactCache.ArtifactCache(self.artifacts_dir, params["cache_max_bytes"])
+		season = detectron.plan_season(video_dir, self.feature_vector_function, self.artifacts_dir, cache,
+									   params["framejump"], resize_width, params["ingestion"], params["batch_size"],
+									   metrics, detection_windows, params["compression"], params["sampling"],
+									   params["sample_fps"], params["feature_threads"])
+		if episode not in season["videos"]:
+			raise Exception(f"The episode {episode} is not in {video_dir}")
+		detectron.prepare_season(season, self.feature_vector_function, 1, metrics, cache)
+		detectron.register_season(season, cache)
+
+		i = season["videos"].index(episode)
+		key = season["vector_keys"][i]
+		with self.index_lock:
+			with metrics.stage("index"):
+				season_index = self.season_index(season)
+			if len(season_index.keys) < 2:
+				# nothing to match against, the search would double k up to the vectors of the episode itself
+				return {episode: []}
+			with metrics.stage("query", episode):
+				result = detectron.search_other_episodes(
+					season_index.index, detectron.as_float32(featureStore.load_vectors(season["vectors_dir"], key)),
+					season_index.episode_id(key), 16
+				)
+		result, framerate, sample_times = detectron.episode_distances(season, i, result)
+		with metrics.stage("post_processing", episode):
+			detected_beginning, detected_end = segments.detect_segments(
+				result, framerate, params["framejump"], params["percentile"],
+				params["video_start_threshold_percentile"], params["video_end_threshold_seconds"],
+				params["min_detection_size_seconds"], sample_times=sample_times
+			)
+		return {episode: segments.longest_segments(detected_beginning) + detected_end}
+
+
+def job_json(job):
+	return {name: value for name, value in job.items() if name != "done"}
+
+
+def to_json(value):
+	# numpy scalars of the detections and the metrics
+	return json.dumps(value, default=lambda o: o.item() if hasattr(o, 'item') else str(o)).encode()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+	"""
+	POST /jobs with a json body {"video_dir", "episode" (optional), "params" (optional), "wait" (optional)} queues a
+	job and answers 202 with the job, or the finished job when wait is true, 503 when the queue is full.
+	GET /jobs/<id> answers the job with its status, result and metrics, GET /health the state of the queue.
+	"""
+	service = None
+
+	def respond(self, status, body):
+		payload = to_json(body)
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(payload)))
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def do_GET(self):
+		if self.path == "/health":
+			self.respond(200, {"status": "ok", "queued": self.service.pending.qsize(),
+							   "method": self.service.feature_vector_function})
+		elif self.path.startswith("/jobs/"):
+			job = self.service.get(self.path[len("/jobs/"):])
+			if job is None:
+				self.respond(404, {"error": "unknown job"})
+			else:
+				self.respond(200, job_json(job))
+		else:
+			self.respond(404, {"error": "unknown path"})
+
+	def do_POST(self):
+		if self.path != "/jobs":
+			self.respond(404, {"error": "unknown path"})
+			return
+		try:
+			request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+			job = self.service.submit(request["video_dir"], request.get("episode"), request.get("params"))
+		except (ValueError, KeyError) as error:
+			self.respond(400, {"error": f"invalid request: {error}"})
+			return
+		except Exception as error:
+			self.respond(400, {"error": str(error)})
+			return
+		if job is None:
+			self.respond(503, {"error": "the job queue is full"})
+			return
+		if request.get("wait"):
+			job["done"].wait()
+			self.respond(200, job_json(job))
+		else:
+			self.respond(202, job_json(job))
+
+	def address_string(self):
+		# unix socket clients have no address
+		return self.client_address[0] if self.client_address else "local"
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+	daemon_threads = True
+
+	def get_request(self):
+		request, _ = super().get_request()
+		return request, ("local", 0)
+
+
+def serve(service, port=DEFAULT_PORT, socket_path=None):
+	"""
+	Serves the service on localhost:port, or on a unix socket when socket_path is given, until interrupted.
+	"""
+	handler = type("ServiceRequestHandler", (RequestHandler,), {"service": service})
+	if socket_path is None:
+		server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+		print(f"Detection service listening on http://127.0.0.1:{port}")
+	else:
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+		server = ThreadingUnixHTTPServer(socket_path, handler)
+		print(f"Detection service listening on {socket_path}")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if socket_path is not None and os.path.exists(socket_path):
+			os.remove(socket_path)
+
+
+def parse_cli_arguments():
+	parser = argparse.ArgumentParser(u"Long running detection service keeping the model and the season indices in "
+									 u"memory, the jobs are submitted over a localhost HTTP API")
+	parser.add_argument(u"--feature_vector_method", nargs='?', const='CH', type=str, default='CH')
+	parser.add_argument(u"--artifacts_dir", required=False, nargs='?', type=str, const='./artifacts/',
+						default='./artifacts/')
+	parser.add_argument(u"--port", nargs='?', const=DEFAULT_PORT, type=int, default=DEFAULT_PORT)
+	parser.add_argument(u"--socket", required=False, type=str, default=None,
+						help="unix socket path the service listens on instead of the localhost port")
+	parser.add_argument(u"--concurrency", nargs='?', const=1, type=int, default=1,
+						help="number of jobs running at the same time, the keras CNN model only supports one")
+	parser.add_argument(u"--queue_size", nargs='?', const=QUEUE_SIZE, type=int, default=QUEUE_SIZE,
+						help="number of jobs waiting to run, further jobs are rejected")
+	parser.add_argument(u"--params", required=False, type=json.loads, default=None,
+						help="json object of the detectron.detect parameters of every job, e.g. '{\"framejump\": 8}'")
+	return parser.parse_args()
+
+
+def main():
+	command_params = parse_cli_arguments()
+	service = DetectionService(command_params.artifacts_dir, command_params.feature_vector_method,
+							   command_params.concurrency, command_params.queue_size, command_params.params)
+	serve(service, command_params.port, command_params.socket)
+
+
+if __name__ == "__main__":
+	main()
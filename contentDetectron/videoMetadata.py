@@ -0,0 +1,66 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from . import videoUtils
+from . import fileUtils
+from . import artifactCache
+
+
+MANIFEST_FILE = "video_metadata.json"
+PROBE_WORKERS = 8
+
+
+def manifest_filename(artifacts_dir):
+	# kept under the cache dir, artifacts_dir defaults to the video dir whose files are all taken as episodes
+	return os.path.join(artifacts_dir, artifactCache.CACHE_DIR, MANIFEST_FILE)
+
+
+def load_manifest(artifacts_dir):
+	if not os.path.isfile(manifest_filename(artifacts_dir)):
+		return {}
+	with open(manifest_filename(artifacts_dir)) as infile:
+		return json.load(infile)
+
+
+def save_manifest(artifacts_dir, manifest):
+	os.makedirs(os.path.dirname(manifest_filename(artifacts_dir)), exist_ok=True)
+	with fileUtils.atomic_output(manifest_filename(artifacts_dir)) as tmp_filename:
+		with open(tmp_filename, 'w') as outfile:
+			json.dump(manifest, outfile, indent=1)
+
+
+def file_signature(video_file):
+	stat = os.stat(video_file)
+	return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def is_fresh(entry, signature):
+	return entry is not None and entry["size"] == signature["size"] and entry["mtime"] == signature["mtime"]
+
+
+def get_videos_metadata(video_files, artifacts_dir, workers=PROBE_WORKERS):
+	"""
+	Returns fps, frame count, duration and resolution of every video. Each file is probed only once, the results
+	are kept in a manifest under artifacts_dir/cache/ keyed by the path and invalidated when the size or mtime
+	changes. The files missing from the manifest are probed concurrently, as the probing mostly waits on the storage.
+	:param video_files: paths of the videos
+	:return: dict of the video path to its metadata
+	"""
+	manifest = load_manifest(artifacts_dir)
+	signatures = {video_file: file_signature(video_file) for video_file in video_files}
+	keys = {video_file: os.path.abspath(video_file) for video_file in video_files}
+	stale = [video_file for video_file in video_files if not is_fresh(manifest.get(keys[video_file]),
+																	   signatures[video_file])]
+
+	if stale:
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			probed = pool.map(videoUtils.probe, stale)
+			for video_file, metadata in zip(stale, probed):
+				manifest[keys[video_file]] = dict(signatures[video_file], metadata=metadata)
+		save_manifest(artifacts_dir, manifest)
+
+	return {video_file: manifest[keys[video_file]]["metadata"] for video_file in video_files}
+
+
+def get_video_metadata(video_file, artifacts_dir):
+	return get_videos_metadata([video_file], artifacts_dir)[video_file]
@@ -1,5 +1,23 @@
+import re
+import sys
 import cv2
+import queue
 import ffmpeg
+import threading
+import numpy as np
+from collections import deque
+from . import fileUtils
+
+
+# how the frames are sampled: every framejump-th frame, only the keyframes or a fixed number of frames per second
+SAMPLING_MODES = ('framejump', 'keyframes', 'fps')
+SHOWINFO_PATTERN = re.compile(r"\bn:\s*\d+\s+pts:\s*-?\d+\s+pts_time:(\S+)")
+# log lines of ffmpeg forwarded to the stderr of the process, ffmpeg prefixes them with their level
+ERROR_PATTERN = re.compile(r"\[(panic|fatal|error)\]")
+# ffmpeg error lines kept for the exception of a failed decoding
+ERROR_LINES = 10
+# longest wait in seconds for the timestamp of a frame already read from the pipe
+TIMESTAMP_TIMEOUT_SECONDS = 30
 
 
 def get_framerate(video_file):
@@ -7,22 +25,211 @@ def get_framerate(video_file):
 	return video.get(cv2.CAP_PROP_FPS)
 
 
-def resize(video_file, outfile, resize_width):
+def parse_frame_rate(rate):
+	numerator, _, denominator = rate.partition('/')
+	if not denominator:
+		return float(numerator)
+	return float(numerator) / float(denominator) if float(denominator) else 0.0
+
+
+def capture_metadata(video_file):
 	video = cv2.VideoCapture(video_file)
+	fps = video.get(cv2.CAP_PROP_FPS)
 	frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+	return {"fps": fps, "frame_count": frame_count, "duration": frame_count / fps if fps else 0.0,
+			"width": int(video.get(cv2.CAP_PROP_FRAME_WIDTH)), "height": int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))}
+
+
+def probe(video_file):
+	"""
+	Reads fps, frame count, duration and resolution of the first video stream with a single ffprobe call.
+	Falls back to OpenCV when ffprobe is not installed or can not read the file.
+	:return: dict with fps, frame_count, duration, width and height
+	"""
+	try:
+		info = ffmpeg.probe(video_file, select_streams='v:0')
+	except (FileNotFoundError, ffmpeg.Error):
+		return capture_metadata(video_file)
+	if not info.get('streams'):
+		return capture_metadata(video_file)
+
+	stream = info['streams'][0]
+	# OpenCV reports the avg_frame_rate of the stream as its fps
+	fps = parse_frame_rate(stream.get('avg_frame_rate', '0/0')) or parse_frame_rate(stream.get('r_frame_rate', '0/0'))
+	duration = float(stream.get('duration') or info.get('format', {}).get('duration') or 0.0)
+	frame_count = int(stream['nb_frames']) if stream.get('nb_frames') else int(round(duration * fps))
+	return {"fps": fps, "frame_count": frame_count, "duration": duration,
+			"width": int(stream.get('width', 0)), "height": int(stream.get('height', 0))}
+
+
+def get_scaled_size(video_file, resize_width, metadata=None):
+	if resize_width == 224:
+		return 244, 244
+	if metadata is None:
+		metadata = capture_metadata(video_file)
+	width = metadata["width"]
+	height = metadata["height"]
+	if not width or not height:
+		raise Exception(f"Could not read the resolution of {video_file}")
+	# mirrors the h = trunc(ow/a/2)*2 expression of the scale filter
+	return resize_width, int(resize_width / (width / height) / 2) * 2
+
+
+def scale(stream, resize_width, height=None):
+	"""
+	:param height: output height, the piped frames are scaled to the exact get_scaled_size the pipe is read with,
+	by default it keeps the aspect ratio
+	"""
+	if height is not None:
+		return ffmpeg.filter(stream, 'scale', w=resize_width, h=height)
+	if resize_width == 224:
+		return ffmpeg.filter(stream, 'scale', w=244, h=244)
+	# in order to return the same aspect ratio during resizing the h = trunc(ow/a/2)*2
+	# more here ---> https://stackoverflow.com/questions/20847674/ffmpeg-libx264-height-not-divisible-by-2
+	return ffmpeg.filter(stream, 'scale', w=resize_width, h="trunc(ow/a/2)*2")
+
+
+def resize(video_file, outfile, resize_width, quiet=False, metadata=None):
+	if metadata is None:
+		metadata = capture_metadata(video_file)
+	frame_count = metadata["frame_count"]
 
 	if frame_count > 0:
-		stream = ffmpeg.input(video_file)
-		if resize_width == 224:
-			stream = ffmpeg.filter(stream, 'scale', w=244, h=244)
-		else:
-			# in order to return the same aspect ratio during resizing the h = trunc(ow/a/2)*2
-			# more here ---> https://stackoverflow.com/questions/20847674/ffmpeg-libx264-height-not-divisible-by-2
-			stream = ffmpeg.filter(stream, 'scale', w=resize_width, h="trunc(ow/a/2)*2")
-		stream = ffmpeg.output(stream, outfile)
-		try:
-			ffmpeg.run(stream)
-		except FileNotFoundError:
-			raise Exception("ffmpeg is not found on your device, install ffmpeg")
+		with fileUtils.atomic_output(outfile) as tmp_outfile:
+			stream = ffmpeg.input(video_file)
+			stream = scale(stream, resize_width)
+			stream = ffmpeg.output(stream, tmp_outfile)
+			stream = ffmpeg.overwrite_output(stream)
+			try:
+				ffmpeg.run(stream, quiet=quiet)
+			except FileNotFoundError:
+				raise Exception("ffmpeg is not found on your device, install ffmpeg")
 	else:
 		raise Exception(f"The video file {video_file} provided is not supported or corrupted.")
+
+
+def read_log(stderr, timestamps, errors):
+	# showinfo logs one line per frame leaving the filter graph, in the order the frames are piped
+	for line in iter(stderr.readline, b''):
+		line = line.decode(errors='replace')
+		match = SHOWINFO_PATTERN.search(line)
+		if match is not None:
+			timestamps.put(float(match.group(1)))
+		elif ERROR_PATTERN.search(line):
+			sys.stderr.write(line)
+			errors.append(line.strip())
+
+
+def iter_piped_frames(stream, width, height, total=None, timestamps=None):
+	"""
+	Runs the ffmpeg stream with a raw BGR output and reads its frames from a pipe.
+	:param stream: ffmpeg input stream with the sampling and scaling filters applied
+	:param total: maximum number of frames to read
+	:param timestamps: list the presentation time in seconds of every read frame is appended to, read from the
+	showinfo filter, not collected when None
+	:return: generator of the frames, read-only arrays over the piped bytes
+	"""
+	frame_size = width * height * 3
+	if timestamps is not None:
+		stream = ffmpeg.filter(stream, 'showinfo')
+	stream = ffmpeg.output(stream, 'pipe:', format='rawvideo', pix_fmt='bgr24', vsync='vfr')
+	loglevel = 'level+error' if timestamps is None else 'level+info'
+	stream = ffmpeg.overwrite_output(stream).global_args('-hide_banner', '-loglevel', loglevel)
+	try:
+		process = ffmpeg.run_async(stream, pipe_stdout=True, pipe_stderr=True)
+	except FileNotFoundError:
+		raise Exception("ffmpeg is not found on your device, install ffmpeg")
+
+	frame_timestamps = queue.Queue()
+	errors = deque(maxlen=ERROR_LINES)
+	log_reader = threading.Thread(target=read_log, args=(process.stderr, frame_timestamps, errors), daemon=True)
+	log_reader.start()
+	sampled = 0
+	ended = False
+	try:
+		while total is None or sampled < total:
+			buffer = process.stdout.read(frame_size)
+			if len(buffer) < frame_size:
+				ended = True
+				break
+			if timestamps is not None:
+				try:
+					timestamps.append(frame_timestamps.get(timeout=TIMESTAMP_TIMEOUT_SECONDS))
+				except queue.Empty:
+					raise Exception(f"ffmpeg did not report the timestamp of the frame {sampled}")
+			yield np.frombuffer(buffer, np.uint8).reshape((height, width, 3))
+			sampled += 1
+	finally:
+		process.stdout.close()
+		# ffmpeg is only stopped when the frames are no longer read, at the end of the output it exits by itself
+		if not ended and process.poll() is None:
+			process.kill()
+		process.wait()
+	if ended and process.returncode != 0:
+		log_reader.join(TIMESTAMP_TIMEOUT_SECONDS)
+		raise Exception(f"ffmpeg failed with the exit code {process.returncode}: {' '.join(errors)}")
+
+
+def iter_scaled_frames(video_file, resize_width, framejump, total=None, metadata=None, start_frame=0,
+					   timestamps=None):
+	"""
+	Decodes the video with ffmpeg straight to the target resolution, keeping only every framejump-th frame,
+	and reads the raw BGR frames from a pipe. Nothing is encoded or written to disk.
+	:param video_file: original video file
+	:param resize_width: target frame width, the height keeps the aspect ratio the same way resize does
+	:param framejump: step between the sampled frames
+	:param total: maximum number of frames to read
+	:param metadata: probed metadata of the video, it is read from the file when not provided
+	:param start_frame: frame the decoding starts at, ffmpeg seeks to its timestamp
+	:param timestamps: list the presentation times of the frames are appended to, see iter_piped_frames
+	:return: generator of (frame_index, frame) pairs, frames are read-only arrays over the piped bytes
+	"""
+	if metadata is None:
+		metadata = capture_metadata(video_file)
+	width, height = get_scaled_size(video_file, resize_width, metadata)
+
+	if start_frame:
+		stream = ffmpeg.input(video_file, ss=start_frame / metadata["fps"])
+	else:
+		stream = ffmpeg.input(video_file)
+	stream = ffmpeg.filter(stream, 'select', f"not(mod(n,{framejump}))")
+	stream = scale(stream, width, height)
+	for sampled, frame in enumerate(iter_piped_frames(stream, width, height, total, timestamps)):
+		yield start_frame + sampled * framejump, frame
+
+
+def iter_sampled_frames(video_file, resize_width, sampling, sample_fps=None, metadata=None, timestamps=None):
+	"""
+	Decodes only the frames of a sampling mode, dropped by the decoder itself, straight to the target resolution.
+	'keyframes' decodes the keyframes alone (-skip_frame nokey). 'fps' keeps sample_fps frames per second,
+	the decoder skips the frames no other frame references (-skip_frame noref) and the fps filter picks
+	the closest decoded frame of every sampling time.
+	:param sampling: 'keyframes' or 'fps'
+	:param timestamps: list the presentation times of the frames are appended to, the sampled frames are not evenly
+	spaced, so they are needed to place the frames in the episode
+	:return: generator of (sample_index, frame) pairs
+	"""
+	if metadata is None:
+		metadata = capture_metadata(video_file)
+	width, height = get_scaled_size(video_file, resize_width, metadata)
+
+	if sampling == 'keyframes':
+		stream = ffmpeg.input(video_file, skip_frame='nokey')
+	elif sampling == 'fps':
+		stream = ffmpeg.input(video_file, skip_frame='noref')
+		stream = ffmpeg.filter(stream, 'fps', fps=sample_fps)
+	else:
+		raise Exception(f"Unknown sampling mode {sampling}, use one of {', '.join(SAMPLING_MODES)}")
+	stream = scale(stream, width, height)
+	yield from enumerate(iter_piped_frames(stream, width, height, None, timestamps))
+
+
+def iter_scaled_frame_windows(video_file, resize_width, framejump, windows, metadata=None):
+	"""
+	iter_scaled_frames of only the given windows, every window is decoded by its own ffmpeg seeking to its start.
+	:param windows: [first, end) ranges of sampled frames
+	"""
+	if metadata is None:
+		metadata = capture_metadata(video_file)
+	for first, end in windows:
+		yield from iter_scaled_frames(video_file, resize_width, framejump, end - first, metadata, first * framejump)
@@ -1,4 +1,8 @@
 from contentDetectron import detectron
+from contentDetectron import featureVectorizer
+from contentDetectron import instrumentation
+from contentDetectron import videoUtils
+from contentDetectron.rmac import frozen
 import os
 import argparse
 import subprocess
@@ -11,7 +15,11 @@ def parse_cli_arguments():
 	parser = argparse.ArgumentParser(
 		u"Python intro/autro detection for video files. Processes video inputs into segments: intro : outro"
 	)
-	parser.add_argument(u"--video_dir", required=True, help="video directory where the video files are stored")
+	seasons = parser.add_mutually_exclusive_group(required=True)
+	seasons.add_argument(u"--video_dir", help="video directory where the video files are stored")
+	seasons.add_argument(u"--library_dir",
+						 help="root directory whose subdirectories are seasons, all of them are processed in one run")
+	seasons.add_argument(u"--season_dirs", nargs='+', help="video directories of the seasons processed in one run")
 	parser.add_argument(u"--feature_vector_method", nargs='?', const='CH', type=str, default='CH')
 	parser.add_argument(u"--artifacts_dir", required=False, nargs='?', type=str, const='./artifacts/',
 						default='./artifacts/')
@@ -20,6 +28,55 @@ def parse_cli_arguments():
 	parser.add_argument(u"--resize_width", nargs='?', const=720, type=int, default=720)
 	parser.add_argument(u"--end_threshold", nargs='?', const=7, type=int, default=7)
 	parser.add_argument(u"--min_seconds", nargs='?', const=3, type=int, default=3)
+	parser.add_argument(u"--ingestion", choices=['resize', 'pipe'], default='resize',
+						help="'resize' re-encodes a resized copy of every video, 'pipe' decodes straight to the "
+							 "target resolution through an ffmpeg pipe without writing a resized video")
+	parser.add_argument(u"--extraction", choices=['full', 'head_tail'], default='full',
+						help="'full' vectorizes every sampled frame, 'head_tail' only the head and the tail of the "
+							 "episodes where the intros and outros are detected")
+	parser.add_argument(u"--sampling", choices=videoUtils.SAMPLING_MODES, default='framejump',
+						help="'framejump' samples every --framejump-th frame, 'keyframes' decodes only the keyframes "
+							 "and 'fps' --sample_fps frames per second, both through ffmpeg from the original videos")
+	parser.add_argument(u"--sample_fps", nargs='?', const=1, type=float, default=1,
+						help="frames per second sampled by the fps sampling")
+	parser.add_argument(u"--window_margin", nargs='?', const=120, type=float, default=120,
+						help="safety margin in seconds of the head_tail windows, it bounds the outro length")
+	parser.add_argument(u"--refine_seconds", nargs='?', const=3, type=float, default=None,
+						help="refines the boundaries found at --framejump by matching every frame within this many "
+							 "seconds of them, 3 when given without a value")
+	parser.add_argument(u"--rmac_graph", required=False, type=str, default=None,
+						help="frozen RMAC graph of the CNN method, by default the one exported into the rmac data "
+							 "directory is used when it exists")
+	parser.add_argument(u"--intra_op_threads", required=False, type=int, default=None,
+						help="threads of a single operation of the frozen RMAC graph inference")
+	parser.add_argument(u"--inter_op_threads", required=False, type=int, default=None,
+						help="threads running independent operations of the frozen RMAC graph inference")
+	parser.add_argument(u"--compression", required=False, type=str, default=None,
+						help="compression of the feature vectors of the method: float16 storage, pca<dimension> "
+							 "projection or pq<subquantizers> product quantization of the season index, a catalog "
+							 "index is compressed by its --catalog_index factory instead")
+	parser.add_argument(u"--workers", nargs='?', const=os.cpu_count(), type=int, default=1,
+						help="number of processes resizing and vectorizing the episodes of the season in parallel")
+	parser.add_argument(u"--feature_threads", nargs='?', const=2, type=int, default=1,
+						help="threads of every worker vectorizing the frames while the next ones are decoded, "
+							 "the keras CNN model always uses one")
+	parser.add_argument(u"--batch_size", nargs='?', const=featureVectorizer.BATCH_SIZE, type=int,
+						default=featureVectorizer.BATCH_SIZE,
+						help="number of frames vectorized per model call by the batched methods (CNN)")
+	parser.add_argument(u"--catalog_dir", required=False, type=str, default=None,
+						help="directory of a persistent approximate index the season is added to and queried against")
+	parser.add_argument(u"--catalog_index", nargs='?', const='HNSW32', type=str, default='HNSW32',
+						help="FAISS factory string of a new catalog index, e.g. IVF1024,Flat, IVF1024,PQ32 or HNSW32")
+	parser.add_argument(u"--nprobe", required=False, type=int, default=None,
+						help="number of inverted lists visited per query by IVF catalog indices")
+	parser.add_argument(u"--ef_search", required=False, type=int, default=None,
+						help="size of the dynamic candidate list per query of HNSW catalog indices")
+	parser.add_argument(u"--cache_max_gb", required=False, type=float, default=None,
+						help="size budget of the artifacts cache, least recently used resized videos are evicted "
+							 "first and feature vectors after them")
+	parser.add_argument(u"--profile", choices=instrumentation.PROFILE_MODES, default=None,
+						help="profiles the detection with cProfile or a sampling profiler into ./outputs/, "
+							 "the episodes processed by --workers processes are not profiled")
 	return parser.parse_args()
 
 
@@ -33,16 +90,68 @@ def main():
 	resize_frame = command_params.resize_width
 	end_threshold = command_params.end_threshold
 	minimum_sec = command_params.min_seconds
+	ingestion_mode = command_params.ingestion
+	workers_count = command_params.workers
+	batch_size = command_params.batch_size
+	catalog_search_params = {}
+	if command_params.nprobe is not None:
+		catalog_search_params['nprobe'] = command_params.nprobe
+	if command_params.ef_search is not None:
+		catalog_search_params['efSearch'] = command_params.ef_search
 
-	results = detectron.detect(video_dir=video_folder, feature_vector_function=feature_vector_method,
-							   artifacts_dir=artifacts_files, framejump=framejump_val, percentile=percentile_cutter,
-							   resize_width=resize_frame, video_end_threshold_seconds=end_threshold,
-							   min_detection_size_seconds=minimum_sec)
+	frozen.configure(command_params.rmac_graph, command_params.intra_op_threads, command_params.inter_op_threads)
+	metrics = instrumentation.Metrics()
+	refine = command_params.refine_seconds is not None
+	refine_seconds = command_params.refine_seconds if refine else detectron.REFINE_SECONDS
+	cache_max_bytes = None if command_params.cache_max_gb is None else int(command_params.cache_max_gb * 1024 ** 3)
+
+	if video_folder is None:
+		season_dirs = command_params.season_dirs or detectron.find_seasons(command_params.library_dir)
+		with instrumentation.profiled(command_params.profile, os.path.join('./outputs', 'profile_for_library')):
+			library_results = detectron.detect_library(
+				season_dirs, feature_vector_function=feature_vector_method, artifacts_dir=artifacts_files,
+				framejump=framejump_val, percentile=percentile_cutter, resize_width=resize_frame,
+				video_end_threshold_seconds=end_threshold, min_detection_size_seconds=minimum_sec,
+				ingestion=ingestion_mode, workers=workers_count, batch_size=batch_size,
+				catalog_dir=command_params.catalog_dir, catalog_factory=command_params.catalog_index,
+				catalog_search_params=catalog_search_params, cache_max_bytes=cache_max_bytes, metrics=metrics,
+				extraction=command_params.extraction, window_margin_seconds=command_params.window_margin,
+				refine=refine, refine_seconds=refine_seconds, compression=command_params.compression,
+				sampling=command_params.sampling, sample_fps=command_params.sample_fps,
+				feature_threads=command_params.feature_threads
+			)
+
+		with open(os.path.join('./outputs', 'outputs_for_library.csv'), "w") as outputs:
+			for season_dir, results in library_results.items():
+				for key in results.keys():
+					outputs.write("%s, %s, %s\n"%(season_dir, key, results[key]))
+
+		metrics.save(os.path.join('./outputs', 'metrics_for_library.json'))
+
+		print("Outputs saved into ./outputs/outputs_for_library.csv file.")
+		return
+
+	with instrumentation.profiled(command_params.profile, os.path.join('./outputs', 'profile_for_season')):
+		results = detectron.detect(video_dir=video_folder, feature_vector_function=feature_vector_method,
+								   artifacts_dir=artifacts_files, framejump=framejump_val, percentile=percentile_cutter,
+								   resize_width=resize_frame, video_end_threshold_seconds=end_threshold,
+								   min_detection_size_seconds=minimum_sec, ingestion=ingestion_mode,
+								   workers=workers_count, batch_size=batch_size, catalog_dir=command_params.catalog_dir,
+								   catalog_factory=command_params.catalog_index,
+								   catalog_search_params=catalog_search_params,
+								   cache_max_bytes=cache_max_bytes, metrics=metrics,
+								   extraction=command_params.extraction,
+								   window_margin_seconds=command_params.window_margin, refine=refine,
+								   refine_seconds=refine_seconds, compression=command_params.compression,
+								   sampling=command_params.sampling, sample_fps=command_params.sample_fps,
+								   feature_threads=command_params.feature_threads)
 
 	with open(os.path.join('./outputs', 'outputs_for_season.csv'), "w") as outputs:
 		for key in results.keys():
 			outputs.write("%s, %s\n"%(key, results[key]))
 
+	metrics.save(os.path.join('./outputs', 'metrics_for_season.json'))
+
 	print("Outputs saved into ./outputs/outputs_for_season.csv file.")
 
 